@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for create_pretraining_data.py.
+
+Generates a Japanese-like corpus of configurable size, then runs the
+pretraining data pipeline phase by phase (file read, tokenization, instance
+building, masking, feature conversion, TFRecord write) and reports wall time
+and Python memory per phase. Optionally profiles the whole run with cProfile
+or pyinstrument and records the hottest functions.
+"""
+
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import benchmark_utils
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class PhaseRecorder(object):
+    """Records wall time and traced Python memory of consecutive phases."""
+
+    def __init__(self):
+        self.phases = []
+
+    def run(self, name, fn, *args, **kwargs):
+        # Tracing restarts for every phase so that only allocations made by
+        # the phase itself are counted.
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.phases.append({
+            'phase': name,
+            'seconds': seconds,
+            'peak_traced_bytes': peak,
+            'retained_bytes': retained,
+        })
+        return result
+
+
+class CallTimer(object):
+    """Wraps a function and accumulates the wall time spent inside it."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.seconds = 0.0
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+
+
+def run_phases(cpd, tokenizer, input_file, output_file, args):
+    """Run the create_pretraining_data pipeline one phase at a time."""
+    import tensorflow as tf
+
+    recorder = PhaseRecorder()
+    rng = random.Random(args.random_seed)
+
+    lines = recorder.run('file_read', lambda: list(cpd.read_lines([input_file])))
+    documents = recorder.run('tokenization', cpd.tokenize_documents,
+                             lines, tokenizer)
+    rng.shuffle(documents)
+
+    # Masking runs inside create_instances_from_document, so it is timed by
+    # wrapping the module level function and subtracted from instance building.
+    masking = CallTimer(cpd.create_masked_lm_predictions)
+    cpd.create_masked_lm_predictions = masking
+    vocab_words = list(tokenizer.vocab.keys())
+
+    def build_instances():
+        instances = []
+        for _ in range(args.dupe_factor):
+            for document_index in range(len(documents)):
+                instances.extend(cpd.create_instances_from_document(
+                    documents, document_index, args.max_seq_length,
+                    args.short_seq_prob, args.masked_lm_prob,
+                    args.max_predictions_per_seq, vocab_words, rng))
+        rng.shuffle(instances)
+        return instances
+
+    try:
+        instances = recorder.run('instance_building', build_instances)
+    finally:
+        cpd.create_masked_lm_predictions = masking.fn
+    recorder.phases[-1]['seconds'] -= masking.seconds
+    recorder.phases.append({'phase': 'masking', 'seconds': masking.seconds,
+                            'calls': masking.calls})
+
+    def convert_features():
+        serialized = []
+        for instance in instances:
+            features = cpd.instance_to_features(
+                instance, tokenizer, args.max_seq_length,
+                args.max_predictions_per_seq)
+            tf_example = tf.train.Example(
+                features=tf.train.Features(feature=features))
+            serialized.append(tf_example.SerializeToString())
+        return serialized
+
+    serialized = recorder.run('feature_conversion', convert_features)
+
+    def write_records():
+        writer = tf.python_io.TFRecordWriter(output_file)
+        for record in serialized:
+            writer.write(record)
+        writer.close()
+
+    recorder.run('tfrecord_write', write_records)
+
+    num_tokens = sum(len(s) for d in documents for s in d)
+    counts = {
+        'lines': len(lines),
+        'documents': len(documents),
+        'tokens': num_tokens,
+        'instances': len(instances),
+        'output_bytes': os.path.getsize(output_file),
+    }
+    return recorder.phases, counts
+
+
+def run_end_to_end(input_file, output_file, model_file, vocab_file, args):
+    """Run create_pretraining_data.py as a separate process and time it."""
+    command = [
+        sys.executable, os.path.join(CURDIR, 'create_pretraining_data.py'),
+        '--input_file=%s' % input_file,
+        '--output_file=%s' % output_file,
+        '--model_file=%s' % model_file,
+        '--vocab_file=%s' % vocab_file,
+        '--max_seq_length=%d' % args.max_seq_length,
+        '--max_predictions_per_seq=%d' % args.max_predictions_per_seq,
+        '--random_seed=%d' % args.random_seed,
+        '--dupe_factor=%d' % args.dupe_factor,
+        '--masked_lm_prob=%s' % args.masked_lm_prob,
+        '--short_seq_prob=%s' % args.short_seq_prob,
+    ]
+    start = time.perf_counter()
+    subprocess.check_call(command, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+    return {'seconds': time.perf_counter() - start}
+
+
+def profile(fn, profiler, top):
+    """
+    Run `fn` under `profiler` ('cprofile' or 'pyinstrument') and return its
+    result together with a text report of the `top` hottest functions.
+    """
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        p = Profiler()
+        p.start()
+        try:
+            result = fn()
+        finally:
+            p.stop()
+        return result, p.output_text(unicode=True), None
+
+    p = cProfile.Profile()
+    result = p.runcall(fn)
+    stream = io.StringIO()
+    stats = pstats.Stats(p, stream=stream).sort_stats('tottime')
+    stats.print_stats(top)
+    hot = []
+    for (filename, lineno, funcname), stat in sorted(
+            stats.stats.items(), key=lambda x: x[1][2], reverse=True)[:top]:
+        calls, _, tottime, cumtime, _ = stat
+        hot.append({'function': '%s:%d(%s)' % (os.path.basename(filename),
+                                               lineno, funcname),
+                    'calls': calls, 'tottime': tottime, 'cumtime': cumtime})
+    return result, stream.getvalue(), hot
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--num_documents', type=int, default=1000,
+                        help='Number of documents in the generated corpus.')
+    parser.add_argument('--sentences_per_document', type=int, default=20)
+    parser.add_argument('--input_file', default=None,
+                        help='Use this corpus instead of a generated one.')
+    parser.add_argument('--model_file', default=None,
+                        help='SentencePiece model. Trained on the fly if omitted.')
+    parser.add_argument('--vocab_file', default=None)
+    parser.add_argument('--vocab_size', type=int, default=2000)
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--max_predictions_per_seq', type=int, default=20)
+    parser.add_argument('--dupe_factor', type=int, default=2)
+    parser.add_argument('--masked_lm_prob', type=float, default=0.15)
+    parser.add_argument('--short_seq_prob', type=float, default=0.1)
+    parser.add_argument('--random_seed', type=int, default=12345)
+    parser.add_argument('--end_to_end', action='store_true',
+                        help='Also time create_pretraining_data.py as a '
+                             'separate process.')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'],
+                        default=None, help='Profile the phased run.')
+    parser.add_argument('--profile_top', type=int, default=25,
+                        help='Number of hot functions to report.')
+    parser.add_argument('--profile_output', default=None,
+                        help='Where to write the text profile report.')
+    parser.add_argument('--output_file', default=None,
+                        help='Where to write the JSON report (default: stdout).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    import create_pretraining_data as cpd
+    import tokenization_sentencepiece as tokenization
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_file = args.input_file
+        if input_file is None:
+            sentences = benchmark_utils.generate_japanese_sentences(
+                args.num_documents * args.sentences_per_document,
+                seed=args.random_seed)
+            input_file = benchmark_utils.write_corpus(
+                sentences, os.path.join(tmpdir, 'corpus.txt'),
+                doc_size=args.sentences_per_document)
+
+        model_file, vocab_file = args.model_file, args.vocab_file
+        if model_file is None:
+            model_file, vocab_file = benchmark_utils.train_sentencepiece(
+                input_file, os.path.join(tmpdir, 'bench'), args.vocab_size)
+
+        tokenizer = tokenization.FullTokenizer(
+            model_file=model_file, vocab_file=vocab_file, do_lower_case=True)
+        output_file = os.path.join(tmpdir, 'bench.tfrecord')
+
+        run = lambda: run_phases(cpd, tokenizer, input_file, output_file, args)
+        hot_functions = None
+        if args.profiler:
+            (phases, counts), text, hot_functions = profile(
+                run, args.profiler, args.profile_top)
+            if args.profile_output:
+                with open(args.profile_output, 'w', encoding='utf-8') as f:
+                    f.write(text)
+            else:
+                sys.stderr.write(text)
+        else:
+            phases, counts = run()
+
+        results = {'phases': phases, 'counts': counts,
+                   'total_seconds': sum(p['seconds'] for p in phases)}
+        if hot_functions is not None:
+            results['hot_functions'] = hot_functions
+        if args.end_to_end:
+            results['end_to_end'] = run_end_to_end(
+                input_file, os.path.join(tmpdir, 'e2e.tfrecord'),
+                model_file, vocab_file, args)
+
+    params = {k: v for k, v in vars(args).items() if k != 'output_file'}
+    report = benchmark_utils.make_report('create_pretraining_data', results,
+                                         params)
+    benchmark_utils.write_report(report, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Numerical parity and speed check for the mixed-precision BertModel.
+
+Builds a float32 modeling_ext.BertModel and, sharing the same randomly
+initialized variables, one model per reduced precision (float16, bfloat16).
+Reports the largest absolute differences of the sequence and pooled outputs,
+the relative error of the gradients of a toy loss, and the time per batch of
+every precision. Runs on CPU; results are written as JSON.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+import benchmark_utils
+
+CURDIR = benchmark_utils.CURDIR
+
+sys.path.append(os.path.join(CURDIR, os.pardir, 'bert'))
+import modeling
+import modeling_ext
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--precisions', default='float16,bfloat16',
+                        help='Comma separated reduced precisions to compare '
+                             'against float32.')
+    parser.add_argument('--bert_config_file', default=None,
+                        help='Model config. A small model is used if omitted.')
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--num_hidden_layers', type=int, default=4)
+    parser.add_argument('--num_attention_heads', type=int, default=4)
+    parser.add_argument('--intermediate_size', type=int, default=1024)
+    parser.add_argument('--vocab_size', type=int, default=32000)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed forward passes per precision.')
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--output_file', default=None,
+                        help='Where to write the JSON report (default: stdout).')
+    return parser.parse_args()
+
+
+def load_config(args):
+    if args.bert_config_file:
+        return modeling.BertConfig.from_json_file(args.bert_config_file)
+    return modeling.BertConfig(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_hidden_layers,
+        num_attention_heads=args.num_attention_heads,
+        intermediate_size=args.intermediate_size,
+        max_position_embeddings=max(512, args.max_seq_length))
+
+
+def build_model(config, input_ids, input_mask, compute_type):
+    """Returns (sequence_output, pooled_output, gradients) of one model."""
+    with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+        model = modeling_ext.BertModel(
+            config=config,
+            is_training=False,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            scope='bert',
+            compute_type=compute_type)
+    pooled_output = model.get_pooled_output()
+    loss = tf.reduce_mean(tf.square(pooled_output))
+    grads = tf.gradients(loss, tf.trainable_variables())
+    grads = [tf.convert_to_tensor(g) for g in grads if g is not None]
+    return model.get_sequence_output(), pooled_output, grads
+
+
+def time_forward(sess, tensor, repeat):
+    # The first run includes graph optimization and is not timed.
+    sess.run(tensor)
+    _, seconds, _ = benchmark_utils.measure(
+        lambda: [sess.run(tensor) for _ in range(repeat)])
+    return seconds / repeat
+
+
+def relative_error(grads, reference):
+    diff = np.sqrt(sum(np.sum(np.square(g - r))
+                       for g, r in zip(grads, reference)))
+    norm = np.sqrt(sum(np.sum(np.square(r)) for r in reference))
+    return float(diff / norm) if norm else None
+
+
+def main():
+    args = parse_args()
+    config = load_config(args)
+    precisions = [p for p in args.precisions.split(',') if p]
+
+    rng = np.random.RandomState(args.seed)
+    input_ids = rng.randint(0, config.vocab_size,
+                            size=(args.batch_size, args.max_seq_length))
+    input_mask = np.ones_like(input_ids)
+    # Pad the second half of every other example to exercise the mask.
+    input_mask[1::2, args.max_seq_length // 2:] = 0
+
+    tf.set_random_seed(args.seed)
+    ids = tf.constant(input_ids, dtype=tf.int32)
+    mask = tf.constant(input_mask, dtype=tf.int32)
+    models = {'float32': build_model(config, ids, mask, tf.float32)}
+    for precision in precisions:
+        models[precision] = build_model(
+            config, ids, mask, modeling_ext.get_compute_type(precision))
+
+    results = []
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        reference = sess.run(models['float32'])
+        reference_seconds = time_forward(sess, models['float32'][0], args.repeat)
+        results.append({
+            'precision': 'float32',
+            'seconds_per_batch': reference_seconds,
+            'examples_per_sec': args.batch_size / reference_seconds,
+        })
+        for precision in precisions:
+            sequence_output, pooled_output, grads = sess.run(models[precision])
+            seconds = time_forward(sess, models[precision][0], args.repeat)
+            results.append({
+                'precision': precision,
+                'seconds_per_batch': seconds,
+                'examples_per_sec': args.batch_size / seconds,
+                'speedup': reference_seconds / seconds,
+                'sequence_output_max_abs_diff': float(
+                    np.max(np.abs(sequence_output - reference[0]))),
+                'pooled_output_max_abs_diff': float(
+                    np.max(np.abs(pooled_output - reference[1]))),
+                'gradient_relative_error': relative_error(grads, reference[2]),
+            })
+
+    params = {k: v for k, v in vars(args).items() if k != 'output_file'}
+    params['bert_config'] = config.to_dict()
+    report = benchmark_utils.make_report('precision', results, params)
+    benchmark_utils.write_report(report, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Startup time benchmark for the command line entry points.
+
+Runs `--help` of run_classifier.py, create_pretraining_data.py,
+extract_features.py, run_multitask_classifier.py and cached_encoder.py, and
+plain imports of run_classifier and the tokenizer, each in a fresh Python
+process, and reports the wall time and peak memory of the process and whether
+it imported TensorFlow. The time of `import tensorflow` alone is reported as
+the cost that lazily importing it saves. Compare reports of two revisions to
+see the gain.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import benchmark_utils
+
+CURDIR = benchmark_utils.CURDIR
+
+# Printed by every command so the benchmark sees which modules were loaded.
+PROBE = ('import json, resource, sys; print(json.dumps({'
+         '"tensorflow_imported": "tensorflow" in sys.modules, '
+         '"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))')
+
+COMMANDS = {
+    'run_classifier_help': ['run_classifier.py', '--help'],
+    'create_pretraining_data_help': ['create_pretraining_data.py', '--help'],
+    'extract_features_help': ['extract_features.py', '--help'],
+    'run_multitask_classifier_help': ['run_multitask_classifier.py', '--help'],
+    'cached_encoder_help': ['cached_encoder.py', '--help'],
+    'import_run_classifier': 'import run_classifier',
+    'import_tokenization': 'import tokenization_sentencepiece',
+    'import_tensorflow': 'import tensorflow',
+}
+
+
+def python_command(command):
+    """Returns the argv that runs `command` and then prints the probe."""
+    if isinstance(command, str):
+        code = command
+    else:
+        # Runs the script as __main__ and catches the SystemExit of --help.
+        script = os.path.join(CURDIR, command[0])
+        code = ('import runpy, sys; sys.argv = %r\n'
+                'try:\n'
+                '    runpy.run_path(%r, run_name="__main__")\n'
+                'except SystemExit:\n'
+                '    pass' % ([script] + command[1:], script))
+    return [sys.executable, '-c', code + '\n' + PROBE]
+
+
+def bench_command(name, command, repeat):
+    argv = python_command(command)
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL='3')
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(argv, cwd=CURDIR, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            return {'name': name, 'skipped':
+                    proc.stderr.decode('utf-8', 'replace').strip()
+                    .splitlines()[-1]}
+    probe = json.loads(proc.stdout.decode('utf-8').strip().splitlines()[-1])
+    return {
+        'name': name,
+        'runs': repeat,
+        'median_seconds': statistics.median(times),
+        'min_seconds': min(times),
+        'tensorflow_imported': probe['tensorflow_imported'],
+        'max_rss_bytes': probe['max_rss_kb'] * 1024,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of processes started per command.')
+    parser.add_argument('--commands', default=','.join(COMMANDS),
+                        help='Comma separated subset of: %s.' %
+                             ', '.join(COMMANDS))
+    parser.add_argument('--output_file', default=None,
+                        help='Where to write the JSON report (default: stdout).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    names = args.commands.split(',')
+    for name in names:
+        if name not in COMMANDS:
+            raise ValueError('Unknown command: %s' % name)
+    results = [bench_command(name, COMMANDS[name], args.repeat)
+               for name in names]
+    params = {k: v for k, v in vars(args).items() if k != 'output_file'}
+    report = benchmark_utils.make_report('startup', results, params)
+    benchmark_utils.write_report(report, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
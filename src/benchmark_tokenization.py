@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the tokenization hot path.
+
+Measures SentencePieceTokenizer.tokenize, FullTokenizer.convert_tokens_to_ids,
+load_vocab, the array-backed Vocab and run_classifier.convert_single_example
+on a synthetic Japanese-like corpus and, optionally, a sample corpus file. A small
+SentencePiece model is trained on the fly unless --model_file is given.
+Results are written as JSON so that runs can be compared across versions.
+"""
+
+import argparse
+import os
+import tempfile
+
+import benchmark_utils
+import tokenization_sentencepiece as tokenization
+
+BENCHMARKS = ['tokenize', 'convert_tokens_to_ids', 'load_vocab',
+              'load_vocab_table',
+              'convert_single_example']
+
+
+def _result(name, corpus, seconds, peak, num_sentences=None, num_tokens=None,
+            **extra):
+    result = {
+        'name': name,
+        'corpus': corpus,
+        'seconds': seconds,
+        'peak_traced_bytes': peak,
+    }
+    if num_sentences is not None:
+        result['sentences'] = num_sentences
+        result['sentences_per_sec'] = num_sentences / seconds if seconds else None
+    if num_tokens is not None:
+        result['tokens'] = num_tokens
+        result['tokens_per_sec'] = num_tokens / seconds if seconds else None
+    result.update(extra)
+    return result
+
+
+def bench_tokenize(tokenizer, corpus, sentences):
+    def run():
+        return [tokenizer.tokenizer.tokenize(s) for s in sentences]
+
+    tokens, seconds, peak = benchmark_utils.measure(run)
+    num_tokens = sum(len(t) for t in tokens)
+    return tokens, _result('tokenize', corpus, seconds, peak,
+                           num_sentences=len(sentences), num_tokens=num_tokens)
+
+
+def bench_convert_tokens_to_ids(tokenizer, corpus, tokenized):
+    def run():
+        return [tokenizer.convert_tokens_to_ids(t) for t in tokenized]
+
+    _, seconds, peak = benchmark_utils.measure(run)
+    num_tokens = sum(len(t) for t in tokenized)
+    return _result('convert_tokens_to_ids', corpus, seconds, peak,
+                   num_sentences=len(tokenized), num_tokens=num_tokens)
+
+
+def bench_load_vocab(vocab_file, repeat):
+    def run():
+        for _ in range(repeat):
+            vocab = tokenization.load_vocab(vocab_file)
+        return vocab
+
+    vocab, seconds, peak = benchmark_utils.measure(run)
+    return _result('load_vocab', os.path.basename(vocab_file), seconds, peak,
+                   loads=repeat, vocab_size=len(vocab),
+                   seconds_per_load=seconds / repeat)
+
+
+def bench_load_vocab_table(tokenizer, vocab_file, repeat):
+    """Times the array-backed Vocab from the model, the .vocab file and a
+    memory-mapped .npy table."""
+    table_file = os.path.join(tempfile.mkdtemp(), 'vocab.npy')
+    tokenization.Vocab.from_vocab_file(vocab_file).save(table_file)
+    processor = tokenizer.tokenizer.tokenizer
+    loaders = [
+        ('model', lambda: tokenization.Vocab.from_model(processor)),
+        (os.path.basename(vocab_file),
+         lambda: tokenization.Vocab.from_vocab_file(vocab_file)),
+        ('vocab.npy', lambda: tokenization.Vocab.load(table_file)),
+    ]
+    results = []
+    for source, load in loaders:
+        def run():
+            for _ in range(repeat):
+                vocab = load()
+            return vocab
+
+        vocab, seconds, peak = benchmark_utils.measure(run)
+        results.append(_result('load_vocab_table', source, seconds, peak,
+                               loads=repeat, vocab_size=len(vocab),
+                               seconds_per_load=seconds / repeat))
+    os.remove(table_file)
+    return results
+
+
+def bench_convert_single_example(tokenizer, corpus, sentences, max_seq_length):
+    # Importing run_classifier pulls in TensorFlow and the BERT modeling code.
+    import run_classifier
+
+    label_list = ['0', '1']
+    examples = [run_classifier.InputExample(guid='bench-%d' % i, text_a=s,
+                                            label=label_list[i % 2])
+                for i, s in enumerate(sentences)]
+
+    def run():
+        # Start the example index past the first five so the per-example
+        # debug logging in convert_single_example is not measured.
+        return [run_classifier.convert_single_example(
+                    5 + i, example, label_list, max_seq_length, tokenizer)
+                for i, example in enumerate(examples)]
+
+    features, seconds, peak = benchmark_utils.measure(run)
+    num_tokens = sum(sum(f.input_mask) for f in features)
+    return _result('convert_single_example', corpus, seconds, peak,
+                   num_sentences=len(sentences), num_tokens=num_tokens,
+                   max_seq_length=max_seq_length)
+
+
+def run_benchmarks(tokenizer, vocab_file, corpora, benchmarks, args):
+    results = []
+    if 'load_vocab' in benchmarks:
+        results.append(bench_load_vocab(vocab_file, args.vocab_repeat))
+    if 'load_vocab_table' in benchmarks:
+        results.extend(bench_load_vocab_table(tokenizer, vocab_file,
+                                              args.vocab_repeat))
+    for corpus, sentences in corpora:
+        tokenized, result = bench_tokenize(tokenizer, corpus, sentences)
+        if 'tokenize' in benchmarks:
+            results.append(result)
+        if 'convert_tokens_to_ids' in benchmarks:
+            results.append(
+                bench_convert_tokens_to_ids(tokenizer, corpus, tokenized))
+        if 'convert_single_example' in benchmarks:
+            try:
+                results.append(bench_convert_single_example(
+                    tokenizer, corpus, sentences, args.max_seq_length))
+            except ImportError as e:
+                results.append({'name': 'convert_single_example',
+                                'corpus': corpus, 'skipped': str(e)})
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--num_sentences', type=int, default=10000,
+                        help='Number of synthetic sentences to generate.')
+    parser.add_argument('--sample_file', default=None,
+                        help='Optional Japanese text file, one sentence per '
+                             'line, benchmarked alongside the synthetic corpus.')
+    parser.add_argument('--model_file', default=None,
+                        help='SentencePiece model. Trained on the fly if omitted.')
+    parser.add_argument('--vocab_file', default=None,
+                        help='SentencePiece vocab matching --model_file.')
+    parser.add_argument('--vocab_size', type=int, default=2000,
+                        help='Vocab size of the model trained on the fly.')
+    parser.add_argument('--vocab_repeat', type=int, default=10,
+                        help='Number of times load_vocab is repeated.')
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                        help='Comma separated subset of: %s.' % ', '.join(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--output_file', default=None,
+                        help='Where to write the JSON report (default: stdout).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    benchmarks = args.benchmarks.split(',')
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark: %s' % name)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        synthetic = benchmark_utils.generate_japanese_sentences(
+            args.num_sentences, seed=args.seed)
+        corpora = [('synthetic', synthetic)]
+        if args.sample_file:
+            corpora.append((os.path.basename(args.sample_file),
+                            benchmark_utils.read_sentences(args.sample_file)))
+        else:
+            corpora.append(('sample', benchmark_utils.SAMPLE_SENTENCES * 100))
+
+        model_file, vocab_file = args.model_file, args.vocab_file
+        if model_file is None:
+            corpus_file = benchmark_utils.write_corpus(
+                synthetic + benchmark_utils.SAMPLE_SENTENCES,
+                os.path.join(tmpdir, 'corpus.txt'))
+            model_file, vocab_file = benchmark_utils.train_sentencepiece(
+                corpus_file, os.path.join(tmpdir, 'bench'), args.vocab_size)
+
+        tokenizer = tokenization.FullTokenizer(
+            model_file=model_file, vocab_file=vocab_file, do_lower_case=True)
+        results = run_benchmarks(tokenizer, vocab_file, corpora, benchmarks, args)
+
+    params = {k: v for k, v in vars(args).items() if k != 'output_file'}
+    report = benchmark_utils.make_report('tokenization', results, params)
+    benchmark_utils.write_report(report, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
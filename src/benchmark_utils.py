@@ -0,0 +1,163 @@
+"""Helpers shared by the benchmark scripts."""
+
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import sentencepiece as sp
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+
+HIRAGANA = [chr(c) for c in range(ord('ぁ'), ord('ゖ') + 1)]
+KATAKANA = [chr(c) for c in range(ord('ァ'), ord('ヺ') + 1)]
+KANJI = list('日本語学校東京大阪京都時間人生年月会社電車駅道山川海空雨雪花'
+             '春夏秋冬朝昼夜今昔新古高低長短大小中上下左右前後内外出入'
+             '食飲見聞読書話言思知行来帰住働休遊買売作使開閉始終教習')
+PARTICLES = ['は', 'が', 'を', 'に', 'で', 'と', 'の', 'も', 'へ', 'から', 'まで']
+ENDINGS = ['です。', 'ます。', 'でした。', 'ました。', 'だ。', 'である。']
+
+SAMPLE_SENTENCES = [
+    '吾輩は猫である。',
+    '名前はまだ無い。',
+    'どこで生れたかとんと見当がつかぬ。',
+    '何でも薄暗いじめじめした所でニャーニャー泣いていた事だけは記憶している。',
+    '国境の長いトンネルを抜けると雪国であった。',
+    '夜の底が白くなった。',
+    '信号所に汽車が止まった。',
+    '東京都は日本の首都であり、世界有数の大都市である。',
+    '京都の祇園祭は毎年七月に行われる伝統的な祭りです。',
+    '花火大会には多くの観光客が訪れました。',
+]
+
+
+def _random_word(rng):
+    kind = rng.random()
+    if kind < 0.4:
+        chars, length = KANJI, rng.randint(1, 3)
+    elif kind < 0.8:
+        chars, length = HIRAGANA, rng.randint(1, 4)
+    else:
+        chars, length = KATAKANA, rng.randint(2, 6)
+    return ''.join(rng.choice(chars) for _ in range(length))
+
+
+def generate_japanese_sentences(num_sentences, seed=12345,
+                                min_words=4, max_words=20):
+    """
+    Generate Japanese-like sentences made of random kanji, hiragana and
+    katakana words joined by particles.
+    """
+    rng = random.Random(seed)
+    sentences = []
+    for _ in range(num_sentences):
+        words = []
+        for _ in range(rng.randint(min_words, max_words)):
+            words.append(_random_word(rng))
+            if rng.random() < 0.5:
+                words.append(rng.choice(PARTICLES))
+        sentences.append(''.join(words) + rng.choice(ENDINGS))
+    return sentences
+
+
+def read_sentences(input_file, max_sentences=None):
+    """Read non-empty lines of a text file (one sentence per line)."""
+    sentences = []
+    with open(input_file, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            sentences.append(line)
+            if max_sentences and len(sentences) >= max_sentences:
+                break
+    return sentences
+
+
+def write_corpus(sentences, output_file, doc_size=0):
+    """
+    Write one sentence per line. When `doc_size` is positive a blank line is
+    inserted every `doc_size` sentences, which is the document delimiter
+    expected by create_pretraining_data.py.
+    """
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for i, sentence in enumerate(sentences):
+            if doc_size and i and i % doc_size == 0:
+                f.write('\n')
+            f.write(sentence + '\n')
+    return output_file
+
+
+def train_sentencepiece(input_file, prefix, vocab_size=2000,
+                        ctl_symbols='[PAD],[CLS],[SEP],[MASK]'):
+    """
+    Train a small SentencePiece model the same way as train-sentencepiece.py.
+    Returns paths of the trained model and vocab files.
+    """
+    command = (f'--input={input_file} --model_prefix={prefix} '
+               f'--vocab_size={vocab_size} --control_symbols={ctl_symbols} '
+               f'--hard_vocab_limit=false --minloglevel=2')
+    sp.SentencePieceTrainer.Train(command)
+    return prefix + '.model', prefix + '.vocab'
+
+
+def measure(fn, *args, **kwargs):
+    """
+    Run `fn` once and return (result, elapsed seconds, peak bytes allocated
+    by Python objects during the call).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def max_rss_bytes():
+    """Peak resident set size of the current process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=CURDIR,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_report(benchmark, results, params):
+    """Wrap benchmark results with the environment they were measured in."""
+    return {
+        'benchmark': benchmark,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+        'max_rss_bytes': max_rss_bytes(),
+    }
+
+
+def write_report(report, output_file=None):
+    """Write a report as JSON to `output_file`, or stdout if it is None."""
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,441 @@
+# coding=utf-8
+"""Classifier fine-tuning on cached encoder outputs.
+
+When the encoder is frozen, every epoch computes the same encoder outputs
+again. This script computes them once with the `init_checkpoint` model,
+caches them in `cache_dir` as .npy arrays and then trains only the classifier
+(and with `cache_mode=hidden_states` the top encoder layers and the pooler)
+on the cached arrays. `cache_mode` selects what is cached:
+
+  pooled         The pooled output, [num_examples, hidden_size].
+  cls_layers     The [CLS] vectors of the last `num_cached_cls_layers` layers,
+                 concatenated, [num_examples, k * hidden_size].
+  hidden_states  The output of the layer below the top `num_trained_layers`
+                 layers, [num_examples, max_seq_length, hidden_size], and the
+                 input mask. The top layers and the pooler are trained too,
+                 starting from `init_checkpoint`.
+
+The data, model and training flags are those of run_classifier.py:
+
+  python3 src/cached_encoder.py --task_name=livedoor --data_dir=data/livedoor \
+    --model_file=model/wiki-ja.model --vocab_file=model/wiki-ja.vocab \
+    --init_checkpoint=model/model.ckpt-1400000 --output_dir=/tmp/livedoor \
+    --do_train=True --do_eval=True --cache_mode=pooled --num_train_epochs=50
+
+A cache is rebuilt when one of the settings it was built with changes,
+including the size or modification time of the data files of its split and
+of `init_checkpoint`, the tokenizer and the model config.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import json
+import os
+import numpy as np
+import run_classifier
+import tokenization_sentencepiece as tokenization
+import utils
+from absl import app
+from absl import flags
+
+# TensorFlow and the model code are imported when first used, so `--help` and
+# flag errors do not import them. run_classifier adds the BERT submodule to
+# the module path.
+tf = utils.LazyModule("tensorflow")
+checkpoint_cache = utils.LazyModule("checkpoint_cache")
+modeling = utils.LazyModule("modeling")
+modeling_ext = utils.LazyModule("modeling_ext")
+optimization_ext = utils.LazyModule("optimization_ext")
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum(
+    "cache_mode", "pooled", ["pooled", "cls_layers", "hidden_states"],
+    "Which encoder outputs are cached, see the module docstring.")
+
+flags.DEFINE_integer(
+    "num_cached_cls_layers", 4,
+    "Number of top layers whose [CLS] vectors are cached with "
+    "`cache_mode=cls_layers`.")
+
+flags.DEFINE_integer(
+    "num_trained_layers", 1,
+    "Number of top transformer layers trained with `cache_mode=hidden_states`.")
+
+flags.DEFINE_string(
+    "cache_dir", None,
+    "Directory of the cached encoder outputs. Defaults to "
+    "`output_dir`/encoder_cache.")
+
+flags.DEFINE_enum("cache_dtype", "float16", ["float32", "float16"],
+                  "Storage type of the cached encoder outputs.")
+
+
+def _data_fingerprint(split):
+  """Returns the sizes and modification times of the files of `split`."""
+  fingerprint = {}
+  for path in sorted(tf.gfile.Glob(os.path.join(FLAGS.data_dir, split + ".*"))):
+    stat = tf.gfile.Stat(path)
+    fingerprint[os.path.basename(path)] = [stat.length, stat.mtime_nsec]
+  return fingerprint
+
+
+def get_cache_settings(bert_config, split, num_examples):
+  """Returns the settings a cache of `split` depends on."""
+  # pylint: disable=protected-access
+  checkpoint_fingerprint = checkpoint_cache._checkpoint_fingerprint(
+      FLAGS.init_checkpoint)
+  # pylint: enable=protected-access
+  settings = {
+      "split": split,
+      "num_examples": num_examples,
+      "task_name": FLAGS.task_name,
+      "data_dir": os.path.abspath(FLAGS.data_dir),
+      "data_files": _data_fingerprint(split),
+      "init_checkpoint": checkpoint_fingerprint,
+      "bert_config_name": FLAGS.bert_config_name,
+      "bert_config": bert_config.to_dict(),
+      "model_file": FLAGS.model_file,
+      "vocab_file": FLAGS.vocab_file,
+      "do_lower_case": FLAGS.do_lower_case,
+      "max_seq_length": FLAGS.max_seq_length,
+      "precision": FLAGS.precision,
+      "cache_mode": FLAGS.cache_mode,
+      "cache_dtype": FLAGS.cache_dtype,
+  }
+  if FLAGS.cache_mode == "cls_layers":
+    settings["num_cached_cls_layers"] = FLAGS.num_cached_cls_layers
+  elif FLAGS.cache_mode == "hidden_states":
+    settings["num_trained_layers"] = FLAGS.num_trained_layers
+  return settings
+
+
+def get_encoder_output(model, bert_config):
+  """Returns the tensor of `model` that is cached for `cache_mode`."""
+  if FLAGS.cache_mode == "pooled":
+    return model.get_pooled_output()
+  all_layers = model.get_all_encoder_layers()
+  if FLAGS.cache_mode == "cls_layers":
+    return tf.concat(
+        [layer[:, 0, :] for layer in all_layers[-FLAGS.num_cached_cls_layers:]],
+        axis=-1)
+  return all_layers[bert_config.num_hidden_layers - FLAGS.num_trained_layers -
+                    1]
+
+
+def build_cache(bert_config, examples, label_list, tokenizer, split,
+                cache_dir):
+  """Runs the frozen encoder over `examples` and writes the arrays."""
+  record_file = os.path.join(FLAGS.output_dir, "%s.tf_record" % split)
+  run_classifier.file_based_convert_examples_to_features(
+      examples, label_list, FLAGS.max_seq_length, tokenizer, record_file)
+  input_fn = run_classifier.file_based_input_fn_builder(
+      input_file=record_file,
+      seq_length=FLAGS.max_seq_length,
+      is_training=False,
+      drop_remainder=False)
+
+  dtypes = {
+      "encoder_output": np.dtype(FLAGS.cache_dtype),
+      "input_mask": np.int8,
+      "label_ids": np.int32,
+  }
+  with tf.Graph().as_default():
+    features = input_fn({"batch_size": FLAGS.eval_batch_size
+                        }).make_one_shot_iterator().get_next()
+    model = modeling_ext.BertModel(
+        config=bert_config,
+        is_training=False,
+        input_ids=features["input_ids"],
+        input_mask=features["input_mask"],
+        token_type_ids=features["segment_ids"],
+        compute_type=modeling_ext.get_compute_type(FLAGS.precision))
+    fetches = {
+        "encoder_output": get_encoder_output(model, bert_config),
+        "label_ids": features["label_ids"],
+    }
+    if FLAGS.cache_mode == "hidden_states":
+      fetches["input_mask"] = features["input_mask"]
+
+    (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+        tf.trainable_variables(), FLAGS.init_checkpoint)
+    tf.train.init_from_checkpoint(FLAGS.init_checkpoint, assignment_map)
+
+    arrays = {}
+    offset = 0
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      while True:
+        try:
+          batch = sess.run(fetches)
+        except tf.errors.OutOfRangeError:
+          break
+        if not arrays:
+          for (name, value) in batch.items():
+            arrays[name] = np.lib.format.open_memmap(
+                os.path.join(cache_dir, "%s.%s.npy.tmp" % (split, name)),
+                mode="w+", dtype=dtypes[name],
+                shape=(len(examples),) + value.shape[1:])
+        size = len(batch["label_ids"])
+        for (name, value) in batch.items():
+          arrays[name][offset:offset + size] = value
+        offset += size
+        tf.logging.info("Encoded %d of %d %s examples", offset, len(examples),
+                        split)
+
+  for (name, array) in arrays.items():
+    array.flush()
+    path = os.path.join(cache_dir, "%s.%s.npy" % (split, name))
+    os.rename(path + ".tmp", path)
+
+
+def load_cache(bert_config, examples, label_list, tokenizer, split):
+  """Returns the dict of cached arrays of `split`, building it if needed."""
+  cache_dir = FLAGS.cache_dir or os.path.join(FLAGS.output_dir, "encoder_cache")
+  tf.gfile.MakeDirs(cache_dir)
+  settings_file = os.path.join(cache_dir, "%s.json" % split)
+  settings = get_cache_settings(bert_config, split, len(examples))
+
+  cached_settings = None
+  if os.path.exists(settings_file):
+    with open(settings_file) as reader:
+      cached_settings = json.load(reader)
+  if cached_settings != settings:
+    tf.logging.info("Building the %s cache in %s", split, cache_dir)
+    build_cache(bert_config, examples, label_list, tokenizer, split, cache_dir)
+    with open(settings_file, "w") as writer:
+      json.dump(settings, writer, indent=2, sort_keys=True)
+
+  names = ["encoder_output", "label_ids"]
+  if FLAGS.cache_mode == "hidden_states":
+    names.append("input_mask")
+  return {
+      name: np.load(os.path.join(cache_dir, "%s.%s.npy" % (split, name)),
+                    mmap_mode="r") for name in names
+  }
+
+
+def input_fn_builder(arrays, batch_size, is_training):
+  """Creates an `input_fn` that reads batches of cached arrays."""
+  names = sorted(arrays)
+  num_examples = len(arrays["label_ids"])
+
+  def gather(indices):
+    return [np.asarray(arrays[name][indices]) for name in names]
+
+  def input_fn():
+    """The actual input function."""
+    d = tf.data.Dataset.range(num_examples)
+    if is_training:
+      d = d.repeat()
+      d = d.shuffle(buffer_size=num_examples)
+    d = d.batch(batch_size)
+
+    def read_batch(indices):
+      values = tf.py_func(gather, [indices],
+                          [tf.as_dtype(arrays[name].dtype) for name in names])
+      features = {}
+      for (name, value) in zip(names, values):
+        value.set_shape([None] + list(arrays[name].shape[1:]))
+        features[name] = tf.to_int32(value) if value.dtype.is_integer else value
+      return features
+
+    return d.map(read_batch, num_parallel_calls=2).prefetch(1)
+
+  return input_fn
+
+
+def create_top_layers(bert_config, hidden_states, input_mask, is_training,
+                      num_trained_layers):
+  """Applies the top encoder layers and the pooler to cached hidden states.
+
+  Variable names are those of `modeling.BertModel`, so the layers start from
+  `init_checkpoint`.
+  """
+  config = copy.deepcopy(bert_config)
+  if not is_training:
+    config.hidden_dropout_prob = 0.0
+    config.attention_probs_dropout_prob = 0.0
+
+  input_shape = modeling.get_shape_list(hidden_states, expected_rank=3)
+  attention_mask = modeling.create_attention_mask_from_input_mask(
+      hidden_states, input_mask)
+  with tf.variable_scope("bert"):
+    with tf.variable_scope("encoder"):
+      layer_output = modeling.reshape_to_matrix(hidden_states)
+      for layer_idx in range(config.num_hidden_layers - num_trained_layers,
+                             config.num_hidden_layers):
+        with tf.variable_scope("layer_%d" % layer_idx):
+          layer_output = modeling_ext.transformer_layer(
+              layer_output,
+              attention_mask=attention_mask,
+              hidden_size=config.hidden_size,
+              num_attention_heads=config.num_attention_heads,
+              intermediate_size=config.intermediate_size,
+              intermediate_act_fn=modeling.get_activation(config.hidden_act),
+              hidden_dropout_prob=config.hidden_dropout_prob,
+              attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+              initializer_range=config.initializer_range,
+              batch_size=input_shape[0],
+              seq_length=input_shape[1])
+      sequence_output = modeling.reshape_from_matrix(layer_output, input_shape)
+    with tf.variable_scope("pooler"):
+      first_token_tensor = tf.squeeze(sequence_output[:, 0:1, :], axis=1)
+      return tf.layers.dense(
+          first_token_tensor,
+          config.hidden_size,
+          activation=tf.tanh,
+          kernel_initializer=modeling.create_initializer(
+              config.initializer_range))
+
+
+def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
+                     num_train_steps, num_warmup_steps, cache_mode,
+                     num_trained_layers):
+  """Returns `model_fn` closure for Estimator."""
+
+  def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+    """The `model_fn` for Estimator."""
+    is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+    label_ids = features["label_ids"]
+    output_layer = tf.cast(features["encoder_output"], tf.float32)
+    if cache_mode == "hidden_states":
+      output_layer = create_top_layers(bert_config, output_layer,
+                                       features["input_mask"], is_training,
+                                       num_trained_layers)
+      (assignment_map, _) = modeling.get_assignment_map_from_checkpoint(
+          tf.trainable_variables(), init_checkpoint)
+      tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+
+    (total_loss, per_example_loss, logits, probabilities
+    ) = run_classifier.create_classifier_output(output_layer, is_training,
+                                                label_ids, num_labels)
+
+    if mode == tf.estimator.ModeKeys.TRAIN:
+      train_op = optimization_ext.create_optimizer(
+          total_loss, learning_rate, num_train_steps, num_warmup_steps,
+          use_tpu=False)
+      return tf.estimator.EstimatorSpec(
+          mode=mode, loss=total_loss, train_op=train_op)
+    elif mode == tf.estimator.ModeKeys.EVAL:
+      predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
+      eval_metric_ops = {
+          "eval_accuracy": tf.metrics.accuracy(
+              labels=label_ids, predictions=predictions),
+          "eval_loss": tf.metrics.mean(values=per_example_loss),
+      }
+      return tf.estimator.EstimatorSpec(
+          mode=mode, loss=total_loss, eval_metric_ops=eval_metric_ops)
+    return tf.estimator.EstimatorSpec(
+        mode=mode, predictions={"probabilities": probabilities})
+
+  return model_fn
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  if not FLAGS.do_train and not FLAGS.do_eval and not FLAGS.do_predict:
+    raise ValueError(
+        "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
+  if not FLAGS.init_checkpoint:
+    raise ValueError("The frozen encoder needs an `init_checkpoint`.")
+
+  bert_config = modeling.BertConfig.from_dict(
+      utils.read_bert_config(run_classifier.CONFIGPATH, FLAGS.bert_config_name))
+  if FLAGS.cache_mode == "cls_layers" and not (
+      1 <= FLAGS.num_cached_cls_layers <= bert_config.num_hidden_layers):
+    raise ValueError("`num_cached_cls_layers` must be between 1 and %d." %
+                     bert_config.num_hidden_layers)
+  if FLAGS.cache_mode == "hidden_states" and not (
+      1 <= FLAGS.num_trained_layers < bert_config.num_hidden_layers):
+    raise ValueError("`num_trained_layers` must be between 1 and %d." %
+                     (bert_config.num_hidden_layers - 1))
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+
+  task_name = FLAGS.task_name.lower()
+  if task_name not in run_classifier.PROCESSORS:
+    raise ValueError("Task not found: %s" % (task_name))
+  processor = run_classifier.PROCESSORS[task_name]()
+  label_list = processor.get_labels()
+
+  tokenizer = tokenization.FullTokenizer(
+      model_file=FLAGS.model_file, vocab_file=FLAGS.vocab_file,
+      do_lower_case=FLAGS.do_lower_case)
+
+  def get_arrays(examples, split):
+    return load_cache(bert_config, examples, label_list, tokenizer, split)
+
+  num_train_steps = None
+  num_warmup_steps = None
+  if FLAGS.do_train:
+    train_arrays = get_arrays(processor.get_train_examples(FLAGS.data_dir),
+                              "train")
+    num_train_steps = int(
+        len(train_arrays["label_ids"]) / FLAGS.train_batch_size *
+        FLAGS.num_train_epochs)
+    num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
+
+  model_fn = model_fn_builder(
+      bert_config=bert_config,
+      num_labels=len(label_list),
+      init_checkpoint=FLAGS.init_checkpoint,
+      learning_rate=FLAGS.learning_rate,
+      num_train_steps=num_train_steps,
+      num_warmup_steps=num_warmup_steps,
+      cache_mode=FLAGS.cache_mode,
+      num_trained_layers=FLAGS.num_trained_layers)
+  estimator = tf.estimator.Estimator(
+      model_fn=model_fn,
+      config=tf.estimator.RunConfig(
+          model_dir=FLAGS.output_dir,
+          save_checkpoints_steps=FLAGS.save_checkpoints_steps))
+
+  if FLAGS.do_train:
+    tf.logging.info("***** Running training on cached %s *****",
+                    FLAGS.cache_mode)
+    tf.logging.info("  Num examples = %d", len(train_arrays["label_ids"]))
+    tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
+    tf.logging.info("  Num steps = %d", num_train_steps)
+    estimator.train(
+        input_fn=input_fn_builder(train_arrays, FLAGS.train_batch_size,
+                                  is_training=True),
+        max_steps=num_train_steps)
+
+  if FLAGS.do_eval:
+    eval_arrays = get_arrays(processor.get_dev_examples(FLAGS.data_dir), "dev")
+    result = estimator.evaluate(input_fn=input_fn_builder(
+        eval_arrays, FLAGS.eval_batch_size, is_training=False))
+
+    output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
+    with tf.gfile.GFile(output_eval_file, "w") as writer:
+      tf.logging.info("***** Eval results *****")
+      for key in sorted(result.keys()):
+        tf.logging.info("  %s = %s", key, str(result[key]))
+        writer.write("%s = %s\n" % (key, str(result[key])))
+
+  if FLAGS.do_predict:
+    predict_arrays = get_arrays(processor.get_test_examples(FLAGS.data_dir),
+                                "test")
+    result = estimator.predict(input_fn=input_fn_builder(
+        predict_arrays, FLAGS.predict_batch_size, is_training=False))
+
+    output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
+    with tf.gfile.GFile(output_predict_file, "w") as writer:
+      tf.logging.info("***** Predict results *****")
+      for prediction in result:
+        writer.write("\t".join(
+            str(class_probability)
+            for class_probability in prediction["probabilities"]) + "\n")
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("data_dir")
+  flags.mark_flag_as_required("task_name")
+  flags.mark_flag_as_required("model_file")
+  flags.mark_flag_as_required("output_dir")
+  app.run(main)
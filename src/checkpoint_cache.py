@@ -0,0 +1,224 @@
+# coding=utf-8
+"""Local warm-start cache of a pre-trained checkpoint.
+
+Initializing from `init_checkpoint` lists and reads the checkpoint through
+`tf.train.init_from_checkpoint` on every run, which is slow when the
+checkpoint lives on network-mounted storage. The cache consolidates the model
+weights of a checkpoint (without optimizer slots) into one local file, stored
+as float32 or float16, with a JSON index of the names, shapes and offsets of
+the variables. Later runs memory-map that file, match its names against the
+trainable variables and load the values in the `init_fn` of the Scaffold,
+without touching the original checkpoint again.
+
+The cache is rebuilt when the checkpoint changes (its size or modification
+time). It can also be built ahead of time:
+
+  python3 src/checkpoint_cache.py --init_checkpoint=model/model.ckpt-1400000 \
+    --cache_dir=/tmp/bert-cache --dtype=float16
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import re
+import numpy as np
+import tensorflow as tf
+
+# Optimizer slots and bookkeeping variables are not needed for warm starts.
+EXCLUDED_VARIABLES = re.compile(r"(/adam_[mv]$|^global_step$)")
+
+# Offsets of the variables in the weights file are aligned to this many bytes.
+ALIGNMENT = 64
+
+
+def get_cache_paths(init_checkpoint, cache_dir, dtype):
+  """Returns the paths of the weights file and the index of a cache."""
+  prefix = os.path.join(cache_dir,
+                        "%s.%s" % (os.path.basename(init_checkpoint), dtype))
+  return (prefix + ".weights", prefix + ".json")
+
+
+def _checkpoint_fingerprint(init_checkpoint):
+  stat = tf.gfile.Stat(init_checkpoint + ".index")
+  return {
+      "checkpoint": init_checkpoint,
+      "index_length": stat.length,
+      "index_mtime_nsec": stat.mtime_nsec,
+  }
+
+
+def build_cache(init_checkpoint, cache_dir, dtype="float32"):
+  """Writes the weights file and index of `init_checkpoint` to `cache_dir`.
+
+  Args:
+    init_checkpoint: Checkpoint prefix, e.g. "model/model.ckpt-1400000".
+    cache_dir: Local directory of the cache.
+    dtype: "float32" or "float16". Floating point variables are stored in this
+      type; float16 halves the size of the cache.
+
+  Returns:
+    The index dict.
+  """
+  if dtype not in ("float32", "float16"):
+    raise ValueError("Unsupported cache dtype: %s" % dtype)
+  (weights_file, index_file) = get_cache_paths(init_checkpoint, cache_dir,
+                                               dtype)
+  tf.gfile.MakeDirs(cache_dir)
+
+  reader = tf.train.load_checkpoint(init_checkpoint)
+  variables = {}
+  offset = 0
+  # Write to temporary files first so that concurrent runs never see a
+  # partially written cache.
+  with open(weights_file + ".tmp", "wb") as writer:
+    for name in sorted(reader.get_variable_to_shape_map()):
+      if EXCLUDED_VARIABLES.search(name):
+        continue
+      value = reader.get_tensor(name)
+      if value.dtype.kind == "f":
+        value = value.astype(dtype)
+      padding = -offset % ALIGNMENT
+      writer.write(b"\0" * padding)
+      offset += padding
+      writer.write(np.ascontiguousarray(value).tobytes())
+      variables[name] = {
+          "offset": offset,
+          "shape": list(value.shape),
+          "dtype": value.dtype.name,
+      }
+      offset += value.nbytes
+
+  index = {"source": _checkpoint_fingerprint(init_checkpoint),
+           "variables": variables}
+  with open(index_file + ".tmp", "w") as writer:
+    json.dump(index, writer, indent=2, sort_keys=True)
+  os.rename(weights_file + ".tmp", weights_file)
+  os.rename(index_file + ".tmp", index_file)
+  tf.logging.info("Cached %d variables of %s in %s (%d bytes)",
+                  len(variables), init_checkpoint, weights_file, offset)
+  return index
+
+
+def load_cache(init_checkpoint, cache_dir, dtype="float32"):
+  """Returns (index, weights memmap) of a cache, building it if needed."""
+  (weights_file, index_file) = get_cache_paths(init_checkpoint, cache_dir,
+                                               dtype)
+  index = None
+  if os.path.exists(index_file) and os.path.exists(weights_file):
+    with open(index_file) as reader:
+      index = json.load(reader)
+    if index["source"] != _checkpoint_fingerprint(init_checkpoint):
+      tf.logging.info("%s changed, rebuilding the cache", init_checkpoint)
+      index = None
+  if index is None:
+    index = build_cache(init_checkpoint, cache_dir, dtype)
+  weights = np.memmap(weights_file, dtype=np.uint8, mode="r")
+  return (index, weights)
+
+
+def _get_value(weights, entry):
+  dtype = np.dtype(entry["dtype"])
+  count = int(np.prod(entry["shape"]))
+  start = entry["offset"]
+  return weights[start:start + count * dtype.itemsize].view(dtype).reshape(
+      entry["shape"])
+
+
+def get_assignment_map_from_cache(tvars, index):
+  """Matches trainable variables with cached checkpoint variables by name.
+
+  Same result as `modeling.get_assignment_map_from_checkpoint`, computed from
+  the local index.
+
+  Returns:
+    (list of (variable, cached name) pairs, dict of initialized variable
+    names as in `modeling.get_assignment_map_from_checkpoint`).
+  """
+  assignments = []
+  initialized_variable_names = {}
+  for var in tvars:
+    name = re.sub(r":\d+$", "", var.name)
+    entry = index["variables"].get(name)
+    if entry is None or entry["shape"] != var.shape.as_list():
+      continue
+    assignments.append((var, name))
+    initialized_variable_names[name] = 1
+    initialized_variable_names[name + ":0"] = 1
+  return (assignments, initialized_variable_names)
+
+
+def warm_start_scaffold_fn(tvars, init_checkpoint, cache_dir, dtype="float32"):
+  """Warm-starts `tvars` from the cache of `init_checkpoint`.
+
+  Use in a model_fn in place of `modeling.get_assignment_map_from_checkpoint`
+  and `tf.train.init_from_checkpoint`.
+
+  Returns:
+    (scaffold_fn for `TPUEstimatorSpec`, initialized variable names). The
+    values are loaded by the `init_fn` of the Scaffold, i.e. only when the
+    model does not restore a checkpoint of its own model directory.
+  """
+  (index, weights) = load_cache(init_checkpoint, cache_dir, dtype)
+  (assignments, initialized_variable_names) = get_assignment_map_from_cache(
+      tvars, index)
+
+  def init_fn(scaffold, session):  # pylint: disable=unused-argument
+    for (var, name) in assignments:
+      value = _get_value(weights, index["variables"][name])
+      # `load` feeds the value to the existing initializer op, so it works
+      # on the finalized graph.
+      var.load(value.astype(var.dtype.base_dtype.as_numpy_dtype), session)
+    tf.logging.info("Initialized %d variables from %s", len(assignments),
+                    get_cache_paths(init_checkpoint, cache_dir, dtype)[0])
+
+  def scaffold_fn():
+    return tf.train.Scaffold(init_fn=init_fn)
+
+  return (scaffold_fn, initialized_variable_names)
+
+
+def log_trainable_variables(tvars, initialized_variable_names,
+                            frozen_variables=(), summary_only=False):
+  """Logs the trainable variables and how they are initialized.
+
+  With `summary_only`, as for warm starts from the cache, only the numbers of
+  initialized and frozen variables are logged at INFO level, and the line per
+  variable at DEBUG level.
+  """
+  log_variable = tf.logging.debug if summary_only else tf.logging.info
+  log_variable("**** Trainable Variables ****")
+  num_initialized = 0
+  num_frozen = 0
+  for var in tvars:
+    init_string = ""
+    if var.name in initialized_variable_names:
+      init_string = ", *INIT_FROM_CKPT*"
+      num_initialized += 1
+    if var in frozen_variables:
+      init_string += ", *FROZEN*"
+      num_frozen += 1
+    log_variable("  name = %s, shape = %s%s", var.name, var.shape, init_string)
+  if summary_only:
+    tf.logging.info(
+        "%d trainable variables, %d initialized from the checkpoint, %d "
+        "frozen", len(tvars), num_initialized, num_frozen)
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  build_cache(FLAGS.init_checkpoint, FLAGS.cache_dir, FLAGS.dtype)
+
+
+if __name__ == "__main__":
+  flags = tf.flags
+  FLAGS = flags.FLAGS
+  flags.DEFINE_string("init_checkpoint", None, "Checkpoint to cache.")
+  flags.DEFINE_string("cache_dir", None, "Local directory of the cache.")
+  flags.DEFINE_enum("dtype", "float32", ["float32", "float16"],
+                    "Storage type of floating point variables.")
+  flags.mark_flag_as_required("init_checkpoint")
+  flags.mark_flag_as_required("cache_dir")
+  tf.app.run()
@@ -1,17 +1,236 @@
 # -*- coding: utf-8 -*-
-import os
-import glob
+"""Merges all CSV files of a folder into one file.
+
+The files are parsed in parallel processes with a fixed schema and written
+to the output one after another, so only a few files are in memory at a
+time. The schema is the union of the columns of all files (in the order of
+their first appearance, all read as strings) unless `--schema_file` gives
+the columns and their dtypes as a JSON object, e.g. {"id": "str",
+"price": "float64"}. Columns that a file does not have are left empty, and
+`bool` and `int64` columns are then filled as `boolean` and `Int64`. With
+`--dedup_columns`, rows whose key was already written are dropped; only
+64-bit hashes of the keys are kept in memory.
+
+    python3 src/combine_csv.py --input_dir=./csv/ --output_file=rurubu.csv
+    python3 src/combine_csv.py --output_file=rurubu.parquet --dedup_columns=id
+"""
+
+import argparse
+import collections
 import csv
+import glob
+import json
+import multiprocessing
+import os
+
 import pandas as pd
 
 # フォルダ中のパスを取得
 DATA_PATH = "./csv/"
-All_Files = glob.glob('{}*.csv'.format(DATA_PATH))
+OUTPUT_FILE = "rurubu.csv"
+
+FORMATS = ('csv', 'parquet', 'feather')
+
+# Dtypes of the columns that a file does not have; unlike `bool` and `int64`,
+# they can hold missing values.
+NULLABLE_DTYPES = {
+    'bool': 'boolean',
+    'int64': 'Int64',
+}
+
+
+def read_header(path, encoding='utf_8'):
+    with open(path, encoding=encoding, newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def infer_schema(paths, encoding='utf_8'):
+    """Returns the union of the columns of `paths`, all typed as str."""
+    schema = collections.OrderedDict()
+    for path in paths:
+        for column in read_header(path, encoding=encoding):
+            schema.setdefault(column, 'str')
+    return schema
+
+
+def read_file(args):
+    """Reads one CSV file with the columns and dtypes of `schema`."""
+    (path, schema, encoding) = args
+    columns = list(schema)
+    df = pd.read_csv(path, dtype=dict(schema), encoding=encoding,
+                     usecols=lambda column: column in schema)
+    missing = [column for column in columns if column not in df.columns]
+    df = df.reindex(columns=columns)
+    for column in missing:
+        if schema[column] not in ('str', 'object'):
+            dtype = NULLABLE_DTYPES.get(schema[column], schema[column])
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def iter_files(paths, schema, encoding='utf_8', num_workers=1):
+    """Yields the DataFrames of `paths` in order.
+
+    At most 2 * `num_workers` files are read ahead, so memory is bounded by
+    a few files however many files there are.
+    """
+    tasks = ((path, schema, encoding) for path in paths)
+    if num_workers <= 1:
+        for task in tasks:
+            yield read_file(task)
+        return
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(read_file, (task,)))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+class Deduplicator(object):
+    """Drops rows whose key columns were seen in an earlier or the same frame."""
+
+    def __init__(self, key_columns):
+        self.key_columns = list(key_columns)
+        self._seen = set()
+
+    def __call__(self, df):
+        hashes = pd.util.hash_pandas_object(df[self.key_columns], index=False)
+        keep = ~hashes.duplicated().values
+        keep &= ~hashes.isin(self._seen).values
+        self._seen.update(hashes.values[keep].tolist())
+        return df[keep]
+
+
+def _arrow_schema(schema):
+    import pyarrow as pa
+    types = {
+        'str': pa.string(),
+        'object': pa.string(),
+        'int64': pa.int64(),
+        'Int64': pa.int64(),
+        'float64': pa.float64(),
+        'bool': pa.bool_(),
+        'boolean': pa.bool_(),
+    }
+    fields = []
+    for (column, dtype) in schema.items():
+        if dtype not in types:
+            raise ValueError('Unsupported dtype %s of column %s' %
+                             (dtype, column))
+        fields.append(pa.field(column, types[dtype]))
+    return pa.schema(fields)
+
+
+class CsvWriter(object):
+
+    def __init__(self, output_file, schema, encoding='utf_8'):
+        self._file = open(output_file, 'w', encoding=encoding, newline='')
+        pd.DataFrame(columns=list(schema)).to_csv(self._file, index=False)
+
+    def write(self, df):
+        df.to_csv(self._file, header=False, index=False)
+
+    def close(self):
+        self._file.close()
+
+
+class ArrowWriter(object):
+    """Writes every frame as a Parquet row group or a Feather record batch."""
+
+    def __init__(self, output_file, schema, output_format):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('--output_format=%s requires pyarrow' %
+                              output_format)
+        self._pa = pa
+        self._schema = _arrow_schema(schema)
+        if output_format == 'parquet':
+            self._writer = pq.ParquetWriter(output_file, self._schema)
+        else:
+            # Feather version 2 is the Arrow IPC file format.
+            self._writer = pa.ipc.new_file(output_file, self._schema)
+
+    def write(self, df):
+        self._writer.write_table(self._pa.Table.from_pandas(
+            df, schema=self._schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+
+
+def combine(paths, output_file, schema=None, output_format='csv',
+            dedup_columns=None, encoding='utf_8', num_workers=1):
+    """Merges the CSV files `paths` into `output_file`.
+
+    Returns:
+        The number of written rows.
+    """
+    if schema is None:
+        schema = infer_schema(paths, encoding=encoding)
+    if output_format == 'csv':
+        writer = CsvWriter(output_file, schema, encoding=encoding)
+    else:
+        writer = ArrowWriter(output_file, schema, output_format)
+    dedup = Deduplicator(dedup_columns) if dedup_columns else None
+    num_rows = 0
+    try:
+        for df in iter_files(paths, schema, encoding=encoding,
+                             num_workers=num_workers):
+            if dedup is not None:
+                df = dedup(df)
+            if len(df):
+                writer.write(df)
+            num_rows += len(df)
+    finally:
+        writer.close()
+    return num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--input_dir', default=DATA_PATH)
+    parser.add_argument('--output_file', default=OUTPUT_FILE)
+    parser.add_argument('--output_format', choices=FORMATS, default=None,
+                        help='Defaults to the extension of --output_file.')
+    parser.add_argument('--schema_file', default=None,
+                        help='JSON object of column name -> dtype.')
+    parser.add_argument('--dedup_columns', default=None,
+                        help='Comma-separated key columns; rows with a key '
+                             'that was already written are dropped.')
+    parser.add_argument('--encoding', default='utf_8')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of reading processes; 0 uses one per '
+                             'CPU.')
+    args = parser.parse_args()
+
+    output_format = args.output_format
+    if output_format is None:
+        extension = os.path.splitext(args.output_file)[1].lstrip('.')
+        output_format = extension if extension in FORMATS else 'csv'
+    schema = None
+    if args.schema_file is not None:
+        with open(args.schema_file) as f:
+            schema = json.load(f, object_pairs_hook=collections.OrderedDict)
+
+    # フォルダ中の全csvをマージ
+    paths = sorted(glob.glob(os.path.join(args.input_dir, '*.csv')))
+    num_rows = combine(
+        paths, args.output_file, schema=schema, output_format=output_format,
+        dedup_columns=(args.dedup_columns.split(',')
+                       if args.dedup_columns else None),
+        encoding=args.encoding,
+        num_workers=args.num_workers or multiprocessing.cpu_count())
+    print('Wrote %d rows of %d files to %s' % (num_rows, len(paths),
+                                                args.output_file))
 
-# フォルダ中の全csvをマージ
-list = []
-for file in All_Files:
-    list.append(pd.read_csv(file))
 
-df = pd.concat(list, sort=False)
-df.to_csv('rurubu.csv', encoding='utf_8')
+if __name__ == '__main__':
+    main()
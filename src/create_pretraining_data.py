@@ -8,11 +8,15 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import packing
 import random
-import tensorflow as tf
 import tokenization_sentencepiece as tokenization
+import utils
+from absl import app
+from absl import flags
 
-flags = tf.flags
+# TensorFlow is imported when the examples are written, not for `--help`.
+tf = utils.LazyModule("tensorflow")
 
 FLAGS = flags.FLAGS
 
@@ -27,7 +31,9 @@ flags.DEFINE_string("model_file", None,
                     "The model file that the SentencePiece model was trained on.")
 
 flags.DEFINE_string("vocab_file", None,
-                    "The vocabulary file that the SentencePiece model was trained on.")
+                    "The vocabulary: a .vocab file of spm_train, a vocabulary "
+                    "saved with `Vocab.save` (.npy) or unset to use the "
+                    "vocabulary of the SentencePiece model.")
 
 flags.DEFINE_bool(
     "do_lower_case", True,
@@ -52,6 +58,13 @@ flags.DEFINE_float(
     "Probability of creating sequences which are shorter than the "
     "maximum length.")
 
+flags.DEFINE_integer(
+    "max_sequences_per_pack", 1,
+    "Maximum number of instances packed into one `max_seq_length` row. "
+    "Packing avoids spending compute on padding for short instances. "
+    "1 disables packing. Must match `max_sequences_per_pack` of "
+    "run_pretraining.py.")
+
 
 class TrainingInstance(object):
   """A single training instance (sentence pair)."""
@@ -82,7 +95,8 @@ class TrainingInstance(object):
 
 
 def write_instance_to_example_files(instances, tokenizer, max_seq_length,
-                                    max_predictions_per_seq, output_files):
+                                    max_predictions_per_seq, output_files,
+                                    max_sequences_per_pack=1):
   """Create TF example files from `TrainingInstance`s."""
   writers = []
   for output_file in output_files:
@@ -90,41 +104,25 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
 
   writer_index = 0
 
+  if max_sequences_per_pack > 1:
+    packs = packing.pack_examples(
+        [len(instance.tokens) for instance in instances], max_seq_length,
+        max_sequences_per_pack,
+        costs=[len(instance.masked_lm_positions) for instance in instances],
+        max_cost=max_predictions_per_seq)
+  else:
+    packs = [[i] for i in range(len(instances))]
+
   total_written = 0
-  for (inst_index, instance) in enumerate(instances):
-    input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
-    input_mask = [1] * len(input_ids)
-    segment_ids = list(instance.segment_ids)
-    assert len(input_ids) <= max_seq_length
-
-    while len(input_ids) < max_seq_length:
-      input_ids.append(0)
-      input_mask.append(0)
-      segment_ids.append(0)
-
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-
-    masked_lm_positions = list(instance.masked_lm_positions)
-    masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
-    masked_lm_weights = [1.0] * len(masked_lm_ids)
-
-    while len(masked_lm_positions) < max_predictions_per_seq:
-      masked_lm_positions.append(0)
-      masked_lm_ids.append(0)
-      masked_lm_weights.append(0.0)
-
-    next_sentence_label = 1 if instance.is_random_next else 0
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(input_ids)
-    features["input_mask"] = create_int_feature(input_mask)
-    features["segment_ids"] = create_int_feature(segment_ids)
-    features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
-    features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
-    features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
-    features["next_sentence_labels"] = create_int_feature([next_sentence_label])
+  for (inst_index, pack) in enumerate(packs):
+    pack_instances = [instances[i] for i in pack]
+    if max_sequences_per_pack > 1:
+      features = packed_instances_to_features(
+          pack_instances, tokenizer, max_seq_length, max_predictions_per_seq,
+          max_sequences_per_pack)
+    else:
+      features = instance_to_features(pack_instances[0], tokenizer,
+                                      max_seq_length, max_predictions_per_seq)
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
 
@@ -136,7 +134,8 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
     if inst_index < 20:
       tf.logging.info("*** Example ***")
       tf.logging.info("tokens: %s" % " ".join(
-          [tokenization.printable_text(x) for x in instance.tokens]))
+          [tokenization.printable_text(x)
+           for instance in pack_instances for x in instance.tokens]))
 
       for feature_name in features.keys():
         feature = features[feature_name]
@@ -151,7 +150,96 @@ def write_instance_to_example_files(instances, tokenizer, max_seq_length,
   for writer in writers:
     writer.close()
 
-  tf.logging.info("Wrote %d total instances", total_written)
+  tf.logging.info("Wrote %d total instances in %d rows", len(instances),
+                  total_written)
+
+
+def instance_to_features(instance, tokenizer, max_seq_length,
+                         max_predictions_per_seq):
+  """Converts a `TrainingInstance` into an ordered dict of `tf.train.Feature`s."""
+  input_ids = tokenizer.convert_tokens_to_ids(instance.tokens)
+  input_mask = [1] * len(input_ids)
+  segment_ids = list(instance.segment_ids)
+  assert len(input_ids) <= max_seq_length
+
+  while len(input_ids) < max_seq_length:
+    input_ids.append(0)
+    input_mask.append(0)
+    segment_ids.append(0)
+
+  assert len(input_ids) == max_seq_length
+  assert len(input_mask) == max_seq_length
+  assert len(segment_ids) == max_seq_length
+
+  masked_lm_positions = list(instance.masked_lm_positions)
+  masked_lm_ids = tokenizer.convert_tokens_to_ids(instance.masked_lm_labels)
+  masked_lm_weights = [1.0] * len(masked_lm_ids)
+
+  while len(masked_lm_positions) < max_predictions_per_seq:
+    masked_lm_positions.append(0)
+    masked_lm_ids.append(0)
+    masked_lm_weights.append(0.0)
+
+  next_sentence_label = 1 if instance.is_random_next else 0
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(input_ids)
+  features["input_mask"] = create_int_feature(input_mask)
+  features["segment_ids"] = create_int_feature(segment_ids)
+  features["masked_lm_positions"] = create_int_feature(masked_lm_positions)
+  features["masked_lm_ids"] = create_int_feature(masked_lm_ids)
+  features["masked_lm_weights"] = create_float_feature(masked_lm_weights)
+  features["next_sentence_labels"] = create_int_feature([next_sentence_label])
+  return features
+
+
+def packed_instances_to_features(instances, tokenizer, max_seq_length,
+                                 max_predictions_per_seq,
+                                 max_sequences_per_pack):
+  """Packs several `TrainingInstance`s into one row of features.
+
+  Besides the usual features, a packed row has `position_ids` and
+  `sequence_ids` (see packing.py), and one next sentence label per instance
+  together with the position of its [CLS] token and a weight that is 0.0 for
+  unused slots.
+  """
+  assert len(instances) <= max_sequences_per_pack
+  packed = packing.pack_token_ids(
+      [(tokenizer.convert_tokens_to_ids(instance.tokens),
+        list(instance.segment_ids)) for instance in instances], max_seq_length)
+
+  masked_lm_positions = []
+  masked_lm_ids = []
+  for (offset, instance) in zip(packed["offsets"], instances):
+    masked_lm_positions.extend(
+        [offset + position for position in instance.masked_lm_positions])
+    masked_lm_ids.extend(
+        tokenizer.convert_tokens_to_ids(instance.masked_lm_labels))
+  masked_lm_weights = [1.0] * len(masked_lm_ids)
+
+  next_sentence_labels = [
+      1 if instance.is_random_next else 0 for instance in instances]
+  next_sentence_weights = [1.0] * len(instances)
+
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(packed["input_ids"])
+  features["input_mask"] = create_int_feature(packed["input_mask"])
+  features["segment_ids"] = create_int_feature(packed["segment_ids"])
+  features["position_ids"] = create_int_feature(packed["position_ids"])
+  features["sequence_ids"] = create_int_feature(packed["sequence_ids"])
+  features["masked_lm_positions"] = create_int_feature(
+      packing.pad_to(masked_lm_positions, max_predictions_per_seq))
+  features["masked_lm_ids"] = create_int_feature(
+      packing.pad_to(masked_lm_ids, max_predictions_per_seq))
+  features["masked_lm_weights"] = create_float_feature(
+      packing.pad_to(masked_lm_weights, max_predictions_per_seq, 0.0))
+  features["next_sentence_positions"] = create_int_feature(
+      packing.pad_to(packed["offsets"], max_sequences_per_pack))
+  features["next_sentence_labels"] = create_int_feature(
+      packing.pad_to(next_sentence_labels, max_sequences_per_pack))
+  features["next_sentence_weights"] = create_float_feature(
+      packing.pad_to(next_sentence_weights, max_sequences_per_pack, 0.0))
+  return features
 
 
 def create_int_feature(values):
@@ -168,31 +256,7 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
                               dupe_factor, short_seq_prob, masked_lm_prob,
                               max_predictions_per_seq, rng):
   """Create `TrainingInstance`s from raw text."""
-  all_documents = [[]]
-
-  # Input file format:
-  # (1) One sentence per line. These should ideally be actual sentences, not
-  # entire paragraphs or arbitrary spans of text. (Because we use the
-  # sentence boundaries for the "next sentence prediction" task).
-  # (2) Blank lines between documents. Document boundaries are needed so
-  # that the "next sentence prediction" task doesn't span between documents.
-  for input_file in input_files:
-    with tf.gfile.GFile(input_file, "r") as reader:
-      while True:
-        line = tokenization.convert_to_unicode(reader.readline())
-        if not line:
-          break
-        line = line.strip()
-
-        # Empty lines are used as document delimiters
-        if not line:
-          all_documents.append([])
-        tokens = tokenizer.tokenize(line)
-        if tokens:
-          all_documents[-1].append(tokens)
-
-  # Remove empty documents
-  all_documents = [x for x in all_documents if x]
+  all_documents = tokenize_documents(read_lines(input_files), tokenizer)
   rng.shuffle(all_documents)
 
   vocab_words = list(tokenizer.vocab.keys())
@@ -208,6 +272,39 @@ def create_training_instances(input_files, tokenizer, max_seq_length,
   return instances
 
 
+def read_lines(input_files):
+  """Yields the stripped lines of `input_files` one at a time."""
+  for input_file in input_files:
+    with tf.gfile.GFile(input_file, "r") as reader:
+      while True:
+        line = tokenization.convert_to_unicode(reader.readline())
+        if not line:
+          break
+        yield line.strip()
+
+
+def tokenize_documents(lines, tokenizer):
+  """Splits stripped lines into documents of tokenized sentences."""
+  all_documents = [[]]
+
+  # Input file format:
+  # (1) One sentence per line. These should ideally be actual sentences, not
+  # entire paragraphs or arbitrary spans of text. (Because we use the
+  # sentence boundaries for the "next sentence prediction" task).
+  # (2) Blank lines between documents. Document boundaries are needed so
+  # that the "next sentence prediction" task doesn't span between documents.
+  for line in lines:
+    # Empty lines are used as document delimiters
+    if not line:
+      all_documents.append([])
+    tokens = tokenizer.tokenize(line)
+    if tokens:
+      all_documents[-1].append(tokens)
+
+  # Remove empty documents
+  return [x for x in all_documents if x]
+
+
 def create_instances_from_document(
     all_documents, document_index, max_seq_length, short_seq_prob,
     masked_lm_prob, max_predictions_per_seq, vocab_words, rng):
@@ -425,12 +522,12 @@ def main(_):
     tf.logging.info("  %s", output_file)
 
   write_instance_to_example_files(instances, tokenizer, FLAGS.max_seq_length,
-                                  FLAGS.max_predictions_per_seq, output_files)
+                                  FLAGS.max_predictions_per_seq, output_files,
+                                  FLAGS.max_sequences_per_pack)
 
 
 if __name__ == "__main__":
   flags.mark_flag_as_required("input_file")
   flags.mark_flag_as_required("output_file")
   flags.mark_flag_as_required("model_file")
-  flags.mark_flag_as_required("vocab_file")
-  tf.app.run()
+  app.run(main)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Builds train/dev/test.tsv classification datasets from event CSV dumps.
+
+The CSV is read in chunks and only the needed columns and rows are kept,
+labels are mapped through categorical codes instead of `DataFrame.replace`,
+and the split is stratified by label and keyed by a seeded hash of the text,
+so it does not depend on the order of the rows in the dump. The TSVs have the
+"text" and "label" columns read by `LivedoorProcessor` in run_classifier.py.
+
+    python3 src/dataset_builder.py --input_file=20190823.csv --output_dir=. \
+        --kind=イベント --text_column=event_name --label_column=genre --dedup
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+SPLITS = ('test', 'dev', 'train')
+
+
+def read_csv(input_file, columns=None, filters=None, chunksize=100000,
+             **kwargs):
+    """Reads `input_file` in chunks and keeps only the matching rows.
+
+    Args:
+        input_file: CSV file.
+        columns: Columns to read; all columns if None.
+        filters: Dict of column -> value; only rows with these values are kept.
+        chunksize: Number of rows parsed at a time.
+        **kwargs: Other arguments of `pd.read_csv`.
+
+    Returns:
+        A DataFrame with the kept rows.
+    """
+    filters = filters or {}
+    if columns is not None:
+        columns = list(columns) + [c for c in filters if c not in columns]
+    chunks = []
+    for chunk in pd.read_csv(input_file, usecols=columns, chunksize=chunksize,
+                             **kwargs):
+        for (column, value) in filters.items():
+            chunk = chunk[chunk[column] == value]
+        chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def map_labels(values, table, keep_unknown=True):
+    """Maps `values` through `table` with categorical codes.
+
+    Equivalent to `values.replace(table)`, but a single vectorized lookup.
+    Values that are not in `table` are kept as they are if `keep_unknown`,
+    and become NaN otherwise.
+    """
+    keys = list(table)
+    codes = pd.Categorical(values, categories=keys).codes
+    mapped = np.array([table[key] for key in keys] + [np.nan],
+                      dtype=object)[codes]
+    if keep_unknown:
+        unknown = codes == -1
+        mapped[unknown] = np.asarray(values, dtype=object)[unknown]
+    return pd.Series(mapped, index=values.index, name=values.name)
+
+
+def split_dataset(df, text_column='text', label_column='label',
+                  fractions=(0.2, 0.2, 0.6), seed=12345, stratify=True):
+    """Splits `df` into (test, dev, train) with the given fractions.
+
+    Rows are shuffled by a hash of their text keyed with `seed`, so the split
+    of a row does not depend on its position in `df`. With `stratify`, every
+    label is split separately, so all splits have (up to rounding) the same
+    label distribution.
+    """
+    if len(fractions) != len(SPLITS) or not np.isclose(sum(fractions), 1.0):
+        raise ValueError('fractions must be 3 numbers that sum up to 1: %s' %
+                         (fractions,))
+    hash_key = hashlib.md5(str(seed).encode('utf-8')).hexdigest()[:16]
+    random_keys = pd.util.hash_pandas_object(
+        df[text_column].astype(str), index=False, hash_key=hash_key).values
+    if stratify:
+        groups = pd.factorize(df[label_column])[0]
+    else:
+        groups = np.zeros(len(df), dtype=np.int64)
+    # Rank of every row within its group in the shuffled order.
+    order = np.lexsort((random_keys, groups))
+    group_sizes = np.bincount(groups)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    ranks = np.empty(len(df), dtype=np.int64)
+    ranks[order] = np.arange(len(df)) - group_starts[groups[order]]
+    positions = (ranks + 0.5) / group_sizes[groups]
+    split_ids = np.searchsorted(np.cumsum(fractions)[:-1], positions,
+                                side='right')
+    return tuple(df[split_ids == i] for i in range(len(SPLITS)))
+
+
+def write_tsv(df, output_file, text_column='text', label_column='label'):
+    """Writes the "text" and "label" columns in the run_classifier format.
+
+    The classifiers read the TSVs without quoting, so tabs and line breaks in
+    the text are replaced with spaces.
+    """
+    out = pd.DataFrame({
+        'text': df[text_column].astype(str).str.replace(r'[\t\r\n]', ' ',
+                                                        regex=True),
+        'label': df[label_column],
+    })
+    out.to_csv(output_file, sep='\t', index=False, columns=['text', 'label'],
+               quoting=csv.QUOTE_NONE)
+
+
+def build_dataset(df, output_dir, text_column='text', label_column='label',
+                  fractions=(0.2, 0.2, 0.6), seed=12345, stratify=True,
+                  dedup=False):
+    """Writes test/dev/train.tsv of `df` to `output_dir`.
+
+    Rows without text or label are dropped, and with `dedup` also rows with
+    the same text as an earlier row (before splitting, so no text is in two
+    splits).
+
+    Returns:
+        Dict of split name -> number of examples.
+    """
+    df = df.dropna(subset=[text_column, label_column])
+    if dedup:
+        df = df.drop_duplicates(subset=[text_column])
+    splits = split_dataset(df, text_column=text_column,
+                           label_column=label_column, fractions=fractions,
+                           seed=seed, stratify=stratify)
+    sizes = {}
+    for (name, split) in zip(SPLITS, splits):
+        write_tsv(split, os.path.join(output_dir, name + '.tsv'),
+                  text_column=text_column, label_column=label_column)
+        sizes[name] = len(split)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--input_file', required=True)
+    parser.add_argument('--output_dir', default='.')
+    parser.add_argument('--text_column', default='text')
+    parser.add_argument('--label_column', default='label')
+    parser.add_argument('--kind', default=None,
+                        help='Only keeps rows with this value in "kind".')
+    parser.add_argument('--label_separator', default=None,
+                        help='Only uses the part of the label before this '
+                             'separator (e.g. "／" for "genre").')
+    parser.add_argument('--fractions', default='0.2,0.2,0.6',
+                        help='Fractions of test,dev,train.')
+    parser.add_argument('--seed', type=int, default=12345)
+    parser.add_argument('--no_stratify', action='store_true')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Drops rows with the same text as earlier rows.')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+
+    filters = {'kind': args.kind} if args.kind is not None else None
+    df = read_csv(args.input_file,
+                  columns=[args.text_column, args.label_column],
+                  filters=filters, chunksize=args.chunksize)
+    if args.label_separator is not None:
+        df[args.label_column] = df[args.label_column].str.split(
+            args.label_separator, n=1).str[0]
+    sizes = build_dataset(
+        df, args.output_dir, text_column=args.text_column,
+        label_column=args.label_column,
+        fractions=[float(f) for f in args.fractions.split(',')],
+        seed=args.seed, stratify=not args.no_stratify, dedup=args.dedup)
+    for name in SPLITS:
+        print('%s.tsv: %d examples' % (name, sizes[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Tests of dataset_builder.py.
+
+    python3 -m unittest src/dataset_builder_test.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dataset_builder
+
+
+def make_frame(num_rows=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'text': ['text %d' % i for i in range(num_rows)],
+        'label': rng.choice(['a', 'b', 'c'], size=num_rows, p=[0.6, 0.3, 0.1]),
+    })
+
+
+class SplitDatasetTest(unittest.TestCase):
+
+    def test_split_does_not_depend_on_row_order(self):
+        df = make_frame()
+        shuffled = df.sample(frac=1.0, random_state=1).reset_index(drop=True)
+        for (split, shuffled_split) in zip(
+                dataset_builder.split_dataset(df),
+                dataset_builder.split_dataset(shuffled)):
+            self.assertEqual(set(split['text']), set(shuffled_split['text']))
+
+    def test_split_depends_on_seed(self):
+        df = make_frame()
+        (test, _, _) = dataset_builder.split_dataset(df, seed=1)
+        (other_test, _, _) = dataset_builder.split_dataset(df, seed=2)
+        self.assertNotEqual(set(test['text']), set(other_test['text']))
+
+    def test_split_is_stratified(self):
+        df = make_frame()
+        splits = dataset_builder.split_dataset(df, fractions=(0.2, 0.2, 0.6))
+        self.assertEqual(sum(len(split) for split in splits), len(df))
+        for (split, fraction) in zip(splits, (0.2, 0.2, 0.6)):
+            counts = split['label'].value_counts()
+            for (label, count) in df['label'].value_counts().items():
+                self.assertLessEqual(abs(counts[label] - fraction * count), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# coding=utf-8
+"""Data-parallel training on a cluster of CPU/GPU hosts.
+
+A cluster is described by the standard `TF_CONFIG` environment variable, e.g.
+
+  {"cluster": {"chief": ["host0:2222"], "worker": ["host1:2222"],
+               "ps": ["host2:2222"]},
+   "task": {"type": "worker", "index": 0}}
+
+Training uses between-graph replication with parameter servers: every chief
+and worker process builds the full graph, variables live on the "ps" tasks
+and every worker applies its updates asynchronously. The chief also
+initializes the variables and writes checkpoints and summaries. Every worker
+reads its own shard of the training data (see `get_input_shard`).
+
+The all-reduce strategies of `tf.distribute` are not used because the
+AdamWeightDecayOptimizer of BERT updates its variables with plain
+assignments instead of `apply_gradients` of a `tf.train.Optimizer`.
+
+`launch_local_cluster.py` starts such a cluster as local processes.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tensorflow as tf
+
+
+def is_distributed(run_config):
+  """Whether `run_config` (parsed from `TF_CONFIG`) describes a cluster.
+
+  Raises:
+    ValueError: if the cluster has no "ps" tasks.
+  """
+  # The cluster spec of a TPU RunConfig comes from its TPU cluster resolver,
+  # not from `TF_CONFIG`.
+  if (not run_config.cluster_spec or
+      getattr(run_config, "cluster", None) is not None):
+    return False
+  if run_config.num_ps_replicas == 0:
+    raise ValueError(
+        "The cluster in TF_CONFIG has no \"ps\" tasks. Multi-worker training "
+        "uses parameter servers, so add a \"ps\" job to the cluster, or unset "
+        "TF_CONFIG to train in a single process.")
+  return True
+
+
+def get_input_shard(run_config):
+  """Returns (num_shards, shard_index) of the training data of this task.
+
+  The chief is shard 0 and worker `i` is shard `i + 1`.
+  """
+  if not is_distributed(run_config):
+    return (1, 0)
+  num_shards = run_config.num_worker_replicas
+  if run_config.task_type == "chief":
+    return (num_shards, 0)
+  return (num_shards, run_config.task_id + 1)
+
+
+def start_server(run_config):
+  """Starts the in-process server of this task of the cluster.
+
+  Parameter server tasks only serve variables, so for them this function
+  never returns.
+
+  Returns:
+    The `tf.train.Server` of a chief or worker task, or None if `run_config`
+    does not describe a cluster.
+  """
+  if not is_distributed(run_config):
+    return None
+
+  tf.logging.info("Starting server for %s task %d", run_config.task_type,
+                  run_config.task_id)
+  server = tf.train.Server(
+      run_config.cluster_spec,
+      job_name=run_config.task_type,
+      task_index=run_config.task_id,
+      config=run_config.session_config,
+      start=True)
+  if run_config.task_type == "ps":
+    server.join()
+  return server
+
+
+def create_estimator(model_fn, run_config, train_batch_size):
+  """Creates an Estimator for the cluster from a `TPUEstimator` model_fn.
+
+  Estimator places the variables on the parameter servers and uses the
+  server of this task as the session master.
+
+  Args:
+    model_fn: model_fn returning a `TPUEstimatorSpec`.
+    run_config: `RunConfig` with the cluster of `TF_CONFIG`.
+    train_batch_size: int. Batch size of every worker, passed to the
+      `input_fn` as `params["batch_size"]` like TPUEstimator does.
+
+  Returns:
+    A `tf.estimator.Estimator`.
+  """
+
+  def estimator_model_fn(features, labels, mode, params):
+    output_spec = model_fn(features, labels, mode, params)
+    return output_spec.as_estimator_spec()
+
+  return tf.estimator.Estimator(
+      model_fn=estimator_model_fn,
+      config=run_config,
+      params={"batch_size": train_batch_size})
+
+
+def get_task_file(path, run_config):
+  """Inserts the task of this process into a file name in a cluster.
+
+  E.g. "metrics.jsonl" becomes "metrics-worker-1.jsonl" for worker 1, so that
+  processes sharing a file system do not write to the same file.
+  """
+  if not is_distributed(run_config):
+    return path
+  (root, ext) = os.path.splitext(path)
+  return "%s-%s-%d%s" % (root, run_config.task_type, run_config.task_id, ext)
@@ -0,0 +1,221 @@
+# coding=utf-8
+"""Dev set evaluation during training, best checkpoints and early stopping.
+
+`Estimator.evaluate` rebuilds the graph and restores the latest checkpoint,
+so running it between training steps is slow. `create_evaluation_hook`
+instead builds a second, non-training copy of the model into the training
+graph (sharing its variables) together with an initializable dev set input
+pipeline and streaming metrics. Every `every_n_steps` optimizer updates the
+`EvaluationHook` runs the dev set through it in the training session, keeps
+the `keep_best` checkpoints with the best value of the chosen metric in
+`<output_dir>/best` and stops the training once the metric did not improve for
+`patience` evaluations.
+
+`get_best_checkpoint` returns the best checkpoint so far, e.g. for
+`Estimator.evaluate(checkpoint_path=...)`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import tensorflow as tf
+
+EvaluationConfig = collections.namedtuple("EvaluationConfig", [
+    "input_fn",  # `input_fn` of the dev set, without `repeat()`.
+    "batch_size",  # Passed to `input_fn` as `params["batch_size"]`.
+    "every_n_steps",  # Global steps between two evaluations.
+    "output_dir",  # Best checkpoints are saved to `<output_dir>/best`.
+    "metric_name",  # Key of the metric in the dict of `metrics_fn`.
+    "metric_mode",  # "max" or "min".
+    "keep_best",  # Number of best checkpoints to keep.
+    "patience",  # Evaluations without improvement before stopping, 0: never.
+    "min_delta",  # Smallest change of the metric that counts as improvement.
+])
+
+BEST_CHECKPOINTS_FILE = "best_checkpoints.json"
+
+
+def get_best_dir(output_dir):
+  return os.path.join(output_dir, "best")
+
+
+def get_best_checkpoint(output_dir):
+  """Returns the best checkpoint saved during training, or None."""
+  return tf.train.latest_checkpoint(get_best_dir(output_dir))
+
+
+def create_evaluation_hook(config, metrics_fn, metrics_writer=None):
+  """Builds the dev set evaluation into the current graph.
+
+  Call from the TRAIN branch of a model_fn.
+
+  Args:
+    config: `EvaluationConfig`.
+    metrics_fn: Function of a dict of dev set features that builds the eval
+      model and returns a dict of `tf.metrics` (value, update_op) pairs. It is
+      called with variable reuse, so the model must use the same variable
+      scope names as the training model.
+    metrics_writer: (Optional) `metrics_hooks.MetricsWriter` for the results.
+
+  Returns:
+    An `EvaluationHook`.
+  """
+  if config.metric_mode not in ("max", "min"):
+    raise ValueError("Unknown metric mode: %s" % config.metric_mode)
+
+  metric_variables = set(tf.get_collection(tf.GraphKeys.METRIC_VARIABLES))
+  with tf.name_scope("in_process_eval"):
+    dataset = config.input_fn({"batch_size": config.batch_size})
+    iterator = dataset.make_initializable_iterator()
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      metrics = metrics_fn(iterator.get_next())
+  if config.metric_name not in metrics:
+    raise ValueError("Metric %s not found, available metrics: %s" %
+                     (config.metric_name, ", ".join(sorted(metrics))))
+
+  # The streaming metrics are reset before every evaluation.
+  new_metric_variables = [
+      v for v in tf.get_collection(tf.GraphKeys.METRIC_VARIABLES)
+      if v not in metric_variables
+  ]
+  return EvaluationHook(
+      config,
+      iterator_initializer=iterator.initializer,
+      reset_op=tf.variables_initializer(new_metric_variables),
+      metrics=metrics,
+      metrics_writer=metrics_writer)
+
+
+class EvaluationHook(tf.train.SessionRunHook):
+  """Evaluates periodically, keeps the best checkpoints and stops early."""
+
+  def __init__(self, config, iterator_initializer, reset_op, metrics,
+               metrics_writer=None):
+    self._config = config
+    self._iterator_initializer = iterator_initializer
+    self._reset_op = reset_op
+    self._update_ops = {k: v[1] for (k, v) in metrics.items()}
+    self._values = {k: v[0] for (k, v) in metrics.items()}
+    self._writer = metrics_writer
+    self._timer = tf.train.SecondOrStepTimer(every_steps=config.every_n_steps)
+    self._best_dir = get_best_dir(config.output_dir)
+
+  def begin(self):
+    self._global_step_tensor = tf.train.get_global_step()
+    # Only the best checkpoints are pruned by this saver, never the regular
+    # ones of the CheckpointSaverHook.
+    self._saver = tf.train.Saver(max_to_keep=None)
+    self._best = self._load_best()
+    self._evaluations_without_improvement = 0
+
+  def after_create_session(self, session, coord):
+    self._timer.update_last_triggered_step(
+        session.run(self._global_step_tensor))
+
+  def before_run(self, run_context):
+    return tf.train.SessionRunArgs(self._global_step_tensor)
+
+  def after_run(self, run_context, run_values):
+    # The fetched global step is the value before the train op ran.
+    if not self._timer.should_trigger_for_step(run_values.results + 1):
+      return
+    global_step = run_context.session.run(self._global_step_tensor)
+    if not self._timer.should_trigger_for_step(global_step):
+      return
+    self._timer.update_last_triggered_step(global_step)
+    if self._evaluate(run_context.session, global_step):
+      tf.logging.info(
+          "Stopping early: %s did not improve for %d evaluations",
+          self._config.metric_name, self._evaluations_without_improvement)
+      run_context.request_stop()
+
+  def _evaluate(self, session, global_step):
+    """Runs one evaluation and returns whether training should stop."""
+    session.run([self._iterator_initializer, self._reset_op])
+    num_batches = 0
+    while True:
+      try:
+        session.run(self._update_ops)
+        num_batches += 1
+      except tf.errors.OutOfRangeError:
+        break
+    results = session.run(self._values)
+    value = float(results[self._config.metric_name])
+
+    tf.logging.info("***** In-process eval at step %d (%d batches) *****",
+                    global_step, num_batches)
+    for key in sorted(results):
+      tf.logging.info("  %s = %s", key, results[key])
+
+    improved = self._is_improvement(value)
+    if improved:
+      self._evaluations_without_improvement = 0
+    else:
+      self._evaluations_without_improvement += 1
+    if self._is_kept(value):
+      self._save(session, global_step, value)
+
+    if self._writer is not None:
+      record = {k: float(v) for (k, v) in results.items()}
+      record["best_" + self._config.metric_name] = self._best[0]["value"]
+      self._writer.write("eval", record, global_step)
+
+    return (self._config.patience > 0 and
+            self._evaluations_without_improvement >= self._config.patience)
+
+  def _is_better(self, value, reference, min_delta=0.0):
+    if self._config.metric_mode == "max":
+      return value > reference + min_delta
+    return value < reference - min_delta
+
+  def _is_improvement(self, value):
+    return not self._best or self._is_better(value, self._best[0]["value"],
+                                             self._config.min_delta)
+
+  def _is_kept(self, value):
+    return (len(self._best) < self._config.keep_best or
+            self._is_better(value, self._best[-1]["value"]))
+
+  def _save(self, session, global_step, value):
+    path = self._saver.save(
+        session, os.path.join(self._best_dir, "model.ckpt"),
+        global_step=global_step, write_meta_graph=False,
+        write_state=False)
+    self._best.append({"path": path, "step": int(global_step),
+                       "value": value})
+    self._best.sort(key=lambda c: c["value"],
+                    reverse=self._config.metric_mode == "max")
+    for checkpoint in self._best[self._config.keep_best:]:
+      for filename in tf.gfile.Glob(checkpoint["path"] + ".*"):
+        tf.gfile.Remove(filename)
+    del self._best[self._config.keep_best:]
+
+    # The best checkpoint is the "latest" one of the directory, so that it can
+    # be found with `tf.train.latest_checkpoint`.
+    tf.train.update_checkpoint_state(
+        self._best_dir, self._best[0]["path"],
+        all_model_checkpoint_paths=[c["path"] for c in self._best])
+    with tf.gfile.GFile(os.path.join(self._best_dir, BEST_CHECKPOINTS_FILE),
+                        "w") as writer:
+      json.dump({"metric_name": self._config.metric_name,
+                 "metric_mode": self._config.metric_mode,
+                 "checkpoints": self._best}, writer, indent=2)
+    tf.logging.info("Saved best checkpoint %s (%s = %s)", path,
+                    self._config.metric_name, value)
+
+  def _load_best(self):
+    """Returns the best checkpoints of a previous run of the same metric."""
+    best_file = os.path.join(self._best_dir, BEST_CHECKPOINTS_FILE)
+    if not tf.gfile.Exists(best_file):
+      return []
+    with tf.gfile.GFile(best_file) as reader:
+      state = json.load(reader)
+    if (state["metric_name"] != self._config.metric_name or
+        state["metric_mode"] != self._config.metric_mode):
+      return []
+    return [c for c in state["checkpoints"]
+            if tf.gfile.Glob(c["path"] + ".*")]
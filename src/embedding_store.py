@@ -0,0 +1,122 @@
+# coding=utf-8
+"""Persistent store of text embeddings computed by extract_features.py.
+
+Every vector is keyed by a 16 byte hash of the text and of the settings that
+determine it (checkpoint, layers, pooling, ...), see `make_key`. The store
+directory holds
+
+  store.json   Vector dimension and dtype.
+  vectors.bin  The vectors, one row per key, appended as raw `dtype` values
+               and memory-mapped for lookups.
+  keys.bin     The keys in row order, appended after their vectors.
+
+A row only counts once its key is written, so a run that is interrupted
+while appending leaves at most unreferenced vector bytes, which the next
+`EmbeddingStore` drops. The keys are loaded into a dict, so looking up texts
+that are already in the store does not touch the model or the vectors.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import numpy as np
+
+KEY_SIZE = 16
+
+
+def make_key(settings, text_a, text_b=None):
+  """Returns the key of a text for a JSON-serializable dict of `settings`."""
+  payload = json.dumps([settings, text_a, text_b], sort_keys=True,
+                       ensure_ascii=False)
+  return hashlib.blake2b(payload.encode("utf-8"),
+                         digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingStore(object):
+  """Append-only store of fixed-size vectors keyed by `make_key`."""
+
+  def __init__(self, store_dir, dim, dtype="float32"):
+    self.store_dir = store_dir
+    self.dim = dim
+    self.dtype = np.dtype(dtype)
+    if not os.path.isdir(store_dir):
+      os.makedirs(store_dir)
+
+    meta_file = os.path.join(store_dir, "store.json")
+    meta = {"dim": dim, "dtype": self.dtype.name}
+    if os.path.exists(meta_file):
+      with open(meta_file) as reader:
+        existing_meta = json.load(reader)
+      if existing_meta != meta:
+        raise ValueError(
+            "%s holds %s vectors of dimension %d, not %s of dimension %d; use "
+            "another store directory" %
+            (store_dir, existing_meta["dtype"], existing_meta["dim"],
+             meta["dtype"], dim))
+    else:
+      with open(meta_file, "w") as writer:
+        json.dump(meta, writer)
+
+    self._vectors_file = os.path.join(store_dir, "vectors.bin")
+    self._keys_file = os.path.join(store_dir, "keys.bin")
+    keys = b""
+    if os.path.exists(self._keys_file):
+      with open(self._keys_file, "rb") as reader:
+        keys = reader.read()
+    num_rows = len(keys) // KEY_SIZE
+    self._index = {
+        keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(num_rows)
+    }
+    # Drops a partly written key and the vectors of keys that were not
+    # written.
+    with open(self._keys_file, "ab") as writer:
+      writer.truncate(num_rows * KEY_SIZE)
+    with open(self._vectors_file, "ab") as writer:
+      writer.truncate(num_rows * self.dim * self.dtype.itemsize)
+    self._vectors = None
+
+  def __len__(self):
+    return len(self._index)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def _get_vectors(self):
+    if self._vectors is None or len(self._vectors) != len(self):
+      self._vectors = np.memmap(self._vectors_file, dtype=self.dtype,
+                                mode="r", shape=(len(self), self.dim))
+    return self._vectors
+
+  def get(self, keys):
+    """Returns the vectors of `keys`, which must be in the store."""
+    if not keys:
+      return np.zeros((0, self.dim), dtype=self.dtype)
+    rows = np.array([self._index[key] for key in keys], dtype=np.int64)
+    return self._get_vectors()[rows]
+
+  def add(self, keys, vectors):
+    """Appends the vectors of the `keys` that are not in the store yet."""
+    vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+    new_rows = collections.OrderedDict()
+    for (i, key) in enumerate(keys):
+      if key not in self._index and key not in new_rows:
+        new_rows[key] = i
+    if not new_rows:
+      return 0
+    new_keys = list(new_rows)
+    with open(self._vectors_file, "ab") as writer:
+      writer.write(vectors[list(new_rows.values())].tobytes())
+      writer.flush()
+      os.fsync(writer.fileno())
+    with open(self._keys_file, "ab") as writer:
+      writer.write(b"".join(new_keys))
+      writer.flush()
+      os.fsync(writer.fileno())
+    for key in new_keys:
+      self._index[key] = len(self._index)
+    return len(new_keys)
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""Tests of embedding_store.py.
+
+  python3 -m unittest src/embedding_store_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import embedding_store
+
+DIM = 4
+
+
+def make_keys(texts):
+  return [embedding_store.make_key({"layers": [-1]}, text) for text in texts]
+
+
+def make_vectors(num_vectors, start=0):
+  return np.arange(start * DIM, (start + num_vectors) * DIM,
+                   dtype=np.float32).reshape(num_vectors, DIM)
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.store_dir)
+
+  def _append(self, name, data):
+    with open(os.path.join(self.store_dir, name), "ab") as writer:
+      writer.write(data)
+
+  def test_add_and_get(self):
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    keys = make_keys(["a", "b", "a", "c"])
+    self.assertEqual(store.add(keys, make_vectors(4)), 3)
+    self.assertEqual(len(store), 3)
+    self.assertIn(keys[1], store)
+    np.testing.assert_array_equal(
+        store.get([keys[3], keys[0]]), make_vectors(4)[[3, 0]])
+
+    # Known keys are not added again, also after reopening the store.
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    self.assertEqual(store.add(keys[:2], make_vectors(2, start=10)), 0)
+    self.assertEqual(len(store), 3)
+    np.testing.assert_array_equal(store.get(keys[:1]), make_vectors(1))
+
+  def test_partial_tails_are_dropped(self):
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    keys = make_keys(["a", "b"])
+    store.add(keys, make_vectors(2))
+
+    # An append interrupted after part of the vectors and of a key.
+    self._append("vectors.bin", make_vectors(2, start=2).tobytes()[:20])
+    self._append("keys.bin", make_keys(["c"])[0][:5])
+
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    self.assertEqual(len(store), 2)
+    self.assertEqual(
+        os.path.getsize(os.path.join(self.store_dir, "keys.bin")),
+        2 * embedding_store.KEY_SIZE)
+    self.assertEqual(
+        os.path.getsize(os.path.join(self.store_dir, "vectors.bin")),
+        2 * DIM * 4)
+    np.testing.assert_array_equal(store.get(keys), make_vectors(2))
+
+    new_keys = make_keys(["c", "d"])
+    self.assertEqual(store.add(new_keys, make_vectors(2, start=2)), 2)
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    self.assertEqual(len(store), 4)
+    np.testing.assert_array_equal(store.get(keys + new_keys), make_vectors(4))
+
+  def test_vectors_without_keys_are_dropped(self):
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    keys = make_keys(["a"])
+    store.add(keys, make_vectors(1))
+
+    # The vectors were written, but the process stopped before their keys.
+    self._append("vectors.bin", make_vectors(3, start=1).tobytes())
+
+    store = embedding_store.EmbeddingStore(self.store_dir, DIM)
+    self.assertEqual(len(store), 1)
+    new_keys = make_keys(["b"])
+    store.add(new_keys, make_vectors(1, start=7))
+    np.testing.assert_array_equal(
+        store.get(keys + new_keys),
+        np.concatenate([make_vectors(1), make_vectors(1, start=7)]))
+
+  def test_other_dim_or_dtype_raises(self):
+    embedding_store.EmbeddingStore(self.store_dir, DIM)
+    with self.assertRaises(ValueError):
+      embedding_store.EmbeddingStore(self.store_dir, DIM + 1)
+    with self.assertRaises(ValueError):
+      embedding_store.EmbeddingStore(self.store_dir, DIM, dtype="float16")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -24,16 +24,24 @@ sys.path.append("../bert")
 
 import codecs
 import collections
+import embedding_store
 import json
+import numpy as np
 import re
 
-import modeling
 #import tokenization
 import tokenization_sentencepiece as tokenization
-import tensorflow as tf
+import utils
+from absl import app
+from absl import flags
 
+# TensorFlow and the model code are imported when the model is built, not
+# for `--help`.
+tf = utils.LazyModule("tensorflow")
+checkpoint_cache = utils.LazyModule("checkpoint_cache")
+modeling = utils.LazyModule("modeling")
+modeling_ext = utils.LazyModule("modeling_ext")
 
-flags = tf.flags
 
 FLAGS = flags.FLAGS
 
@@ -58,8 +66,22 @@ flags.DEFINE_string(
     "init_checkpoint", None,
     "Initial checkpoint (usually from a pre-trained BERT model).")
 
+flags.DEFINE_string(
+    "init_checkpoint_cache_dir", None,
+    "[Optional] Local directory of a warm-start cache of `init_checkpoint` "
+    "(see checkpoint_cache.py). The cache is built on the first run and "
+    "memory-mapped afterwards, so later runs do not read the checkpoint. "
+    "Only used if `use_tpu` is False.")
+
+flags.DEFINE_enum(
+    "init_checkpoint_cache_dtype", "float32", ["float32", "float16"],
+    "Storage type of the warm-start cache. float16 halves its size at a "
+    "small loss of precision.")
+
 flags.DEFINE_string("vocab_file", None,
-                    "The vocabulary file that the BERT model was trained on.")
+                    "The vocabulary: a .vocab file of spm_train, a vocabulary "
+                    "saved with `Vocab.save` (.npy) or unset to use the "
+                    "vocabulary of the SentencePiece model.")
 
 flags.DEFINE_bool(
     "do_lower_case", True,
@@ -87,6 +109,28 @@ flags.DEFINE_bool(
 flags.DEFINE_string("model_file", None,
                     "The model file that the SentencePiece model was trained on.")
 
+flags.DEFINE_enum(
+    "precision", "float32", list(utils.PRECISIONS),
+    "Type of the transformer activations and matmuls. With float16 or "
+    "bfloat16 the variables stay float32, and layer normalization and the "
+    "attention softmax run in float32.")
+
+flags.DEFINE_string(
+    "embedding_store_dir", None,
+    "[Optional] Directory of a persistent embedding store (see "
+    "embedding_store.py). Only lines that are not in the store yet are run "
+    "through the model, and `output_file` is written as a .npy array with "
+    "one pooled vector (the `layers` concatenated) per input line.")
+
+flags.DEFINE_enum(
+    "pooling", "cls", ["cls", "mean"],
+    "How the token vectors of a line are pooled into the vector of the "
+    "embedding store: the [CLS] vector or the mean over all tokens.")
+
+flags.DEFINE_enum(
+    "embedding_store_dtype", "float32", ["float32", "float16"],
+    "Storage type of the vectors in the embedding store.")
+
 class InputExample(object):
 
   def __init__(self, unique_id, text_a, text_b):
@@ -155,7 +199,9 @@ def input_fn_builder(features, seq_length):
 
 
 def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, compute_type="float32",
+                     init_checkpoint_cache_dir=None,
+                     init_checkpoint_cache_dtype="float32"):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -166,39 +212,41 @@ def model_fn_builder(bert_config, init_checkpoint, layer_indexes, use_tpu,
     input_mask = features["input_mask"]
     input_type_ids = features["input_type_ids"]
 
-    model = modeling.BertModel(
+    model = modeling_ext.BertModel(
         config=bert_config,
         is_training=False,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=input_type_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        compute_type=tf.as_dtype(compute_type))
 
     if mode != tf.estimator.ModeKeys.PREDICT:
       raise ValueError("Only PREDICT modes are supported: %s" % (mode))
 
     tvars = tf.trainable_variables()
     scaffold_fn = None
-    (assignment_map,
-     initialized_variable_names) = modeling.get_assignment_map_from_checkpoint(
-         tvars, init_checkpoint)
-    if use_tpu:
+    use_checkpoint_cache = bool(init_checkpoint_cache_dir and not use_tpu)
+    if use_checkpoint_cache:
+      (scaffold_fn, initialized_variable_names
+       ) = checkpoint_cache.warm_start_scaffold_fn(
+          tvars, init_checkpoint, init_checkpoint_cache_dir,
+          init_checkpoint_cache_dtype)
+    else:
+      (assignment_map, initialized_variable_names
+       ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      if use_tpu:
 
-      def tpu_scaffold():
-        tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
-        return tf.train.Scaffold()
+        def tpu_scaffold():
+          tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+          return tf.train.Scaffold()
 
-      scaffold_fn = tpu_scaffold
-    else:
-      tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+        scaffold_fn = tpu_scaffold
+      else:
+        tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
 
-    tf.logging.info("**** Trainable Variables ****")
-    for var in tvars:
-      init_string = ""
-      if var.name in initialized_variable_names:
-        init_string = ", *INIT_FROM_CKPT*"
-      tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape,
-                      init_string)
+    checkpoint_cache.log_trainable_variables(
+        tvars, initialized_variable_names, summary_only=use_checkpoint_cache)
 
     all_layers = model.get_all_encoder_layers()
 
@@ -354,6 +402,53 @@ def read_examples(input_file):
   return examples
 
 
+def get_embedding_settings(bert_config, layer_indexes):
+  """Returns everything besides the text that determines a stored vector."""
+  checkpoint_mtime = None
+  if tf.gfile.Exists(FLAGS.init_checkpoint + ".index"):
+    checkpoint_mtime = tf.gfile.Stat(FLAGS.init_checkpoint +
+                                     ".index").mtime_nsec
+  settings = {
+      "init_checkpoint": FLAGS.init_checkpoint,
+      "init_checkpoint_mtime": checkpoint_mtime,
+      "bert_config_file": FLAGS.bert_config_file,
+      "bert_config": bert_config.to_dict(),
+      "model_file": FLAGS.model_file,
+      "vocab_file": FLAGS.vocab_file,
+      "do_lower_case": FLAGS.do_lower_case,
+      "max_seq_length": FLAGS.max_seq_length,
+      "precision": FLAGS.precision,
+      "layers": layer_indexes,
+      "pooling": FLAGS.pooling,
+  }
+  # The model is initialized from the cached copy of the checkpoint, which
+  # may hold float16 weights.
+  if FLAGS.init_checkpoint_cache_dir and not FLAGS.use_tpu:
+    settings["init_checkpoint_cache_dtype"] = FLAGS.init_checkpoint_cache_dtype
+  return settings
+
+
+def pool_layers(result, feature, num_layers):
+  """Returns the pooled vectors of all layers of `result`, concatenated."""
+  vectors = []
+  for j in range(num_layers):
+    layer_output = result["layer_output_%d" % j]
+    if FLAGS.pooling == "cls":
+      vectors.append(layer_output[0])
+    else:
+      mask = np.asarray(feature.input_mask, dtype=np.float32)
+      vectors.append(
+          np.dot(mask, layer_output) / np.maximum(mask.sum(), 1.0))
+  return np.concatenate(vectors)
+
+
+def write_store_output(store, keys):
+  """Writes the stored vectors of `keys` as a .npy array to `output_file`."""
+  with tf.gfile.GFile(FLAGS.output_file, "wb") as writer:
+    np.save(writer, store.get(keys))
+  tf.logging.info("Wrote %d vectors to %s", len(keys), FLAGS.output_file)
+
+
 def main(_):
 
   layer_indexes = [int(x) for x in FLAGS.layers.split(",")]
@@ -376,6 +471,33 @@ def main(_):
 
   examples = read_examples(FLAGS.input_file)
 
+  store = None
+  if FLAGS.embedding_store_dir:
+    store = embedding_store.EmbeddingStore(
+        FLAGS.embedding_store_dir,
+        dim=len(layer_indexes) * bert_config.hidden_size,
+        dtype=FLAGS.embedding_store_dtype)
+    settings = get_embedding_settings(bert_config, layer_indexes)
+    keys = [
+        embedding_store.make_key(settings, example.text_a, example.text_b)
+        for example in examples
+    ]
+    # Only the first line of every text that is not in the store yet.
+    unique_id_to_key = {}
+    pending_keys = set()
+    for (example, key) in zip(examples, keys):
+      if key not in store and key not in pending_keys:
+        unique_id_to_key[example.unique_id] = key
+        pending_keys.add(key)
+    tf.logging.info("%d new texts in %d lines", len(unique_id_to_key),
+                    len(examples))
+    examples = [
+        example for example in examples
+        if example.unique_id in unique_id_to_key
+    ]
+    if not examples:
+      write_store_output(store, keys)
+      return
 
   features = convert_examples_to_features(
       examples=examples, seq_length=FLAGS.max_seq_length, tokenizer=tokenizer)
@@ -388,9 +510,12 @@ def main(_):
   model_fn = model_fn_builder(
       bert_config=bert_config,
       init_checkpoint=FLAGS.init_checkpoint,
+      init_checkpoint_cache_dir=FLAGS.init_checkpoint_cache_dir,
+      init_checkpoint_cache_dtype=FLAGS.init_checkpoint_cache_dtype,
       layer_indexes=layer_indexes,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_one_hot_embeddings)
+      use_one_hot_embeddings=FLAGS.use_one_hot_embeddings,
+      compute_type=modeling_ext.get_compute_type(FLAGS.precision))
 
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
@@ -404,6 +529,21 @@ def main(_):
   input_fn = input_fn_builder(
       features=features, seq_length=FLAGS.max_seq_length)
 
+  if store is not None:
+    # Vectors are added every batch, so an interrupted run keeps them.
+    (batch_keys, batch_vectors) = ([], [])
+    for result in estimator.predict(input_fn, yield_single_examples=True):
+      unique_id = int(result["unique_id"])
+      batch_keys.append(unique_id_to_key[unique_id])
+      batch_vectors.append(pool_layers(
+          result, unique_id_to_feature[unique_id], len(layer_indexes)))
+      if len(batch_keys) == FLAGS.batch_size:
+        store.add(batch_keys, batch_vectors)
+        (batch_keys, batch_vectors) = ([], [])
+    store.add(batch_keys, batch_vectors)
+    write_store_output(store, keys)
+    return
+
   with codecs.getwriter("utf-8")(tf.gfile.Open(FLAGS.output_file,
                                                "w")) as writer:
     for result in estimator.predict(input_fn, yield_single_examples=True):
@@ -435,8 +575,7 @@ def main(_):
 
 if __name__ == "__main__":
   flags.mark_flag_as_required("input_file")
-  flags.mark_flag_as_required("vocab_file")
   flags.mark_flag_as_required("bert_config_file")
   flags.mark_flag_as_required("init_checkpoint")
   flags.mark_flag_as_required("output_file")
-  tf.app.run()
+  app.run(main)
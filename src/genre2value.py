@@ -1,6 +1,7 @@
-import pandas as pd
 import os
 
+import dataset_builder
+
 table = {
 '節句・年中行事'             :  'Traditional-Festivalsand-annual-events'   ,
 '神輿・山車など'             :  'Shrine-floats-etc.'   ,
@@ -34,21 +35,15 @@ table = {
 '0'                          : 'none'
 }
 
-df = pd.read_csv('./20190823.csv',delimiter=',')
-events = df[df['kind'] == 'イベント']
-genres = events['genre'].str.split('／',expand=True)
+events = dataset_builder.read_csv('./20190823.csv', filters={'kind': 'イベント'})
+genres = events['genre'].str.split('／', n=2, expand=True)
 events['genre'] = genres[0]
-events['genre2'] = genres[1]
-events['genre2_num'] = events['genre2'].replace(table)
-events['genre_num'] = events['genre'].replace(table)
+events['genre2'] = genres[1] if genres.shape[1] > 1 else None
+events['genre2_num'] = dataset_builder.map_labels(events['genre2'], table)
+events['genre_num'] = dataset_builder.map_labels(events['genre'], table)
 events.to_csv('./genre_test_changed.txt')
 
-df = pd.DataFrame()
-df['text'] = events['event_name']
-df['label'] = events['genre_num']
-
 EXTRACTDIR = "."
-df[:len(df) // 5].to_csv( os.path.join(EXTRACTDIR, "test.tsv"), sep='\t', index=False)
-df[len(df) // 5:len(df)*2 // 5].to_csv( os.path.join(EXTRACTDIR, "dev.tsv"), sep='\t', index=False)
-df[len(df)*2 // 5:].to_csv( os.path.join(EXTRACTDIR, "train.tsv"), sep='\t', index=False)
-
+# Stratified by genre and seeded, instead of the row order of the dump.
+dataset_builder.build_dataset(events, EXTRACTDIR, text_column='event_name',
+                              label_column='genre_num')
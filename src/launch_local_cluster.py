@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Runs run_pretraining.py or run_classifier.py as a local multi-worker cluster.
+
+Starts one chief, NUM_WORKERS - 1 workers and NUM_PS parameter servers as
+processes on this machine, each with its own TF_CONFIG (see
+distribute_utils.py), and waits for the training to finish. Every run gets
+its own output directory below --run_dir, and the script appends
+--output_dir and --metrics_file to the training command.
+
+Given several cluster sizes (e.g. --num_workers=1,2,4), the clusters run one
+after the other. The report gives the summed examples/sec of the workers of
+every size and the scaling efficiency relative to the smallest size, as JSON.
+
+Example:
+    python3 src/launch_local_cluster.py --num_workers=1,2,4 \\
+        --run_dir=/tmp/scaling -- src/run_pretraining.py \\
+        --input_file=data/all-maxseq128.tfrecord --do_train=True \\
+        --num_train_steps=200 --metrics_every_n_steps=20
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import benchmark_utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.strip().split('\n\n', 1)[1])
+    parser.add_argument('--num_workers', default='2',
+                        help='Comma separated numbers of workers (including '
+                             'the chief); one cluster is run per value.')
+    parser.add_argument('--num_ps', type=int, default=1,
+                        help='Number of parameter server processes.')
+    parser.add_argument('--run_dir', required=True,
+                        help='Directory for the output directories, metrics '
+                             'and logs of all runs.')
+    parser.add_argument('--output_file', default=None,
+                        help='Where to write the JSON report (default: stdout).')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='Training script and its flags, after "--".')
+    args = parser.parse_args()
+    if args.command and args.command[0] == '--':
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error('the training script is missing')
+    if args.num_ps < 1:
+        parser.error('--num_ps must be at least 1')
+    return args
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def cluster_spec(num_workers, num_ps):
+    def addresses(n):
+        return ['localhost:%d' % free_port() for _ in range(n)]
+
+    cluster = {'chief': addresses(1), 'ps': addresses(num_ps)}
+    if num_workers > 1:
+        cluster['worker'] = addresses(num_workers - 1)
+    return cluster
+
+
+def run_cluster(num_workers, num_ps, command, output_dir):
+    """Runs one training cluster and returns the metrics file prefix."""
+    os.makedirs(output_dir, exist_ok=True)
+    metrics_file = os.path.join(output_dir, 'metrics.jsonl')
+    cluster = cluster_spec(num_workers, num_ps)
+    argv = [sys.executable] + command + [
+        '--output_dir=%s' % output_dir, '--metrics_file=%s' % metrics_file]
+
+    processes = {}
+    for task_type in ('ps', 'chief', 'worker'):
+        for index in range(len(cluster.get(task_type, []))):
+            tf_config = {'cluster': cluster,
+                         'task': {'type': task_type, 'index': index}}
+            env = dict(os.environ, TF_CONFIG=json.dumps(tf_config))
+            log_file = os.path.join(output_dir,
+                                    'log-%s-%d.txt' % (task_type, index))
+            with open(log_file, 'w') as log:
+                processes[(task_type, index)] = (subprocess.Popen(
+                    argv, env=env, stdout=log, stderr=subprocess.STDOUT),
+                    log_file)
+
+    failed = []
+    try:
+        for (task, (process, log_file)) in sorted(processes.items()):
+            if task[0] != 'ps' and process.wait() != 0:
+                failed.append(log_file)
+    finally:
+        # Parameter servers never exit on their own.
+        for (process, _) in processes.values():
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+    if failed:
+        raise RuntimeError('Training failed, see %s' % ', '.join(failed))
+    return metrics_file
+
+
+def worker_throughput(metrics_file):
+    """Mean examples/sec of one worker, skipping the first (warm-up) record."""
+    records = []
+    with open(metrics_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['kind'] == 'step':
+                records.append(record['examples_per_sec'])
+    if len(records) > 1:
+        records = records[1:]
+    return sum(records) / len(records) if records else 0.0
+
+
+def main():
+    args = parse_args()
+    sizes = [int(n) for n in args.num_workers.split(',') if n]
+
+    results = []
+    for num_workers in sizes:
+        output_dir = os.path.join(args.run_dir, 'workers-%d' % num_workers)
+        metrics_file = run_cluster(num_workers, args.num_ps, args.command,
+                                   output_dir)
+        root, ext = os.path.splitext(metrics_file)
+        per_worker = [worker_throughput('%s-chief-0%s' % (root, ext))]
+        per_worker += [worker_throughput('%s-worker-%d%s' % (root, i, ext))
+                       for i in range(num_workers - 1)]
+        results.append({
+            'num_workers': num_workers,
+            'output_dir': output_dir,
+            'worker_examples_per_sec': per_worker,
+            'cluster_examples_per_sec': sum(per_worker),
+        })
+
+    smallest = min(results, key=lambda r: r['num_workers'])
+    baseline = smallest['cluster_examples_per_sec'] / smallest['num_workers']
+    for result in results:
+        ideal = baseline * result['num_workers']
+        result['scaling_efficiency'] = (
+            result['cluster_examples_per_sec'] / ideal if ideal else None)
+
+    params = {k: v for k, v in vars(args).items() if k != 'output_file'}
+    report = benchmark_utils.make_report('distributed_scaling', results, params)
+    benchmark_utils.write_report(report, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# coding=utf-8
+"""Step-time and throughput instrumentation for the Estimator training loops.
+
+`StepMetricsHook` records examples/sec, tokens/sec (non-padding tokens) and
+splits every step into time spent waiting for the input pipeline and time
+spent computing. In multi-worker training it also estimates the throughput of
+the whole cluster from the rate at which the shared global step advances.
+`CheckpointTimingListener` records how long checkpoint saves take. Both write
+through a `MetricsWriter`, which appends records to a JSONL or CSV file and
+mirrors them to TensorBoard summaries.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+import tensorflow as tf
+
+
+class MetricsWriter(object):
+  """Writes metric records to a JSONL/CSV file and to TensorBoard."""
+
+  def __init__(self, metrics_file, summary_dir=None, tag_prefix="perf"):
+    """Constructs a MetricsWriter.
+
+    Args:
+      metrics_file: Path of the output file. Records are written as CSV if the
+        path ends with ".csv" and as JSON lines otherwise.
+      summary_dir: (Optional) directory for TensorBoard summaries, usually the
+        model directory.
+      tag_prefix: Prefix of the TensorBoard summary tags.
+    """
+    self.metrics_file = metrics_file
+    self.summary_dir = summary_dir
+    self.tag_prefix = tag_prefix
+    self._is_csv = metrics_file.endswith(".csv")
+    self._csv_fields = {}
+
+  def write(self, kind, record, global_step):
+    """Appends `record` (a flat dict of numbers) of the given `kind`."""
+    record = dict(record)
+    record["kind"] = kind
+    record["global_step"] = int(global_step)
+    record["time"] = time.time()
+
+    with tf.gfile.GFile(self.metrics_file, "a") as writer:
+      if self._is_csv:
+        # Each kind of record has its own columns, so the header is repeated
+        # whenever a new kind starts.
+        if kind not in self._csv_fields:
+          self._csv_fields[kind] = sorted(record.keys())
+          writer.write(",".join(self._csv_fields[kind]) + "\n")
+        row = [str(record.get(k, "")) for k in self._csv_fields[kind]]
+        writer.write(",".join(row) + "\n")
+      else:
+        writer.write(json.dumps(record, sort_keys=True) + "\n")
+
+    if self.summary_dir:
+      values = [
+          tf.Summary.Value(
+              tag="%s/%s" % (self.tag_prefix, k), simple_value=float(v))
+          for (k, v) in sorted(record.items())
+          if k not in ("kind", "global_step", "time")
+      ]
+      summary_writer = tf.summary.FileWriterCache.get(self.summary_dir)
+      summary_writer.add_summary(tf.Summary(value=values), global_step)
+      summary_writer.flush()
+
+
+def create_input_ready_timestamp(features):
+  """Returns a scalar tensor holding the time at which `features` were ready.
+
+  The timestamp op only depends on the input tensors, so it runs as soon as the
+  input pipeline has produced the batch and before the model consumes it.
+  """
+  with tf.control_dependencies(
+      [t for t in features.values() if isinstance(t, tf.Tensor)]):
+    return tf.timestamp()
+
+
+class StepMetricsHook(tf.train.SessionRunHook):
+  """Records throughput and input wait vs. compute time of training steps."""
+
+  def __init__(self, metrics_writer, num_examples, num_tokens,
+               input_ready_time, every_n_steps=100, num_workers=1,
+               worker_index=0):
+    """Constructs a StepMetricsHook.
+
+    Args:
+      metrics_writer: `MetricsWriter` used to emit the records.
+      num_examples: int scalar Tensor. Number of examples in the batch.
+      num_tokens: int scalar Tensor. Number of non-padding tokens in the batch.
+      input_ready_time: Tensor from `create_input_ready_timestamp`.
+      every_n_steps: Number of steps aggregated into one record.
+      num_workers: Number of workers (including the chief) that train in
+        parallel and advance the same global step.
+      worker_index: Index of this worker, 0 for the chief.
+    """
+    self._writer = metrics_writer
+    self._every_n_steps = every_n_steps
+    self._num_workers = num_workers
+    self._worker_index = worker_index
+    self._fetches = {
+        "examples": num_examples,
+        "tokens": num_tokens,
+        "input_ready_time": input_ready_time,
+    }
+
+  def begin(self):
+    self._global_step_tensor = tf.train.get_global_step()
+    self._reset()
+
+  def _reset(self):
+    self._steps = 0
+    self._examples = 0
+    self._tokens = 0
+    self._input_wait = 0.0
+    self._compute = 0.0
+    self._first_global_step = None
+    self._first_step_end = None
+
+  def before_run(self, run_context):
+    self._step_start = time.time()
+    fetches = dict(self._fetches)
+    fetches["global_step"] = self._global_step_tensor
+    return tf.train.SessionRunArgs(fetches)
+
+  def after_run(self, run_context, run_values):
+    step_end = time.time()
+    results = run_values.results
+    input_ready = results["input_ready_time"]
+    self._steps += 1
+    self._examples += int(results["examples"])
+    self._tokens += int(results["tokens"])
+    self._input_wait += max(0.0, input_ready - self._step_start)
+    self._compute += max(0.0, step_end - input_ready)
+    if self._first_global_step is None:
+      self._first_global_step = results["global_step"]
+      self._first_step_end = step_end
+    self._last_global_step = results["global_step"]
+    self._last_step_end = step_end
+
+    if self._steps >= self._every_n_steps:
+      self._emit(results["global_step"])
+
+  def end(self, session):
+    if self._steps:
+      self._emit(session.run(self._global_step_tensor))
+
+  def _emit(self, global_step):
+    total = self._input_wait + self._compute
+    record = {
+        "steps": self._steps,
+        "step_time_sec": total / self._steps,
+        "examples_per_sec": self._examples / total if total else 0.0,
+        "tokens_per_sec": self._tokens / total if total else 0.0,
+        "input_wait_sec": self._input_wait / self._steps,
+        "compute_sec": self._compute / self._steps,
+        "input_wait_fraction": self._input_wait / total if total else 0.0,
+    }
+    if self._num_workers > 1:
+      # Every worker advances the shared global step, so its rate times the
+      # examples per step of this worker estimates the cluster throughput.
+      elapsed = self._last_step_end - self._first_step_end
+      global_steps = self._last_global_step - self._first_global_step
+      global_steps_per_sec = global_steps / elapsed if elapsed > 0 else 0.0
+      record.update({
+          "num_workers": self._num_workers,
+          "worker_index": self._worker_index,
+          "global_steps_per_sec": global_steps_per_sec,
+          "cluster_examples_per_sec":
+              global_steps_per_sec * self._examples / self._steps,
+      })
+    tf.logging.info(
+        "step %d: %.1f examples/sec, %.1f tokens/sec, input wait %.1f%%",
+        global_step, record["examples_per_sec"], record["tokens_per_sec"],
+        100.0 * record["input_wait_fraction"])
+    self._writer.write("step", record, global_step)
+    self._reset()
+
+
+class CheckpointTimingListener(tf.train.CheckpointSaverListener):
+  """Records how long each checkpoint save takes."""
+
+  def __init__(self, metrics_writer):
+    self._writer = metrics_writer
+
+  def before_save(self, session, global_step_value):
+    self._save_start = time.time()
+
+  def after_save(self, session, global_step_value):
+    seconds = time.time() - self._save_start
+    tf.logging.info("Saved checkpoint for step %d in %.2f sec",
+                    global_step_value, seconds)
+    self._writer.write("checkpoint", {"checkpoint_save_sec": seconds},
+                       global_step_value)
+
+
+def create_training_hooks(metrics_writer, features, every_n_steps,
+                          num_workers=1, worker_index=0):
+  """Builds the `StepMetricsHook` for a model_fn from its input features."""
+  input_ready_time = create_input_ready_timestamp(features)
+  if "sequence_ids" in features:
+    # Packed rows hold as many examples as their largest sequence id.
+    num_examples = tf.reduce_sum(tf.reduce_max(features["sequence_ids"], axis=1))
+  else:
+    num_examples = tf.shape(features["input_ids"])[0]
+  return [
+      StepMetricsHook(
+          metrics_writer,
+          num_examples=num_examples,
+          num_tokens=tf.reduce_sum(features["input_mask"]),
+          input_ready_time=input_ready_time,
+          every_n_steps=every_n_steps,
+          num_workers=num_workers,
+          worker_index=worker_index)
+  ]
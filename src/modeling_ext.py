@@ -0,0 +1,689 @@
+# coding=utf-8
+# This file extends https://github.com/google-research/bert/blob/master/modeling.py.
+# Variable names are the same as in `modeling.BertModel`, so checkpoints are
+# interchangeable between the two.
+"""BERT model with packed sequences, mixed precision, recomputation and
+layer freezing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import functools
+import math
+import modeling
+import re
+import tensorflow as tf
+import utils
+
+PRECISIONS = utils.PRECISIONS
+
+
+class BertModel(modeling.BertModel):
+  """`modeling.BertModel` that also accepts packed sequences.
+
+  When `sequence_ids` is given, every row of `input_ids` may hold several
+  examples (see packing.py). Tokens only attend to tokens of the same example,
+  `position_ids` restart for every example and `pooled_positions` selects the
+  [CLS] token of every example for the pooled output.
+
+  With a `compute_type` other than float32 the transformer layers run in that
+  type while the variables are kept in float32 (see
+  `float32_variable_storage_getter`). Embeddings, layer normalization,
+  attention softmax and the pooler run in float32, and all outputs are
+  float32.
+
+  With `num_recomputed_layers` the activations inside the first transformer
+  layers are not kept for the backward pass but recomputed from the layer
+  input, trading extra compute for activation memory during training.
+
+  With `num_frozen_layers` no gradients flow into the embeddings and the
+  first transformer layers; see `freeze_variables` to also exclude their
+  variables from training.
+  """
+
+  def __init__(self,
+               config,
+               is_training,
+               input_ids,
+               input_mask=None,
+               token_type_ids=None,
+               use_one_hot_embeddings=False,
+               scope=None,
+               position_ids=None,
+               sequence_ids=None,
+               pooled_positions=None,
+               compute_type=tf.float32,
+               num_recomputed_layers=0,
+               num_frozen_layers=0):
+    """Constructor for BertModel.
+
+    Args:
+      config: `BertConfig` instance.
+      is_training: bool. true for training model, false for eval model. Controls
+        whether dropout will be applied.
+      input_ids: int32 Tensor of shape [batch_size, seq_length].
+      input_mask: (optional) int32 Tensor of shape [batch_size, seq_length].
+      token_type_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+      use_one_hot_embeddings: (optional) bool. Whether to use one-hot word
+        embeddings or tf.embedding_lookup() for the word embeddings.
+      scope: (optional) variable scope. Defaults to "bert".
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        Position of every token within its own example. Defaults to
+        0..seq_length-1 for every row.
+      sequence_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        1-based index of the packed example every token belongs to, 0 for
+        padding. When given it replaces `input_mask` for the attention mask.
+      pooled_positions: (optional) int32 Tensor of shape
+        [batch_size, max_sequences_per_pack]. Positions of the tokens fed to
+        the pooler. The pooled output then has shape
+        [batch_size * max_sequences_per_pack, hidden_size].
+      compute_type: (optional) tf.float32, tf.float16 or tf.bfloat16. Type of
+        the activations and matmuls of the transformer layers.
+      num_recomputed_layers: (optional) int. Number of transformer layers,
+        counted from the bottom, whose activations are recomputed in the
+        backward pass. Only used if `is_training` is true.
+      num_frozen_layers: (optional) int. Number of transformer layers, counted
+        from the bottom, that get no gradients, along with the embeddings.
+
+    Raises:
+      ValueError: The config is invalid or one of the input tensor shapes
+        is invalid.
+    """
+    config = copy.deepcopy(config)
+    if not is_training:
+      config.hidden_dropout_prob = 0.0
+      config.attention_probs_dropout_prob = 0.0
+
+    input_shape = modeling.get_shape_list(input_ids, expected_rank=2)
+    batch_size = input_shape[0]
+    seq_length = input_shape[1]
+
+    if input_mask is None:
+      input_mask = tf.ones(shape=[batch_size, seq_length], dtype=tf.int32)
+
+    if token_type_ids is None:
+      token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
+
+    with tf.variable_scope(scope, default_name="bert",
+                           custom_getter=get_custom_getter(compute_type)):
+      with tf.variable_scope("embeddings"):
+        # Perform embedding lookup on the word ids.
+        (self.embedding_output, self.embedding_table) = modeling.embedding_lookup(
+            input_ids=input_ids,
+            vocab_size=config.vocab_size,
+            embedding_size=config.hidden_size,
+            initializer_range=config.initializer_range,
+            word_embedding_name="word_embeddings",
+            use_one_hot_embeddings=use_one_hot_embeddings)
+
+        # Add positional embeddings and token type embeddings, then layer
+        # normalize and perform dropout.
+        self.embedding_output = embedding_postprocessor(
+            input_tensor=self.embedding_output,
+            token_type_ids=token_type_ids,
+            token_type_vocab_size=config.type_vocab_size,
+            position_ids=position_ids,
+            initializer_range=config.initializer_range,
+            max_position_embeddings=config.max_position_embeddings,
+            dropout_prob=config.hidden_dropout_prob)
+
+      with tf.variable_scope("encoder"):
+        if sequence_ids is not None:
+          attention_mask = create_packed_attention_mask(sequence_ids)
+        else:
+          attention_mask = modeling.create_attention_mask_from_input_mask(
+              input_ids, input_mask)
+
+        self.all_encoder_layers = transformer_model(
+            input_tensor=tf.cast(self.embedding_output, compute_type),
+            attention_mask=attention_mask,
+            hidden_size=config.hidden_size,
+            num_hidden_layers=config.num_hidden_layers,
+            num_attention_heads=config.num_attention_heads,
+            intermediate_size=config.intermediate_size,
+            intermediate_act_fn=modeling.get_activation(config.hidden_act),
+            hidden_dropout_prob=config.hidden_dropout_prob,
+            attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+            initializer_range=config.initializer_range,
+            do_return_all_layers=True,
+            num_recomputed_layers=(
+                num_recomputed_layers if is_training else 0),
+            num_frozen_layers=num_frozen_layers)
+        self.all_encoder_layers = [
+            tf.cast(layer_output, tf.float32)
+            for layer_output in self.all_encoder_layers
+        ]
+
+      self.sequence_output = self.all_encoder_layers[-1]
+      # The "pooler" converts the encoded sequence tensor of shape
+      # [batch_size, seq_length, hidden_size] to a tensor of shape
+      # [batch_size, hidden_size]. In packed mode it pools the [CLS] token of
+      # every example instead of only the first token of every row.
+      with tf.variable_scope("pooler"):
+        if pooled_positions is not None:
+          first_token_tensor = gather_indexes(self.sequence_output,
+                                              pooled_positions)
+        else:
+          first_token_tensor = tf.squeeze(
+              self.sequence_output[:, 0:1, :], axis=1)
+        self.pooled_output = tf.layers.dense(
+            first_token_tensor,
+            config.hidden_size,
+            activation=tf.tanh,
+            kernel_initializer=modeling.create_initializer(
+                config.initializer_range))
+
+
+def embedding_postprocessor(input_tensor,
+                            token_type_ids,
+                            token_type_vocab_size=16,
+                            position_ids=None,
+                            initializer_range=0.02,
+                            max_position_embeddings=512,
+                            dropout_prob=0.1):
+  """Adds token type and position embeddings to a word embedding tensor.
+
+  Same as `modeling.embedding_postprocessor` with both embeddings enabled,
+  except that positions can be given per token with `position_ids`.
+  """
+  input_shape = modeling.get_shape_list(input_tensor, expected_rank=3)
+  batch_size = input_shape[0]
+  seq_length = input_shape[1]
+  width = input_shape[2]
+
+  output = input_tensor
+
+  token_type_table = tf.get_variable(
+      name="token_type_embeddings",
+      shape=[token_type_vocab_size, width],
+      initializer=modeling.create_initializer(initializer_range))
+  # This vocab will be small so we always do one-hot here, since it is always
+  # faster for a small vocabulary.
+  flat_token_type_ids = tf.reshape(token_type_ids, [-1])
+  one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
+  token_type_embeddings = tf.matmul(one_hot_ids, token_type_table)
+  token_type_embeddings = tf.reshape(token_type_embeddings,
+                                     [batch_size, seq_length, width])
+  output += token_type_embeddings
+
+  assert_op = tf.assert_less_equal(seq_length, max_position_embeddings)
+  with tf.control_dependencies([assert_op]):
+    full_position_embeddings = tf.get_variable(
+        name="position_embeddings",
+        shape=[max_position_embeddings, width],
+        initializer=modeling.create_initializer(initializer_range))
+    if position_ids is None:
+      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                     [seq_length, -1])
+      output += tf.reshape(position_embeddings, [1, seq_length, width])
+    else:
+      output += tf.gather(full_position_embeddings, position_ids)
+
+  output = modeling.layer_norm_and_dropout(output, dropout_prob)
+  return output
+
+
+def create_packed_attention_mask(sequence_ids):
+  """Creates a block-diagonal 3D attention mask from packed `sequence_ids`.
+
+  Args:
+    sequence_ids: int32 Tensor of shape [batch_size, seq_length]. 1-based index
+      of the example every token belongs to, 0 for padding.
+
+  Returns:
+    float Tensor of shape [batch_size, seq_length, seq_length], 1.0 where the
+    from-token and the to-token belong to the same example.
+  """
+  from_ids = tf.expand_dims(sequence_ids, axis=2)
+  to_ids = tf.expand_dims(sequence_ids, axis=1)
+  mask = tf.logical_and(tf.equal(from_ids, to_ids), tf.greater(to_ids, 0))
+  return tf.cast(mask, tf.float32)
+
+
+def gather_indexes(sequence_tensor, positions):
+  """Gathers the vectors at the specific positions over a minibatch."""
+  sequence_shape = modeling.get_shape_list(sequence_tensor, expected_rank=3)
+  batch_size = sequence_shape[0]
+  seq_length = sequence_shape[1]
+  width = sequence_shape[2]
+
+  flat_offsets = tf.reshape(
+      tf.range(0, batch_size, dtype=tf.int32) * seq_length, [-1, 1])
+  flat_positions = tf.reshape(positions + flat_offsets, [-1])
+  flat_sequence_tensor = tf.reshape(sequence_tensor,
+                                    [batch_size * seq_length, width])
+  output_tensor = tf.gather(flat_sequence_tensor, flat_positions)
+  return output_tensor
+
+
+def get_compute_type(precision):
+  """Maps a `--precision` flag value to a TensorFlow dtype."""
+  if precision not in PRECISIONS:
+    raise ValueError("Unsupported precision: %s" % precision)
+  return tf.as_dtype(precision)
+
+
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None,
+                                    initializer=None, regularizer=None,
+                                    trainable=True, *args, **kwargs):
+  """Custom getter that keeps trainable variables in float32.
+
+  Variables requested in a lower precision are created in float32 (the
+  "master weights" seen by the optimizer and stored in checkpoints) and cast
+  to the requested type, so gradients also arrive in float32.
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, dtype=storage_dtype,
+                    initializer=initializer, regularizer=regularizer,
+                    trainable=trainable, *args, **kwargs)
+  if trainable and dtype is not None and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+
+def get_custom_getter(compute_type):
+  """Returns the variable scope custom getter for `compute_type`, if any."""
+  if compute_type == tf.float32:
+    return None
+  return float32_variable_storage_getter
+
+
+def is_frozen_variable(name, num_frozen_layers):
+  """Whether a variable belongs to the embeddings or the first layers."""
+  if num_frozen_layers <= 0:
+    return False
+  if "/embeddings/" in name:
+    return True
+  match = re.search(r"/encoder/layer_(\d+)/", name)
+  return match is not None and int(match.group(1)) < num_frozen_layers
+
+
+def freeze_variables(num_frozen_layers):
+  """Removes the embeddings and the first layers from the trainable variables.
+
+  Call after building a `BertModel` with the same `num_frozen_layers` and
+  before creating the optimizer, which then creates no slots for them. They
+  are still saved in checkpoints.
+
+  Returns:
+    The list of frozen variables.
+  """
+  trainable_variables = tf.get_collection_ref(
+      tf.GraphKeys.TRAINABLE_VARIABLES)
+  frozen = []
+  trainable = []
+  for var in trainable_variables:
+    if is_frozen_variable(var.name, num_frozen_layers):
+      frozen.append(var)
+    else:
+      trainable.append(var)
+  trainable_variables[:] = trainable
+  return frozen
+
+
+def layer_norm(input_tensor, name=None):
+  """Runs layer normalization in float32 and casts back to the input type."""
+  output = modeling.layer_norm(tf.cast(input_tensor, tf.float32), name=name)
+  return tf.cast(output, input_tensor.dtype)
+
+
+def attention_layer(from_tensor,
+                    to_tensor,
+                    attention_mask=None,
+                    num_attention_heads=1,
+                    size_per_head=512,
+                    query_act=None,
+                    key_act=None,
+                    value_act=None,
+                    attention_probs_dropout_prob=0.0,
+                    initializer_range=0.02,
+                    batch_size=None,
+                    from_seq_length=None,
+                    to_seq_length=None,
+                    dropout_seed=None):
+  """Multi-headed attention on 2D tensors, as `modeling.attention_layer`.
+
+  Works in the type of `from_tensor` except for the attention mask and the
+  softmax, which are computed in float32.
+
+  Args:
+    from_tensor: Tensor of shape [batch_size * from_seq_length, from_width].
+    to_tensor: Tensor of shape [batch_size * to_seq_length, to_width].
+    attention_mask: (optional) Tensor of shape
+      [batch_size, from_seq_length, to_seq_length] with 1 for positions that
+      can be attended to and 0 elsewhere.
+    num_attention_heads: int. Number of attention heads.
+    size_per_head: int. Size of each attention head.
+    query_act: (optional) Activation function for the query transform.
+    key_act: (optional) Activation function for the key transform.
+    value_act: (optional) Activation function for the value transform.
+    attention_probs_dropout_prob: (optional) float. Dropout probability of the
+      attention probabilities.
+    initializer_range: float. Range of the weight initializer.
+    batch_size: int. Batch size of the input.
+    from_seq_length: int. Length of the sequences in `from_tensor`.
+    to_seq_length: int. Length of the sequences in `to_tensor`.
+    dropout_seed: (optional) int64 Tensor of shape [2]. Seed of the attention
+      dropout, see `dropout`.
+
+  Returns:
+    Tensor of shape [batch_size * from_seq_length,
+      num_attention_heads * size_per_head].
+  """
+
+  def transpose_for_scores(input_tensor, batch_size, num_attention_heads,
+                           seq_length, width):
+    output_tensor = tf.reshape(
+        input_tensor, [batch_size, seq_length, num_attention_heads, width])
+
+    output_tensor = tf.transpose(output_tensor, [0, 2, 1, 3])
+    return output_tensor
+
+  # `query_layer` = [B*F, N*H]
+  query_layer = tf.layers.dense(
+      from_tensor,
+      num_attention_heads * size_per_head,
+      activation=query_act,
+      name="query",
+      kernel_initializer=modeling.create_initializer(initializer_range))
+
+  # `key_layer` = [B*T, N*H]
+  key_layer = tf.layers.dense(
+      to_tensor,
+      num_attention_heads * size_per_head,
+      activation=key_act,
+      name="key",
+      kernel_initializer=modeling.create_initializer(initializer_range))
+
+  # `value_layer` = [B*T, N*H]
+  value_layer = tf.layers.dense(
+      to_tensor,
+      num_attention_heads * size_per_head,
+      activation=value_act,
+      name="value",
+      kernel_initializer=modeling.create_initializer(initializer_range))
+
+  # `query_layer` = [B, N, F, H]
+  query_layer = transpose_for_scores(query_layer, batch_size,
+                                     num_attention_heads, from_seq_length,
+                                     size_per_head)
+
+  # `key_layer` = [B, N, T, H]
+  key_layer = transpose_for_scores(key_layer, batch_size, num_attention_heads,
+                                   to_seq_length, size_per_head)
+
+  # Take the dot product between "query" and "key" to get the raw
+  # attention scores. The softmax runs in float32: the -10000.0 mask offset
+  # and the exponentials do not fit in float16.
+  # `attention_scores` = [B, N, F, T]
+  attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
+  attention_scores = tf.multiply(tf.cast(attention_scores, tf.float32),
+                                 1.0 / math.sqrt(float(size_per_head)))
+
+  if attention_mask is not None:
+    # `attention_mask` = [B, 1, F, T]
+    attention_mask = tf.expand_dims(attention_mask, axis=[1])
+
+    adder = (1.0 - tf.cast(attention_mask, tf.float32)) * -10000.0
+
+    attention_scores += adder
+
+  # `attention_probs` = [B, N, F, T]
+  attention_probs = tf.nn.softmax(attention_scores)
+  attention_probs = tf.cast(attention_probs, from_tensor.dtype)
+
+  # This is actually dropping out entire tokens to attend to, which might
+  # seem a bit unusual, but is taken from the original Transformer paper.
+  attention_probs = dropout(attention_probs, attention_probs_dropout_prob,
+                            seed=dropout_seed)
+
+  # `value_layer` = [B, T, N, H]
+  value_layer = tf.reshape(
+      value_layer,
+      [batch_size, to_seq_length, num_attention_heads, size_per_head])
+
+  # `value_layer` = [B, N, T, H]
+  value_layer = tf.transpose(value_layer, [0, 2, 1, 3])
+
+  # `context_layer` = [B, N, F, H]
+  context_layer = tf.matmul(attention_probs, value_layer)
+
+  # `context_layer` = [B, F, N, H]
+  context_layer = tf.transpose(context_layer, [0, 2, 1, 3])
+
+  # `context_layer` = [B*F, N*H]
+  context_layer = tf.reshape(
+      context_layer,
+      [batch_size * from_seq_length, num_attention_heads * size_per_head])
+
+  return context_layer
+
+
+def transformer_model(input_tensor,
+                      attention_mask=None,
+                      hidden_size=768,
+                      num_hidden_layers=12,
+                      num_attention_heads=12,
+                      intermediate_size=3072,
+                      intermediate_act_fn=modeling.gelu,
+                      hidden_dropout_prob=0.1,
+                      attention_probs_dropout_prob=0.1,
+                      initializer_range=0.02,
+                      do_return_all_layers=False,
+                      num_recomputed_layers=0,
+                      num_frozen_layers=0):
+  """Multi-headed, multi-layer Transformer, as `modeling.transformer_model`.
+
+  Works in the type of `input_tensor`, with layer normalization and attention
+  softmax in float32. Variable names are those of `modeling.transformer_model`.
+
+  Args:
+    input_tensor: float Tensor of shape [batch_size, seq_length, hidden_size].
+    attention_mask: (optional) Tensor of shape
+      [batch_size, seq_length, seq_length] with 1 for positions that can be
+      attended to and 0 elsewhere.
+    hidden_size: int. Hidden size of the Transformer.
+    num_hidden_layers: int. Number of layers (blocks) in the Transformer.
+    num_attention_heads: int. Number of attention heads in the Transformer.
+    intermediate_size: int. The size of the "intermediate" (a.k.a., feed
+      forward) layer.
+    intermediate_act_fn: function. The non-linear activation function to apply
+      to the output of the intermediate/feed-forward layer.
+    hidden_dropout_prob: float. Dropout probability for the hidden layers.
+    attention_probs_dropout_prob: float. Dropout probability of the attention
+      probabilities.
+    initializer_range: float. Range of the initializer (stddev of truncated
+      normal).
+    do_return_all_layers: Whether to also return all layers or just the final
+      layer.
+    num_recomputed_layers: int. Number of layers, counted from the bottom,
+      that are wrapped in `tf.contrib.layers.recompute_grad`. Only the inputs
+      of those layers are kept for the backward pass; everything else is
+      recomputed.
+    num_frozen_layers: int. Number of layers, counted from the bottom, through
+      which no gradients flow back. The backward pass stops above them.
+
+  Returns:
+    Tensor of shape [batch_size, seq_length, hidden_size], the final hidden
+    layer of the Transformer, or a list of such tensors for all layers.
+
+  Raises:
+    ValueError: A Tensor shape or parameter is invalid.
+  """
+  if hidden_size % num_attention_heads != 0:
+    raise ValueError(
+        "The hidden size (%d) is not a multiple of the number of attention "
+        "heads (%d)" % (hidden_size, num_attention_heads))
+
+  input_shape = modeling.get_shape_list(input_tensor, expected_rank=3)
+  batch_size = input_shape[0]
+  seq_length = input_shape[1]
+  input_width = input_shape[2]
+
+  # The Transformer performs sum residuals on all layers so the input needs
+  # to be the same as the hidden size.
+  if input_width != hidden_size:
+    raise ValueError("The width of the input tensor (%d) != hidden size (%d)" %
+                     (input_width, hidden_size))
+
+  # We keep the representation as a 2D tensor to avoid re-shaping it back and
+  # forth from a 3D tensor to a 2D tensor.
+  prev_output = modeling.reshape_to_matrix(input_tensor)
+
+  layer_fn = functools.partial(
+      transformer_layer,
+      attention_mask=attention_mask,
+      hidden_size=hidden_size,
+      num_attention_heads=num_attention_heads,
+      intermediate_size=intermediate_size,
+      intermediate_act_fn=intermediate_act_fn,
+      hidden_dropout_prob=hidden_dropout_prob,
+      attention_probs_dropout_prob=attention_probs_dropout_prob,
+      initializer_range=initializer_range,
+      batch_size=batch_size,
+      seq_length=seq_length)
+
+  all_layer_outputs = []
+  for layer_idx in range(num_hidden_layers):
+    if layer_idx < num_recomputed_layers:
+      # The recomputation has to reproduce the dropout masks of the forward
+      # pass, so the layer uses stateless dropout seeded from a tensor that
+      # is computed outside of the recomputed function. `recompute_grad`
+      # requires resource variables; they are stored in checkpoints under the
+      # same names.
+      dropout_seed = tf.random_uniform(
+          [2], maxval=tf.int64.max, dtype=tf.int64)
+      recomputed_layer_fn = tf.contrib.layers.recompute_grad(
+          functools.partial(layer_fn, dropout_seed=dropout_seed))
+      with tf.variable_scope("layer_%d" % layer_idx, use_resource=True):
+        prev_output = recomputed_layer_fn(prev_output)
+    else:
+      with tf.variable_scope("layer_%d" % layer_idx):
+        prev_output = layer_fn(prev_output)
+    if layer_idx == num_frozen_layers - 1:
+      prev_output = tf.stop_gradient(prev_output)
+    all_layer_outputs.append(prev_output)
+
+  if do_return_all_layers:
+    final_outputs = []
+    for layer_output in all_layer_outputs:
+      final_output = modeling.reshape_from_matrix(layer_output, input_shape)
+      final_outputs.append(final_output)
+    return final_outputs
+  else:
+    final_output = modeling.reshape_from_matrix(prev_output, input_shape)
+    return final_output
+
+
+def transformer_layer(layer_input,
+                      attention_mask=None,
+                      hidden_size=768,
+                      num_attention_heads=12,
+                      intermediate_size=3072,
+                      intermediate_act_fn=modeling.gelu,
+                      hidden_dropout_prob=0.1,
+                      attention_probs_dropout_prob=0.1,
+                      initializer_range=0.02,
+                      batch_size=None,
+                      seq_length=None,
+                      dropout_seed=None):
+  """One Transformer block of `transformer_model` on a 2D tensor.
+
+  Args:
+    layer_input: Tensor of shape [batch_size * seq_length, hidden_size].
+    attention_mask: (optional) Tensor of shape
+      [batch_size, seq_length, seq_length].
+    hidden_size: int. Hidden size of the Transformer.
+    num_attention_heads: int. Number of attention heads.
+    intermediate_size: int. The size of the feed forward layer.
+    intermediate_act_fn: function. Activation of the feed forward layer.
+    hidden_dropout_prob: float. Dropout probability for the hidden layers.
+    attention_probs_dropout_prob: float. Dropout probability of the attention
+      probabilities.
+    initializer_range: float. Range of the weight initializer.
+    batch_size: int. Batch size of the input.
+    seq_length: int. Sequence length of the input.
+    dropout_seed: (optional) int64 Tensor of shape [2]. If given, all dropout
+      masks of the block are derived from it, see `dropout`.
+
+  Returns:
+    Tensor of shape [batch_size * seq_length, hidden_size].
+  """
+
+  def site_seed(site):
+    if dropout_seed is None:
+      return None
+    return dropout_seed + tf.constant([0, site], dtype=tf.int64)
+
+  with tf.variable_scope("attention"):
+    with tf.variable_scope("self"):
+      attention_output = attention_layer(
+          from_tensor=layer_input,
+          to_tensor=layer_input,
+          attention_mask=attention_mask,
+          num_attention_heads=num_attention_heads,
+          size_per_head=int(hidden_size / num_attention_heads),
+          attention_probs_dropout_prob=attention_probs_dropout_prob,
+          initializer_range=initializer_range,
+          batch_size=batch_size,
+          from_seq_length=seq_length,
+          to_seq_length=seq_length,
+          dropout_seed=site_seed(0))
+
+    # Run a linear projection of `hidden_size` then add a residual
+    # with `layer_input`.
+    with tf.variable_scope("output"):
+      attention_output = tf.layers.dense(
+          attention_output,
+          hidden_size,
+          kernel_initializer=modeling.create_initializer(initializer_range))
+      attention_output = dropout(attention_output, hidden_dropout_prob,
+                                 seed=site_seed(1))
+      attention_output = layer_norm(attention_output + layer_input)
+
+  # The activation is only applied to the "intermediate" hidden layer.
+  with tf.variable_scope("intermediate"):
+    intermediate_output = tf.layers.dense(
+        attention_output,
+        intermediate_size,
+        activation=intermediate_act_fn,
+        kernel_initializer=modeling.create_initializer(initializer_range))
+
+  # Down-project back to `hidden_size` then add the residual.
+  with tf.variable_scope("output"):
+    layer_output = tf.layers.dense(
+        intermediate_output,
+        hidden_size,
+        kernel_initializer=modeling.create_initializer(initializer_range))
+    layer_output = dropout(layer_output, hidden_dropout_prob,
+                           seed=site_seed(2))
+    layer_output = layer_norm(layer_output + attention_output)
+  return layer_output
+
+
+def dropout(input_tensor, dropout_prob, seed=None):
+  """Performs dropout, as `modeling.dropout`.
+
+  Args:
+    input_tensor: float Tensor.
+    dropout_prob: Python float. The probability of dropping out a value (NOT of
+      *keeping* a dimension as in `tf.nn.dropout`).
+    seed: (optional) int64 Tensor of shape [2]. If given, the mask is drawn
+      with a stateless random op, so evaluating the function twice with the
+      same seed drops the same values.
+
+  Returns:
+    A version of `input_tensor` with dropout applied.
+  """
+  if dropout_prob is None or dropout_prob == 0.0:
+    return input_tensor
+  if seed is None:
+    return modeling.dropout(input_tensor, dropout_prob)
+
+  keep_prob = 1.0 - dropout_prob
+  random_tensor = tf.contrib.stateless.stateless_random_uniform(
+      tf.shape(input_tensor), seed=seed, dtype=tf.float32)
+  keep_mask = tf.cast(random_tensor < keep_prob, input_tensor.dtype)
+  return input_tensor * keep_mask * (1.0 / keep_prob)
@@ -0,0 +1,275 @@
+# coding=utf-8
+# This file extends https://github.com/google-research/bert/blob/master/optimization.py.
+"""Optimizer with gradient accumulation and loss scaling."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import optimization
+import tensorflow as tf
+
+
+def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
+                     gradient_accumulation_steps=1, loss_scale=None):
+  """Creates an optimizer training op.
+
+  Same as `optimization.create_optimizer` when `gradient_accumulation_steps` is
+  1 and `loss_scale` is None.
+
+  With `gradient_accumulation_steps` > 1, gradients are summed over that many
+  micro-batches and their mean is applied once, so the effective batch size is
+  `gradient_accumulation_steps` times the batch size. The global step still
+  counts micro-batches, so the estimator has to run
+  `num_train_steps * gradient_accumulation_steps` steps. `num_train_steps`
+  and `num_warmup_steps` count optimizer updates, and the learning rate
+  schedule is driven by the number of updates applied so far.
+
+  With `loss_scale`, the loss is multiplied by the loss scale before the
+  gradients are computed, which keeps small float16 gradients from flushing to
+  zero. Gradients are unscaled before they are used. Micro-batches with
+  non-finite gradients are skipped; with dynamic loss scaling they also lower
+  the loss scale.
+
+  Args:
+    loss: float32 scalar Tensor.
+    init_lr: float. Peak learning rate.
+    num_train_steps: int. Number of optimizer updates.
+    num_warmup_steps: int. Number of optimizer updates of linear warmup.
+    use_tpu: bool. Whether the model runs on TPU.
+    gradient_accumulation_steps: int. Number of micro-batches per update.
+    loss_scale: (optional) float. Static loss scale, or 0 for dynamic loss
+      scaling. None disables loss scaling.
+
+  Returns:
+    The training op.
+  """
+  if gradient_accumulation_steps <= 1 and loss_scale is None:
+    return optimization.create_optimizer(loss, init_lr, num_train_steps,
+                                         num_warmup_steps, use_tpu)
+
+  if use_tpu:
+    raise ValueError(
+        "Gradient accumulation and loss scaling are not supported on TPU.")
+
+  global_step = tf.train.get_or_create_global_step()
+  # The global step is read once, and the learning rate, the accumulation
+  # cycle and the increment below all use this value.
+  step = tf.identity(global_step)
+  update_step = tf.floordiv(step, gradient_accumulation_steps)
+
+  learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
+
+  # Implements linear decay of the learning rate.
+  learning_rate = tf.train.polynomial_decay(
+      learning_rate,
+      update_step,
+      num_train_steps,
+      end_learning_rate=0.0,
+      power=1.0,
+      cycle=False)
+
+  # Implements linear warmup. I.e., if update_step < num_warmup_steps, the
+  # learning rate will be `update_step/num_warmup_steps * init_lr`.
+  if num_warmup_steps:
+    update_steps_int = tf.cast(update_step, tf.int32)
+    warmup_steps_int = tf.constant(num_warmup_steps, dtype=tf.int32)
+
+    update_steps_float = tf.cast(update_steps_int, tf.float32)
+    warmup_steps_float = tf.cast(warmup_steps_int, tf.float32)
+
+    warmup_percent_done = update_steps_float / warmup_steps_float
+    warmup_learning_rate = init_lr * warmup_percent_done
+
+    is_warmup = tf.cast(update_steps_int < warmup_steps_int, tf.float32)
+    learning_rate = (
+        (1.0 - is_warmup) * learning_rate + is_warmup * warmup_learning_rate)
+
+  optimizer = AdamWeightDecayOptimizer(
+      learning_rate=learning_rate,
+      weight_decay_rate=0.01,
+      beta_1=0.9,
+      beta_2=0.999,
+      epsilon=1e-6,
+      exclude_from_weight_decay=["LayerNorm", "layer_norm", "bias"])
+
+  tvars = tf.trainable_variables()
+
+  loss_scale_manager = None
+  grads_are_finite = None
+  if loss_scale is None:
+    grads = tf.gradients(loss, tvars)
+  else:
+    loss_scale_manager = create_loss_scale_manager(loss_scale)
+    scale = loss_scale_manager.get_loss_scale()
+    grads = tf.gradients(loss * scale, tvars)
+    grads = [_scale_gradient(grad, 1.0 / scale) for grad in grads]
+    grads_are_finite = _all_finite(grads)
+    tf.summary.scalar("loss_scale", scale)
+
+  train_op = optimizer.accumulate_and_apply(
+      zip(grads, tvars),
+      step,
+      accumulation_steps=gradient_accumulation_steps,
+      grads_are_finite=grads_are_finite)
+
+  update_ops = [train_op]
+  if loss_scale_manager is not None:
+    update_ops.append(loss_scale_manager.update_loss_scale(grads_are_finite))
+
+  with tf.control_dependencies(update_ops):
+    increment_op = global_step.assign(step + 1)
+  return tf.group(increment_op, *update_ops)
+
+
+def create_loss_scale_manager(loss_scale):
+  """Returns a static (`loss_scale` > 0) or dynamic (0) loss scale manager."""
+  if loss_scale > 0:
+    return tf.contrib.mixed_precision.FixedLossScaleManager(loss_scale)
+  return tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+      init_loss_scale=2**15, incr_every_n_steps=2000, decr_every_n_nan_or_inf=1,
+      decr_ratio=0.5)
+
+
+def _scale_gradient(grad, factor):
+  if grad is None:
+    return None
+  if isinstance(grad, tf.IndexedSlices):
+    return tf.IndexedSlices(grad.values * factor, grad.indices,
+                            grad.dense_shape)
+  return grad * factor
+
+
+def _all_finite(grads):
+  """Returns a bool scalar Tensor, whether all gradients are finite."""
+  checks = []
+  for grad in grads:
+    if grad is None:
+      continue
+    if isinstance(grad, tf.IndexedSlices):
+      grad = grad.values
+    checks.append(tf.reduce_all(tf.is_finite(grad)))
+  return tf.reduce_all(tf.stack(checks))
+
+
+class AdamWeightDecayOptimizer(optimization.AdamWeightDecayOptimizer):
+  """`optimization.AdamWeightDecayOptimizer` with gradient accumulation."""
+
+  def accumulate_and_apply(self, grads_and_vars, global_step,
+                           accumulation_steps=1, grads_are_finite=None,
+                           clip_norm=1.0):
+    """Adds the gradients to the accumulators and applies them when due.
+
+    Args:
+      grads_and_vars: iterable of (gradient, variable) pairs.
+      global_step: int64 scalar Tensor. The value of the global step before
+        this micro-batch. The caller increments the global step only after the
+        returned op has run.
+      accumulation_steps: int. Number of micro-batches per update. The update
+        is applied on every `accumulation_steps`-th global step.
+      grads_are_finite: (optional) bool scalar Tensor. If false, the gradients
+        of this micro-batch are dropped.
+      clip_norm: float. The mean gradients are clipped to this global norm
+        before they are applied.
+
+    Returns:
+      An op that accumulates the gradients and, at the end of an accumulation
+      cycle, updates the variables and resets the accumulators.
+    """
+    grads_and_vars = [(grad, param) for (grad, param) in grads_and_vars
+                      if grad is not None and param is not None]
+    grads = [tf.convert_to_tensor(grad) for (grad, _) in grads_and_vars]
+    params = [param for (_, param) in grads_and_vars]
+
+    # Slot variables have to be created outside of `tf.cond`.
+    slots = [self._create_slots(param) for param in params]
+
+    if accumulation_steps <= 1:
+      if grads_are_finite is None:
+        return self._apply_mean_gradients(grads, params, slots, clip_norm)
+      return tf.cond(
+          grads_are_finite,
+          lambda: self._apply_mean_gradients(grads, params, slots, clip_norm),
+          tf.no_op)
+
+    # The accumulators are local variables so that checkpoints stay
+    # compatible with `optimization.create_optimizer`.
+    accumulators = [
+        tf.get_variable(
+            name=self._get_variable_name(param.name) + "/grad_accum",
+            shape=param.shape.as_list(),
+            dtype=tf.float32,
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+            initializer=tf.zeros_initializer()) for param in params
+    ]
+
+    def accumulate_fn():
+      return tf.group(*[
+          accum.assign_add(grad) for (accum, grad) in zip(accumulators, grads)
+      ])
+
+    if grads_are_finite is None:
+      accumulate_op = accumulate_fn()
+    else:
+      accumulate_op = tf.cond(grads_are_finite, accumulate_fn, tf.no_op)
+
+    def apply_fn():
+      mean_grads = [accum / float(accumulation_steps) for accum in accumulators]
+      apply_op = self._apply_mean_gradients(mean_grads, params, slots,
+                                            clip_norm)
+      with tf.control_dependencies([apply_op]):
+        return tf.group(
+            *[accum.assign(tf.zeros_like(accum)) for accum in accumulators])
+
+    is_last_micro_batch = tf.equal(
+        tf.mod(global_step + 1, accumulation_steps), 0)
+    with tf.control_dependencies([accumulate_op]):
+      return tf.cond(is_last_micro_batch, apply_fn, tf.no_op)
+
+  def _create_slots(self, param):
+    param_name = self._get_variable_name(param.name)
+    m = tf.get_variable(
+        name=param_name + "/adam_m",
+        shape=param.shape.as_list(),
+        dtype=tf.float32,
+        trainable=False,
+        initializer=tf.zeros_initializer())
+    v = tf.get_variable(
+        name=param_name + "/adam_v",
+        shape=param.shape.as_list(),
+        dtype=tf.float32,
+        trainable=False,
+        initializer=tf.zeros_initializer())
+    return (m, v)
+
+  def _apply_mean_gradients(self, grads, params, slots, clip_norm):
+    """Clips `grads` and applies one AdamW update, as `apply_gradients`."""
+    (grads, _) = tf.clip_by_global_norm(grads, clip_norm=clip_norm)
+
+    assignments = []
+    for (grad, param, (m, v)) in zip(grads, params, slots):
+      param_name = self._get_variable_name(param.name)
+
+      # Standard Adam update.
+      next_m = (
+          tf.multiply(self.beta_1, m) + tf.multiply(1.0 - self.beta_1, grad))
+      next_v = (
+          tf.multiply(self.beta_2, v) + tf.multiply(1.0 - self.beta_2,
+                                                    tf.square(grad)))
+
+      update = next_m / (tf.sqrt(next_v) + self.epsilon)
+
+      # Decoupled weight decay, see `optimization.AdamWeightDecayOptimizer`.
+      if self._do_use_weight_decay(param_name):
+        update += self.weight_decay_rate * param
+
+      update_with_lr = self.learning_rate * update
+
+      next_param = param - update_with_lr
+
+      assignments.extend(
+          [param.assign(next_param),
+           m.assign(next_m),
+           v.assign(next_v)])
+    return tf.group(*assignments)
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""Sequence packing: several short examples share one max-length row.
+
+Padding every example to `max_seq_length` wastes most of the compute on short
+sequences. In packing mode several examples are concatenated into one row.
+Each token carries a 1-based `sequence_ids` entry naming the example it came
+from (0 for padding) and a `position_ids` entry that restarts at 0 for every
+example, so the model can build a block-diagonal attention mask and per-example
+position embeddings (see `modeling_ext.BertModel`).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+def pack_examples(lengths, max_seq_length, max_sequences_per_pack,
+                  costs=None, max_cost=None, max_open_packs=100):
+  """Groups examples into packs with a first-fit heuristic.
+
+  Args:
+    lengths: list of int. Number of tokens of every example.
+    max_seq_length: int. Maximum number of tokens in a pack.
+    max_sequences_per_pack: int. Maximum number of examples in a pack.
+    costs: (Optional) list of int. A second per-example quantity that is
+      limited per pack, e.g. the number of masked LM predictions.
+    max_cost: (Optional) int. Limit of the sum of `costs` in a pack.
+    max_open_packs: int. Number of packs that are still searched for free
+      space. The oldest one is closed when the limit is exceeded, which keeps
+      packing linear in the number of examples.
+
+  Returns:
+    A list of packs, each a list of example indexes in their original order.
+    Examples are taken in order, so the result is deterministic.
+  """
+  if costs is None:
+    costs = [0] * len(lengths)
+    max_cost = 0
+
+  packs = []
+  # Open packs are those that may still take another example. Each entry is
+  # [indexes, remaining_length, remaining_cost].
+  open_packs = []
+  for (index, (length, cost)) in enumerate(zip(lengths, costs)):
+    if length > max_seq_length or cost > max_cost:
+      raise ValueError(
+          "Example %d does not fit in a pack (length %d, cost %d)" %
+          (index, length, cost))
+    target = None
+    for pack in open_packs:
+      if pack[1] >= length and pack[2] >= cost:
+        target = pack
+        break
+    if target is None:
+      target = [[], max_seq_length, max_cost]
+      open_packs.append(target)
+      packs.append(target)
+      if len(open_packs) > max_open_packs:
+        open_packs.pop(0)
+    target[0].append(index)
+    target[1] -= length
+    target[2] -= cost
+    if len(target[0]) >= max_sequences_per_pack or target[1] == 0:
+      open_packs.remove(target)
+
+  return [pack[0] for pack in packs]
+
+
+def pack_token_ids(sequences, max_seq_length):
+  """Concatenates per-example features into one zero-padded row.
+
+  Args:
+    sequences: list of (input_ids, segment_ids) tuples, one per example.
+    max_seq_length: int. Length of the packed row.
+
+  Returns:
+    A dict with "input_ids", "input_mask", "segment_ids", "position_ids" and
+    "sequence_ids" lists of length `max_seq_length`, plus "offsets", the start
+    position of every example in the row.
+  """
+  packed = {
+      "input_ids": [],
+      "input_mask": [],
+      "segment_ids": [],
+      "position_ids": [],
+      "sequence_ids": [],
+      "offsets": [],
+  }
+  for (i, (input_ids, segment_ids)) in enumerate(sequences):
+    packed["offsets"].append(len(packed["input_ids"]))
+    packed["input_ids"].extend(input_ids)
+    packed["input_mask"].extend([1] * len(input_ids))
+    packed["segment_ids"].extend(segment_ids)
+    packed["position_ids"].extend(range(len(input_ids)))
+    packed["sequence_ids"].extend([i + 1] * len(input_ids))
+  assert len(packed["input_ids"]) <= max_seq_length
+
+  for name in ("input_ids", "input_mask", "segment_ids", "position_ids",
+               "sequence_ids"):
+    values = packed[name]
+    values.extend([0] * (max_seq_length - len(values)))
+  return packed
+
+
+def pad_to(values, length, pad_value=0):
+  """Returns a copy of `values` right-padded with `pad_value` to `length`."""
+  assert len(values) <= length
+  return list(values) + [pad_value] * (length - len(values))
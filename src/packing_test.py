@@ -0,0 +1,79 @@
+# coding=utf-8
+"""Tests of packing.py.
+
+  python3 -m unittest src/packing_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import packing
+
+
+class PackExamplesTest(unittest.TestCase):
+
+  def test_packs_respect_limits_and_order(self):
+    rng = random.Random(0)
+    lengths = [rng.randint(1, 64) for _ in range(500)]
+    costs = [rng.randint(0, 10) for _ in range(500)]
+    packs = packing.pack_examples(lengths, 128, 4, costs=costs, max_cost=20,
+                                  max_open_packs=8)
+
+    self.assertEqual(sorted(i for pack in packs for i in pack),
+                     list(range(len(lengths))))
+    for pack in packs:
+      self.assertTrue(pack)
+      self.assertLessEqual(len(pack), 4)
+      self.assertLessEqual(sum(lengths[i] for i in pack), 128)
+      self.assertLessEqual(sum(costs[i] for i in pack), 20)
+      self.assertEqual(pack, sorted(pack))
+
+  def test_first_fit(self):
+    packs = packing.pack_examples([6, 6, 3, 4, 1], 10, 3)
+    self.assertEqual(packs, [[0, 2, 4], [1, 3]])
+
+  def test_max_sequences_per_pack_closes_packs(self):
+    packs = packing.pack_examples([1] * 5, 10, 2)
+    self.assertEqual(packs, [[0, 1], [2, 3], [4]])
+
+  def test_evicted_packs_are_not_filled(self):
+    # With one open pack, the first pack is closed when the second is opened,
+    # so the last example starts a new pack although it fits into the first.
+    packs = packing.pack_examples([5, 8, 3], 10, 3, max_open_packs=1)
+    self.assertEqual(packs, [[0], [1], [2]])
+
+  def test_oversized_example_raises(self):
+    with self.assertRaises(ValueError):
+      packing.pack_examples([3, 11], 10, 2)
+    with self.assertRaises(ValueError):
+      packing.pack_examples([3, 3], 10, 2, costs=[1, 6], max_cost=5)
+
+
+class PackTokenIdsTest(unittest.TestCase):
+
+  def test_pack_token_ids(self):
+    packed = packing.pack_token_ids(
+        [([11, 12, 13], [0, 0, 1]), ([21, 22], [0, 1])], 8)
+
+    self.assertEqual(packed["input_ids"], [11, 12, 13, 21, 22, 0, 0, 0])
+    self.assertEqual(packed["input_mask"], [1, 1, 1, 1, 1, 0, 0, 0])
+    self.assertEqual(packed["segment_ids"], [0, 0, 1, 0, 1, 0, 0, 0])
+    self.assertEqual(packed["position_ids"], [0, 1, 2, 0, 1, 0, 0, 0])
+    self.assertEqual(packed["sequence_ids"], [1, 1, 1, 2, 2, 0, 0, 0])
+    self.assertEqual(packed["offsets"], [0, 3])
+
+  def test_full_row_has_no_padding(self):
+    packed = packing.pack_token_ids([([1, 2], [0, 0]), ([3, 4], [0, 0])], 4)
+    self.assertEqual(packed["input_mask"], [1, 1, 1, 1])
+    self.assertEqual(packed["sequence_ids"], [1, 1, 2, 2])
+
+
+if __name__ == "__main__":
+  unittest.main()
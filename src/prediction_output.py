@@ -0,0 +1,98 @@
+# coding=utf-8
+"""Binary prediction output of the classifiers.
+
+`NpyPredictionWriter` writes the class probabilities of the test set as a
+float16 or float32 .npy array, together with the argmax label ids, the
+argmax label names and optionally the top-k label ids and probabilities of
+every example, so that post-processing is a vectorized `np.load` instead of
+parsing test_results.tsv:
+
+  test_probabilities.npy        [num_examples, num_labels]
+  test_label_ids.npy            [num_examples] int32, argmax label ids
+  test_labels.npy               [num_examples] str, argmax label names
+  test_top_k_label_ids.npy      [num_examples, k] int32 (if `top_k` > 0)
+  test_top_k_probabilities.npy  [num_examples, k] (if `top_k` > 0)
+  test_label_list.txt           All label names, one per line by label id
+
+The arrays are memory-mapped and every block is written at its row offset,
+so a resumed chunked prediction (see resumable_predict.py) can keep writing
+into the arrays of the interrupted run.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import numpy as np
+
+PREFIX = "test_"
+
+
+class NpyPredictionWriter(object):
+  """Writes blocks of class probabilities to memory-mapped .npy arrays."""
+
+  def __init__(self, output_dir, label_list, num_examples, dtype="float16",
+               top_k=0, resume=False):
+    """Constructs a NpyPredictionWriter.
+
+    Args:
+      output_dir: Directory of the output files.
+      label_list: Label names, indexed by label id.
+      num_examples: Number of examples (rows) of the arrays.
+      dtype: "float16" or "float32", type of the stored probabilities.
+      top_k: Number of most probable labels stored per example; 0 stores
+        none.
+      resume: Whether to write into the arrays of an earlier run, if they
+        have the same shapes, instead of creating new ones.
+    """
+    self.label_list = list(label_list)
+    self.top_k = min(top_k, len(self.label_list))
+    self._label_names = np.array(self.label_list)
+    num_labels = len(self.label_list)
+
+    with open(os.path.join(output_dir, PREFIX + "label_list.txt"),
+              "w", encoding="utf-8") as writer:
+      for label in self.label_list:
+        writer.write(label + "\n")
+
+    def open_array(name, arr_dtype, shape):
+      path = os.path.join(output_dir, PREFIX + name + ".npy")
+      if resume and os.path.exists(path):
+        array = np.lib.format.open_memmap(path, mode="r+")
+        if array.shape == shape and array.dtype == np.dtype(arr_dtype):
+          return array
+      return np.lib.format.open_memmap(path, mode="w+", dtype=arr_dtype,
+                                       shape=shape)
+
+    self._arrays = {
+        "probabilities": open_array("probabilities", dtype,
+                                    (num_examples, num_labels)),
+        "label_ids": open_array("label_ids", np.int32, (num_examples,)),
+        "labels": open_array("labels", self._label_names.dtype,
+                             (num_examples,)),
+    }
+    if self.top_k > 0:
+      self._arrays["top_k_label_ids"] = open_array(
+          "top_k_label_ids", np.int32, (num_examples, self.top_k))
+      self._arrays["top_k_probabilities"] = open_array(
+          "top_k_probabilities", dtype, (num_examples, self.top_k))
+
+  def write(self, start_index, probabilities):
+    """Writes the rows of `probabilities` starting at row `start_index`."""
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    end_index = start_index + len(probabilities)
+    label_ids = np.argmax(probabilities, axis=-1)
+    arrays = self._arrays
+    arrays["probabilities"][start_index:end_index] = probabilities
+    arrays["label_ids"][start_index:end_index] = label_ids
+    arrays["labels"][start_index:end_index] = self._label_names[label_ids]
+    if self.top_k > 0:
+      top_k_ids = np.argsort(-probabilities, axis=-1)[:, :self.top_k]
+      arrays["top_k_label_ids"][start_index:end_index] = top_k_ids
+      arrays["top_k_probabilities"][start_index:end_index] = np.take_along_axis(
+          probabilities, top_k_ids, axis=-1)
+
+  def flush(self):
+    for array in self._arrays.values():
+      array.flush()
@@ -0,0 +1,115 @@
+# coding=utf-8
+"""Chunked prediction that survives restarts.
+
+`predict_in_chunks` runs prediction over fixed-size chunks of the examples,
+appends the results of every chunk to the output file and then records the
+progress in a sidecar file (`<output_file>.progress.json`). A restarted run
+with the same settings truncates the output file to the last completed
+chunk, skips the completed chunks and continues from there. Runs with other
+settings (e.g. another checkpoint) start over.
+
+The output file has to be on a local file system, since it is truncated and
+synced with plain file operations.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import os
+import tensorflow as tf
+
+
+def get_progress_file(output_file):
+  return output_file + ".progress.json"
+
+
+def load_progress(output_file, settings):
+  """Returns the progress of an earlier run with `settings`, or None."""
+  progress_file = get_progress_file(output_file)
+  if not (os.path.exists(progress_file) and os.path.exists(output_file)):
+    return None
+  with open(progress_file) as reader:
+    progress = json.load(reader)
+  if progress["settings"] != settings:
+    tf.logging.info("Settings of %s changed, starting over", output_file)
+    return None
+  return progress
+
+
+def save_progress(output_file, settings, num_chunks, num_examples,
+                  output_bytes):
+  """Atomically records that `num_chunks` chunks are in `output_file`."""
+  progress_file = get_progress_file(output_file)
+  with open(progress_file + ".tmp", "w") as writer:
+    json.dump({
+        "settings": settings,
+        "num_chunks": num_chunks,
+        "num_examples": num_examples,
+        "output_bytes": output_bytes,
+    }, writer, indent=2, sort_keys=True)
+    writer.flush()
+    os.fsync(writer.fileno())
+  os.rename(progress_file + ".tmp", progress_file)
+
+
+def predict_in_chunks(examples, chunk_size, predict_fn, format_fn, output_file,
+                      settings):
+  """Predicts `examples` chunk by chunk and appends the results.
+
+  Args:
+    examples: Iterable of examples, in the same order on every run.
+    chunk_size: Number of examples per chunk.
+    predict_fn: Function of (list of examples, index of the first example)
+      that returns one prediction per example.
+    format_fn: Function of (example, prediction) that returns the output line.
+    output_file: Local output file.
+    settings: JSON-serializable dict; progress is only resumed from a run
+      with the same settings.
+
+  Returns:
+    The number of examples in the output file.
+  """
+  progress = load_progress(output_file, settings)
+  if progress is None:
+    (num_chunks, num_examples, output_bytes) = (0, 0, 0)
+  else:
+    (num_chunks, num_examples, output_bytes) = (
+        progress["num_chunks"], progress["num_examples"],
+        progress["output_bytes"])
+    tf.logging.info("Resuming %s after %d chunks (%d examples)", output_file,
+                    num_chunks, num_examples)
+
+  # Drops the partial output of a chunk that was interrupted.
+  with open(output_file, "ab") as writer:
+    writer.truncate(output_bytes)
+
+  iterator = iter(examples)
+  # Completed chunks are read again but not predicted.
+  for _ in itertools.islice(iterator, num_chunks * chunk_size):
+    pass
+
+  with open(output_file, "ab") as writer:
+    while True:
+      chunk = list(itertools.islice(iterator, chunk_size))
+      if not chunk:
+        break
+      predictions = predict_fn(chunk, num_examples)
+      lines = [format_fn(example, prediction)
+               for (example, prediction) in zip(chunk, predictions)]
+      if len(lines) != len(chunk):
+        raise ValueError("Got %d predictions for %d examples" %
+                         (len(lines), len(chunk)))
+      writer.write("".join(lines).encode("utf-8"))
+      writer.flush()
+      os.fsync(writer.fileno())
+
+      num_chunks += 1
+      num_examples += len(chunk)
+      save_progress(output_file, settings, num_chunks, num_examples,
+                    writer.tell())
+      tf.logging.info("Predicted chunk %d (%d examples in total)", num_chunks,
+                      num_examples)
+  return num_examples
@@ -8,29 +8,37 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import configparser
 import csv
-import json
+import itertools
+import multiprocessing
 import os
+import queue
 import sys
-import tempfile
+import threading
+import packing
+import prediction_output
 import tokenization_sentencepiece as tokenization
-import tensorflow as tf
 import utils
+from absl import app
+from absl import flags
+
+# TensorFlow and the modules that use it are imported when first used, so
+# `--help` and flag errors do not import them and conversion workers do not
+# import the model code.
+tf = utils.LazyModule("tensorflow")
+checkpoint_cache = utils.LazyModule("checkpoint_cache")
+distribute_utils = utils.LazyModule("distribute_utils")
+early_stopping = utils.LazyModule("early_stopping")
+metrics_hooks = utils.LazyModule("metrics_hooks")
+resumable_predict = utils.LazyModule("resumable_predict")
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 CONFIGPATH = os.path.join(CURDIR, os.pardir, 'config.ini')
-config = configparser.ConfigParser()
-config.read(CONFIGPATH)
-bert_config_file = tempfile.NamedTemporaryFile(mode='w+t', encoding='utf-8', suffix='.json')
-bert_config_file.write(json.dumps({k:utils.str_to_value(v) for k,v in config['BERT-CONFIG'].items()}))
-bert_config_file.seek(0)
 
 sys.path.append(os.path.join(CURDIR, os.pardir, 'bert'))
-import modeling
-import optimization
-
-flags = tf.flags
+modeling = utils.LazyModule("modeling")
+modeling_ext = utils.LazyModule("modeling_ext")
+optimization_ext = utils.LazyModule("optimization_ext")
 
 FLAGS = flags.FLAGS
 
@@ -45,13 +53,21 @@ flags.DEFINE_string(
     "The config json file corresponding to the pre-trained BERT model. "
     "This specifies the model architecture.")
 
+flags.DEFINE_string(
+    "bert_config_name", None,
+    "Name of the model config in config.ini: the [BERT-CONFIG:NAME] section, "
+    "which overrides values of [BERT-CONFIG]. Uses [BERT-CONFIG] if not "
+    "set.")
+
 flags.DEFINE_string("task_name", None, "The name of the task to train.")
 
 flags.DEFINE_string("model_file", None,
                     "The model file that the SentencePiece model was trained on.")
 
 flags.DEFINE_string("vocab_file", None,
-                    "The vocabulary file that the BERT model was trained on.")
+                    "The vocabulary: a .vocab file of spm_train, a vocabulary "
+                    "saved with `Vocab.save` (.npy) or unset to use the "
+                    "vocabulary of the SentencePiece model.")
 
 flags.DEFINE_string(
     "output_dir", None,
@@ -63,6 +79,18 @@ flags.DEFINE_string(
     "init_checkpoint", None,
     "Initial checkpoint (usually from a pre-trained BERT model).")
 
+flags.DEFINE_string(
+    "init_checkpoint_cache_dir", None,
+    "[Optional] Local directory of a warm-start cache of `init_checkpoint` "
+    "(see checkpoint_cache.py). The cache is built on the first run and "
+    "memory-mapped afterwards, so later runs do not read the checkpoint. "
+    "Only used if `use_tpu` is False.")
+
+flags.DEFINE_enum(
+    "init_checkpoint_cache_dtype", "float32", ["float32", "float16"],
+    "Storage type of the warm-start cache. float16 halves its size at a "
+    "small loss of precision.")
+
 flags.DEFINE_bool(
     "do_lower_case", True,
     "Whether to lower case the input text. Should be True for uncased "
@@ -74,6 +102,46 @@ flags.DEFINE_integer(
     "Sequences longer than this will be truncated, and sequences shorter "
     "than this will be padded.")
 
+flags.DEFINE_integer(
+    "max_sequences_per_pack", 1,
+    "Maximum number of examples packed into one `max_seq_length` row, so "
+    "that short texts do not waste compute on padding. 1 disables packing. "
+    "The train set is always packed; the dev set is packed unless `use_tpu` "
+    "is True; the test set is never packed.")
+
+flags.DEFINE_integer(
+    "num_conversion_workers", 1,
+    "Number of processes converting examples to TFRecords. 0 uses one per "
+    "CPU.")
+
+flags.DEFINE_integer(
+    "predict_chunk_size", 0,
+    "If > 0, `do_predict` converts and predicts the test set in chunks of "
+    "this many examples, appends every chunk to test_results.tsv (with the "
+    "example guid as first column) and resumes after the last completed "
+    "chunk when restarted.")
+
+flags.DEFINE_enum(
+    "predict_output_format", "tsv", ["tsv", "npy"],
+    "Output of `do_predict`. `tsv` writes test_results.tsv, `npy` writes "
+    "the probabilities, argmax label ids and label names (and the top "
+    "`predict_top_k` labels) as .npy arrays to `output_dir`, which has to be "
+    "a local directory.")
+
+flags.DEFINE_enum(
+    "predict_output_dtype", "float16", ["float16", "float32"],
+    "Type of the probabilities with `predict_output_format`=npy.")
+
+flags.DEFINE_integer(
+    "predict_top_k", 0,
+    "With `predict_output_format`=npy, also writes the ids and "
+    "probabilities of the k most probable labels of every example.")
+
+flags.DEFINE_integer(
+    "num_record_shards", 1,
+    "Number of TFRecord files the train and test sets are written to. Not "
+    "supported with `max_sequences_per_pack` > 1.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_eval", False, "Whether to run eval on the dev set.")
@@ -98,6 +166,40 @@ flags.DEFINE_float(
     "Proportion of training to perform linear learning rate warmup for. "
     "E.g., 0.1 = 10% of training.")
 
+flags.DEFINE_integer(
+    "gradient_accumulation_steps", 1,
+    "Number of micro-batches whose gradients are summed before each optimizer "
+    "update. `train_batch_size` stays the effective batch size and must be "
+    "divisible by this; every micro-batch holds "
+    "`train_batch_size / gradient_accumulation_steps` examples. "
+    "`save_checkpoints_steps` counts optimizer updates. Only used if "
+    "`use_tpu` is False.")
+
+flags.DEFINE_enum(
+    "precision", "float32", list(utils.PRECISIONS),
+    "Type of the transformer activations and matmuls. With float16 or "
+    "bfloat16 the variables stay float32, and layer normalization and the "
+    "attention softmax run in float32.")
+
+flags.DEFINE_float(
+    "loss_scale", 0,
+    "Loss scale for training with `precision=float16`; 0 selects dynamic loss "
+    "scaling. Not used with float32 or bfloat16.")
+
+flags.DEFINE_integer(
+    "num_recomputed_layers", 0,
+    "Number of transformer layers, counted from the bottom, whose activations "
+    "are recomputed in the backward pass instead of being kept in memory. "
+    "Costs roughly one extra forward pass of those layers per step but allows "
+    "much larger batches at long sequence lengths.")
+
+flags.DEFINE_integer(
+    "num_frozen_layers", 0,
+    "Number of transformer layers, counted from the bottom, that are not "
+    "trained, along with the embeddings. Their backward pass and optimizer "
+    "slots are skipped. See cached_encoder.py to also skip their forward pass "
+    "when all layers are frozen.")
+
 flags.DEFINE_integer("save_checkpoints_steps", 1000,
                      "How often to save the model checkpoint.")
 
@@ -106,30 +208,67 @@ flags.DEFINE_integer("iterations_per_loop", 1000,
 
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     "tpu_name", None,
     "The Cloud TPU to use for training. This should be either the name "
     "used when creating the Cloud TPU, or a grpc://ip.address.of.tpu:8470 "
     "url.")
 
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     "tpu_zone", None,
     "[Optional] GCE zone where the Cloud TPU is located in. If not "
     "specified, we will attempt to automatically detect the GCE project from "
     "metadata.")
 
-tf.flags.DEFINE_string(
+flags.DEFINE_string(
     "gcp_project", None,
     "[Optional] Project name for the Cloud TPU-enabled project. If not "
     "specified, we will attempt to automatically detect the GCE project from "
     "metadata.")
 
-tf.flags.DEFINE_string("master", None, "[Optional] TensorFlow master URL.")
+flags.DEFINE_string("master", None, "[Optional] TensorFlow master URL.")
 
 flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_string(
+    "metrics_file", None,
+    "[Optional] File (.jsonl or .csv) to which step-time, throughput and "
+    "checkpoint save metrics are appended. They are also written as "
+    "TensorBoard summaries to `output_dir`. Only used if `use_tpu` is False.")
+
+flags.DEFINE_integer("metrics_every_n_steps", 100,
+                     "How many training steps are aggregated per metrics record.")
+
+flags.DEFINE_integer(
+    "eval_every_n_steps", 0,
+    "If > 0, evaluate on the dev set every this many training steps while "
+    "training, in the training session, and keep the best checkpoints in "
+    "`output_dir`/best. `do_eval` and `do_predict` then use the best "
+    "checkpoint. Only used if `use_tpu` is False.")
+
+flags.DEFINE_string(
+    "early_stopping_metric", "eval_accuracy",
+    "Dev set metric (eval_accuracy or eval_loss) by which checkpoints are "
+    "ranked and training is stopped early.")
+
+flags.DEFINE_enum(
+    "early_stopping_mode", "max", ["max", "min"],
+    "Whether a larger (max) or smaller (min) `early_stopping_metric` is better.")
+
+flags.DEFINE_integer(
+    "early_stopping_patience", 0,
+    "Stop training when `early_stopping_metric` did not improve for this many "
+    "evaluations. 0 never stops early.")
+
+flags.DEFINE_float(
+    "early_stopping_min_delta", 0.0,
+    "Smallest change of `early_stopping_metric` that counts as improvement.")
+
+flags.DEFINE_integer("keep_best_checkpoints", 1,
+                     "Number of best checkpoints kept by `eval_every_n_steps`.")
+
 
 class InputExample(object):
   """A single training/test example for simple sequence classification."""
@@ -200,43 +339,100 @@ class DataProcessor(object):
     """Gets the list of labels for this data set."""
     raise NotImplementedError()
 
+  def iter_train_examples(self, data_dir):
+    """Yields the `InputExample`s of the train set one at a time.
+
+    Processors that can read their data lazily override the `iter_*`
+    methods; by default they go through the lists of the `get_*` methods.
+    """
+    return iter(self.get_train_examples(data_dir))
+
+  def iter_dev_examples(self, data_dir):
+    """Yields the `InputExample`s of the dev set one at a time."""
+    return iter(self.get_dev_examples(data_dir))
+
+  def iter_test_examples(self, data_dir):
+    """Yields the `InputExample`s for prediction one at a time."""
+    return iter(self.get_test_examples(data_dir))
+
+  def get_num_examples(self, data_dir, set_type):
+    """Gets the number of examples of the "train", "dev" or "test" set."""
+    examples = getattr(self, "iter_%s_examples" % set_type)(data_dir)
+    return sum(1 for _ in examples)
+
   @classmethod
   def _read_tsv(cls, input_file, quotechar=None):
     """Reads a tab separated value file."""
+    return list(cls._iter_tsv(input_file, quotechar))
+
+  @classmethod
+  def _iter_tsv(cls, input_file, quotechar=None):
+    """Yields the rows of a tab separated value file one at a time."""
     with tf.gfile.Open(input_file, "r") as f:
       reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-      lines = []
       for line in reader:
-        lines.append(line)
-      return lines
+        yield line
+
+  @classmethod
+  def _count_lines(cls, input_file):
+    """Counts the lines of a file without decoding it."""
+    num_lines = 0
+    last_block = b""
+    with tf.gfile.Open(input_file, "rb") as f:
+      while True:
+        block = f.read(1 << 20)
+        if not block:
+          break
+        num_lines += block.count(b"\n")
+        last_block = block
+    if last_block and not last_block.endswith(b"\n"):
+      num_lines += 1
+    return num_lines
 
 
-class TitanicProcessor(DataProcessor):
-  """Processor for the livedoor data set (see https://www.rondhuit.com/download.html)."""
+class TextLabelProcessor(DataProcessor):
+  """Base class for train/dev/test.tsv files with "text" and "label" columns.
+
+  The files are read lazily, one row at a time.
+  """
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return list(self.iter_train_examples(data_dir))
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return list(self.iter_dev_examples(data_dir))
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return list(self.iter_test_examples(data_dir))
 
-  def get_labels(self):
+  def iter_train_examples(self, data_dir):
     """See base class."""
-    return ['0','1']
+    return self._iter_examples(os.path.join(data_dir, "train.tsv"), "train")
+
+  def iter_dev_examples(self, data_dir):
+    """See base class."""
+    return self._iter_examples(os.path.join(data_dir, "dev.tsv"), "dev")
+
+  def iter_test_examples(self, data_dir):
+    """See base class."""
+    return self._iter_examples(os.path.join(data_dir, "test.tsv"), "test")
 
-  def _create_examples(self, lines, set_type):
+  def get_num_examples(self, data_dir, set_type):
+    """See base class.
+
+    Counts lines instead of parsing the file. Rows are never quoted (see
+    `_read_tsv`), so every line but the header is one example.
+    """
+    num_lines = self._count_lines(
+        os.path.join(data_dir, "%s.tsv" % set_type))
+    return max(0, num_lines - 1)
+
+  def _iter_examples(self, input_file, set_type):
     """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
+    for (i, line) in enumerate(self._iter_tsv(input_file)):
       if i == 0:
         idx_text = line.index('text')
         idx_label = line.index('label')
@@ -244,28 +440,19 @@ class TitanicProcessor(DataProcessor):
         guid = "%s-%s" % (set_type, i)
         text_a = tokenization.convert_to_unicode(line[idx_text])
         label = tokenization.convert_to_unicode(line[idx_label])
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+        yield InputExample(guid=guid, text_a=text_a, text_b=None, label=label)
 
 
-class LivedoorProcessor(DataProcessor):
+class TitanicProcessor(TextLabelProcessor):
   """Processor for the livedoor data set (see https://www.rondhuit.com/download.html)."""
 
-  def get_train_examples(self, data_dir):
+  def get_labels(self):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return ['0','1']
 
-  def get_dev_examples(self, data_dir):
-    """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
 
-  def get_test_examples(self, data_dir):
-    """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+class LivedoorProcessor(TextLabelProcessor):
+  """Processor for the livedoor data set (see https://www.rondhuit.com/download.html)."""
 
   def get_labels(self):
     """See base class."""
@@ -275,20 +462,11 @@ class LivedoorProcessor(DataProcessor):
 
 #return ['0','1']
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        idx_text = line.index('text')
-        idx_label = line.index('label')
-      else:
-        guid = "%s-%s" % (set_type, i)
-        text_a = tokenization.convert_to_unicode(line[idx_text])
-        label = tokenization.convert_to_unicode(line[idx_label])
-        examples.append(
-            InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+
+PROCESSORS = {
+    "livedoor": LivedoorProcessor,
+    "titanic":  TitanicProcessor
+}
 
 
 def convert_single_example(ex_index, example, label_list, max_seq_length,
@@ -393,39 +571,282 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   return feature
 
 
-def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer, output_file):
-  """Convert a set of `InputExample`s to a TFRecord file."""
+def serialize_feature(feature):
+  """Serializes an `InputFeatures` to a `tf.train.Example` string."""
 
-  writer = tf.python_io.TFRecordWriter(output_file)
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
 
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(feature.input_ids)
+  features["input_mask"] = create_int_feature(feature.input_mask)
+  features["segment_ids"] = create_int_feature(feature.segment_ids)
+  features["label_ids"] = create_int_feature([feature.label_id])
+  features["is_real_example"] = create_int_feature(
+      [int(feature.is_real_example)])
 
-    feature = convert_single_example(ex_index, example, label_list,
+  tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+  return tf_example.SerializeToString()
+
+
+# Number of examples converted and written at a time. Sharded record files
+# hold consecutive chunks of this size in turn.
+CONVERSION_CHUNK_SIZE = 1000
+
+
+def iter_chunks(iterable, chunk_size):
+  """Yields lists of up to `chunk_size` consecutive items of `iterable`."""
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+class PipelinedRecordWriter(object):
+  """TFRecord writer that writes chunks of records in a background thread.
+
+  The next chunk is converted while the previous one is written, and at most
+  `max_pending_chunks` chunks wait in memory.
+  """
+
+  def __init__(self, output_file, max_pending_chunks=2):
+    self._writer = tf.python_io.TFRecordWriter(output_file)
+    self._queue = queue.Queue(max_pending_chunks)
+    self._error = None
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      records = self._queue.get()
+      if records is None:
+        return
+      # After an error the queue is still drained so that `write` never
+      # blocks; the error is raised in the calling thread.
+      if self._error is None:
+        try:
+          for record in records:
+            self._writer.write(record)
+        except Exception as e:  # pylint: disable=broad-except
+          self._error = e
+
+  def write(self, records):
+    """Queues a list of serialized records."""
+    if self._error is not None:
+      raise self._error
+    self._queue.put(records)
+
+  def close(self):
+    self._queue.put(None)
+    self._thread.join()
+    self._writer.close()
+    if self._error is not None:
+      raise self._error
+
+
+def get_record_files(output_file, num_record_shards=1):
+  """Returns the files of a data set written in `num_record_shards` shards."""
+  if num_record_shards <= 1:
+    return [output_file]
+  return ["%s-%05d-of-%05d" % (output_file, i, num_record_shards)
+          for i in range(num_record_shards)]
+
+
+def convert_examples_chunk(start_index, examples, label_list, max_seq_length,
+                           tokenizer, serialize=True):
+  """Converts consecutive examples to serialized records or `InputFeatures`."""
+  results = []
+  for (i, example) in enumerate(examples):
+    feature = convert_single_example(start_index + i, example, label_list,
                                      max_seq_length, tokenizer)
+    results.append(serialize_feature(feature) if serialize else feature)
+  return results
+
+
+_conversion_worker_args = {}
+
+
+def _init_conversion_worker(label_list, max_seq_length, tokenizer, serialize):
+  # Runs once per worker process; the tokenizer is unpickled (i.e. its files
+  # are loaded) once here instead of for every chunk.
+  _conversion_worker_args.update(
+      label_list=label_list, max_seq_length=max_seq_length,
+      tokenizer=tokenizer, serialize=serialize)
 
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
+
+def _convert_chunk_in_worker(args):
+  (start_index, examples) = args
+  return convert_examples_chunk(start_index, examples,
+                                **_conversion_worker_args)
+
+
+def iter_converted_chunks(examples, label_list, max_seq_length, tokenizer,
+                          serialize=True, num_workers=1,
+                          chunk_size=CONVERSION_CHUNK_SIZE,
+                          num_examples=None):
+  """Converts `examples` in chunks, in parallel if `num_workers` > 1.
+
+  Yields one list of results per chunk of `chunk_size` examples, in the order
+  of `examples`. The worker processes are started with "spawn", so they are
+  safe to use after TensorFlow sessions ran in this process; at most two
+  chunks per worker are in flight at a time.
+  """
+  chunks = ((i * chunk_size, chunk)
+            for (i, chunk) in enumerate(iter_chunks(examples, chunk_size)))
+
+  def log_progress(start_index, size):
+    for ex_index in range(start_index, start_index + size):
+      if ex_index % 10000 == 0:
+        tf.logging.info("Writing example %d of %s" %
+                        (ex_index, num_examples or "?"))
+
+  if num_workers <= 1:
+    for (start_index, chunk) in chunks:
+      log_progress(start_index, len(chunk))
+      yield convert_examples_chunk(start_index, chunk, label_list,
+                                   max_seq_length, tokenizer, serialize)
+    return
+
+  pool = multiprocessing.get_context("spawn").Pool(
+      num_workers,
+      initializer=_init_conversion_worker,
+      initargs=(label_list, max_seq_length, tokenizer, serialize))
+  try:
+    pending = collections.deque()
+    for (start_index, chunk) in chunks:
+      pending.append((start_index, len(chunk),
+                      pool.apply_async(_convert_chunk_in_worker,
+                                       ((start_index, chunk),))))
+      if len(pending) >= 2 * num_workers:
+        (start_index, size, result) = pending.popleft()
+        log_progress(start_index, size)
+        yield result.get()
+    while pending:
+      (start_index, size, result) = pending.popleft()
+      log_progress(start_index, size)
+      yield result.get()
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def file_based_convert_examples_to_features(
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    max_sequences_per_pack=1, num_examples=None, num_workers=1,
+    num_record_shards=1):
+  """Convert a set of `InputExample`s to a TFRecord file.
+
+  `examples` may be any iterable, e.g. the `iter_*_examples` of a processor;
+  it is consumed in chunks of `CONVERSION_CHUNK_SIZE`, so only a few chunks
+  are in memory at a time. With `num_workers` > 1 the chunks are converted by
+  a pool of processes. With `num_record_shards` > 1 the chunks are written in turn
+  to the files of `get_record_files`, which `file_based_input_fn_builder`
+  reads back in the original order. `num_examples` is only used for progress
+  logging.
+
+  Returns the number of records written, which is smaller than the number of
+  examples if `max_sequences_per_pack` > 1.
+  """
+  if max_sequences_per_pack > 1:
+    if num_record_shards > 1:
+      raise ValueError("Packed records cannot be written in shards.")
+    return file_based_convert_packed_examples_to_features(
+        examples, label_list, max_seq_length, tokenizer, output_file,
+        max_sequences_per_pack, num_workers=num_workers)
+
+  writers = [PipelinedRecordWriter(path)
+             for path in get_record_files(output_file, num_record_shards)]
+  num_written = 0
+  try:
+    for (i, records) in enumerate(iter_converted_chunks(
+        examples, label_list, max_seq_length, tokenizer,
+        num_workers=num_workers, num_examples=num_examples)):
+      writers[i % num_record_shards].write(records)
+      num_written += len(records)
+  finally:
+    for writer in writers:
+      writer.close()
+  return num_written
+
+
+def file_based_convert_packed_examples_to_features(
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    max_sequences_per_pack, num_workers=1):
+  """Convert a set of `InputExample`s to a TFRecord file of packed rows.
+
+  Every row holds up to `max_sequences_per_pack` examples (see packing.py).
+  `cls_positions` holds the position of the [CLS] token of every example and
+  `label_weights` is 0.0 for unused slots. `PaddingInputExample`s are dropped
+  since unused slots already carry a zero weight.
+  """
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  def create_float_feature(values):
+    f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
+    return f
+
+  # Packing needs the lengths of all examples, so the converted features are
+  # kept in memory (the examples themselves are still read lazily).
+  input_features = []
+  examples = (example for example in examples
+              if not isinstance(example, PaddingInputExample))
+  for features in iter_converted_chunks(examples, label_list, max_seq_length,
+                                        tokenizer, serialize=False,
+                                        num_workers=num_workers):
+    input_features.extend(features)
+
+  lengths = [sum(feature.input_mask) for feature in input_features]
+  packs = packing.pack_examples(lengths, max_seq_length, max_sequences_per_pack)
+  tf.logging.info("Packed %d examples into %d rows" % (len(input_features),
+                                                       len(packs)))
+
+  writer = tf.python_io.TFRecordWriter(output_file)
+  for pack in packs:
+    packed = packing.pack_token_ids(
+        [(input_features[i].input_ids[:lengths[i]],
+          input_features[i].segment_ids[:lengths[i]]) for i in pack],
+        max_seq_length)
+    label_ids = [input_features[i].label_id for i in pack]
+    label_weights = [1.0] * len(pack)
 
     features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(feature.input_ids)
-    features["input_mask"] = create_int_feature(feature.input_mask)
-    features["segment_ids"] = create_int_feature(feature.segment_ids)
-    features["label_ids"] = create_int_feature([feature.label_id])
-    features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
+    features["input_ids"] = create_int_feature(packed["input_ids"])
+    features["input_mask"] = create_int_feature(packed["input_mask"])
+    features["segment_ids"] = create_int_feature(packed["segment_ids"])
+    features["position_ids"] = create_int_feature(packed["position_ids"])
+    features["sequence_ids"] = create_int_feature(packed["sequence_ids"])
+    features["cls_positions"] = create_int_feature(
+        packing.pad_to(packed["offsets"], max_sequences_per_pack))
+    features["label_ids"] = create_int_feature(
+        packing.pad_to(label_ids, max_sequences_per_pack))
+    features["label_weights"] = create_float_feature(
+        packing.pad_to(label_weights, max_sequences_per_pack, 0.0))
 
     tf_example = tf.train.Example(features=tf.train.Features(feature=features))
     writer.write(tf_example.SerializeToString())
   writer.close()
+  return len(packs)
 
 
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                                drop_remainder, max_sequences_per_pack=1,
+                                num_shards=1, shard_index=0,
+                                num_record_shards=1):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  In multi-worker training every worker reads every `num_shards`-th training
+  record, starting at `shard_index`. `num_record_shards` is the number of
+  files `file_based_convert_examples_to_features` wrote the records to.
+  """
+  input_files = get_record_files(input_file, num_record_shards)
 
   name_to_features = {
       "input_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
@@ -434,6 +855,17 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
       "label_ids": tf.io.FixedLenFeature([], tf.int64),
       "is_real_example": tf.io.FixedLenFeature([], tf.int64),
   }
+  if max_sequences_per_pack > 1:
+    del name_to_features["is_real_example"]
+    name_to_features.update({
+        "position_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
+        "sequence_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
+        "cls_positions":
+            tf.io.FixedLenFeature([max_sequences_per_pack], tf.int64),
+        "label_ids": tf.io.FixedLenFeature([max_sequences_per_pack], tf.int64),
+        "label_weights":
+            tf.io.FixedLenFeature([max_sequences_per_pack], tf.float32),
+    })
 
   def _decode_record(record, name_to_features):
     """Decodes a record to a TensorFlow example."""
@@ -455,8 +887,18 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
+    if len(input_files) > 1:
+      # The shards hold consecutive chunks in turn, so reading them in turn
+      # chunk by chunk restores the order of the examples.
+      d = tf.data.Dataset.from_tensor_slices(input_files).interleave(
+          tf.data.TFRecordDataset,
+          cycle_length=len(input_files),
+          block_length=CONVERSION_CHUNK_SIZE)
+    else:
+      d = tf.data.TFRecordDataset(input_file)
     if is_training:
+      if num_shards > 1:
+        d = d.shard(num_shards, shard_index)
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
@@ -489,15 +931,30 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
 
 
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings):
-  """Creates a classification model."""
-  model = modeling.BertModel(
+                 labels, num_labels, use_one_hot_embeddings,
+                 label_weights=None, position_ids=None, sequence_ids=None,
+                 cls_positions=None, compute_type="float32",
+                 num_recomputed_layers=0, scope=None, num_frozen_layers=0):
+  """Creates a classification model.
+
+  For packed input (see packing.py) `position_ids`, `sequence_ids` and
+  `cls_positions` must be given; `labels` and `label_weights` then hold one
+  entry per [CLS] position and the loss is averaged over the weighted ones.
+  """
+  model = modeling_ext.BertModel(
       config=bert_config,
       is_training=is_training,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      position_ids=position_ids,
+      sequence_ids=sequence_ids,
+      pooled_positions=cls_positions,
+      compute_type=tf.as_dtype(compute_type),
+      num_recomputed_layers=num_recomputed_layers,
+      scope=scope,
+      num_frozen_layers=num_frozen_layers)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -506,6 +963,17 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
   # instead.
   output_layer = model.get_pooled_output()
 
+  return create_classifier_output(output_layer, is_training, labels,
+                                  num_labels, label_weights)
+
+
+def create_classifier_output(output_layer, is_training, labels, num_labels,
+                             label_weights=None):
+  """Adds the classification layer and loss on top of the pooled output.
+
+  Returns:
+    (loss, per_example_loss, logits, probabilities).
+  """
   hidden_size = output_layer.shape[-1].value
 
   output_weights = tf.get_variable(
@@ -528,15 +996,73 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
     one_hot_labels = tf.one_hot(labels, depth=num_labels, dtype=tf.float32)
 
     per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
-    loss = tf.reduce_mean(per_example_loss)
+    if label_weights is None:
+      loss = tf.reduce_mean(per_example_loss)
+    else:
+      numerator = tf.reduce_sum(label_weights * per_example_loss)
+      denominator = tf.reduce_sum(label_weights) + 1e-5
+      loss = numerator / denominator
 
     return (loss, per_example_loss, logits, probabilities)
 
 
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
-  """Returns `model_fn` closure for TPUEstimator."""
+                     use_one_hot_embeddings, metrics_writer=None,
+                     metrics_every_n_steps=100, gradient_accumulation_steps=1,
+                     compute_type="float32", loss_scale=None,
+                     num_recomputed_layers=0, num_workers=1,
+                     worker_index=0, init_checkpoint_cache_dir=None,
+                     init_checkpoint_cache_dtype="float32",
+                     in_process_eval=None, num_frozen_layers=0):
+  """Returns `model_fn` closure for TPUEstimator.
+
+  `in_process_eval` is an optional `early_stopping.EvaluationConfig` to
+  evaluate on the dev set during training.
+  """
+
+  def get_labels(features):
+    """Returns (label_ids, is_real_example, label_weights) of a batch."""
+    label_ids = features["label_ids"]
+    is_real_example = None
+    label_weights = None
+    if "sequence_ids" in features:
+      # Packed rows have one label per [CLS] position; unused slots have a
+      # weight of 0.0 and count as padding examples.
+      label_ids = tf.reshape(label_ids, [-1])
+      is_real_example = tf.reshape(features["label_weights"], [-1])
+      label_weights = is_real_example
+    elif "is_real_example" in features:
+      is_real_example = tf.cast(features["is_real_example"], dtype=tf.float32)
+    else:
+      is_real_example = tf.ones(tf.shape(label_ids), dtype=tf.float32)
+    return (label_ids, is_real_example, label_weights)
+
+  def metric_fn(per_example_loss, label_ids, logits, is_real_example):
+    predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
+    accuracy = tf.metrics.accuracy(
+        labels=label_ids, predictions=predictions, weights=is_real_example)
+    loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
+    return {
+        "eval_accuracy": accuracy,
+        "eval_loss": loss,
+    }
+
+  def eval_metrics_fn(features):
+    """Builds the dev set model of `in_process_eval` on the same variables."""
+    (label_ids, is_real_example, label_weights) = get_labels(features)
+    (_, per_example_loss, logits, _) = create_model(
+        bert_config, False, features["input_ids"], features["input_mask"],
+        features["segment_ids"], label_ids, num_labels,
+        use_one_hot_embeddings,
+        label_weights=label_weights,
+        position_ids=features.get("position_ids"),
+        sequence_ids=features.get("sequence_ids"),
+        cls_positions=features.get("cls_positions"),
+        compute_type=compute_type,
+        # An explicit scope, since the default one would be uniquified.
+        scope="bert")
+    return metric_fn(per_example_loss, label_ids, logits, is_real_example)
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
     """The `model_fn` for TPUEstimator."""
@@ -548,23 +1074,32 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     input_ids = features["input_ids"]
     input_mask = features["input_mask"]
     segment_ids = features["segment_ids"]
-    label_ids = features["label_ids"]
-    is_real_example = None
-    if "is_real_example" in features:
-      is_real_example = tf.cast(features["is_real_example"], dtype=tf.float32)
-    else:
-      is_real_example = tf.ones(tf.shape(label_ids), dtype=tf.float32)
+    (label_ids, is_real_example, label_weights) = get_labels(features)
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
     (total_loss, per_example_loss, logits, probabilities) = create_model(
         bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels, use_one_hot_embeddings)
+        num_labels, use_one_hot_embeddings,
+        label_weights=label_weights,
+        position_ids=features.get("position_ids"),
+        sequence_ids=features.get("sequence_ids"),
+        cls_positions=features.get("cls_positions"),
+        compute_type=compute_type,
+        num_recomputed_layers=num_recomputed_layers,
+        num_frozen_layers=num_frozen_layers)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
     scaffold_fn = None
-    if init_checkpoint:
+    use_checkpoint_cache = bool(
+        init_checkpoint and init_checkpoint_cache_dir and not use_tpu)
+    if use_checkpoint_cache:
+      (scaffold_fn, initialized_variable_names
+       ) = checkpoint_cache.warm_start_scaffold_fn(
+          tvars, init_checkpoint, init_checkpoint_cache_dir,
+          init_checkpoint_cache_dtype)
+    elif init_checkpoint:
       (assignment_map, initialized_variable_names
        ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
       if use_tpu:
@@ -577,37 +1112,36 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
       else:
         tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
 
-    tf.logging.info("**** Trainable Variables ****")
-    for var in tvars:
-      init_string = ""
-      if var.name in initialized_variable_names:
-        init_string = ", *INIT_FROM_CKPT*"
-      tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape,
-                      init_string)
+    frozen_variables = modeling_ext.freeze_variables(num_frozen_layers)
+
+    checkpoint_cache.log_trainable_variables(
+        tvars, initialized_variable_names, frozen_variables,
+        summary_only=use_checkpoint_cache)
 
     output_spec = None
     if mode == tf.estimator.ModeKeys.TRAIN:
 
-      train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+      train_op = optimization_ext.create_optimizer(
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          gradient_accumulation_steps=gradient_accumulation_steps,
+          loss_scale=loss_scale)
+
+      training_hooks = []
+      if metrics_writer is not None and not use_tpu:
+        training_hooks.extend(metrics_hooks.create_training_hooks(
+            metrics_writer, features, metrics_every_n_steps,
+            num_workers=num_workers, worker_index=worker_index))
+      if in_process_eval is not None:
+        training_hooks.append(early_stopping.create_evaluation_hook(
+            in_process_eval, eval_metrics_fn, metrics_writer))
 
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
           loss=total_loss,
           train_op=train_op,
+          training_hooks=training_hooks,
           scaffold_fn=scaffold_fn)
     elif mode == tf.estimator.ModeKeys.EVAL:
-
-      def metric_fn(per_example_loss, label_ids, logits, is_real_example):
-        predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
-        accuracy = tf.metrics.accuracy(
-            labels=label_ids, predictions=predictions, weights=is_real_example)
-        loss = tf.metrics.mean(values=per_example_loss, weights=is_real_example)
-        return {
-            "eval_accuracy": accuracy,
-            "eval_loss": loss,
-        }
-
       eval_metrics = (metric_fn,
                       [per_example_loss, label_ids, logits, is_real_example])
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
@@ -700,11 +1234,6 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
 
-  processors = {
-      "livedoor": LivedoorProcessor,
-      "titanic":  TitanicProcessor
-  }
-
   tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case,
                                                 FLAGS.init_checkpoint)
 
@@ -712,7 +1241,8 @@ def main(_):
     raise ValueError(
         "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
 
-  bert_config = modeling.BertConfig.from_json_file(bert_config_file.name)
+  bert_config = modeling.BertConfig.from_dict(
+      utils.read_bert_config(CONFIGPATH, FLAGS.bert_config_name))
 
   if FLAGS.max_seq_length > bert_config.max_position_embeddings:
     raise ValueError(
@@ -720,14 +1250,39 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  if not 0 <= FLAGS.num_frozen_layers <= bert_config.num_hidden_layers:
+    raise ValueError("`num_frozen_layers` must be between 0 and %d." %
+                     bert_config.num_hidden_layers)
+
+  accumulation_steps = FLAGS.gradient_accumulation_steps
+  if accumulation_steps < 1:
+    raise ValueError("`gradient_accumulation_steps` must be at least 1.")
+  if accumulation_steps > 1 and FLAGS.use_tpu:
+    raise ValueError("`gradient_accumulation_steps` is not supported on TPU.")
+  if FLAGS.train_batch_size % accumulation_steps != 0:
+    raise ValueError(
+        "`train_batch_size` (%d) must be divisible by "
+        "`gradient_accumulation_steps` (%d)" %
+        (FLAGS.train_batch_size, accumulation_steps))
+  micro_batch_size = FLAGS.train_batch_size // accumulation_steps
+
+  compute_type = modeling_ext.get_compute_type(FLAGS.precision)
+  loss_scale = FLAGS.loss_scale if compute_type == tf.float16 else None
+
+  num_conversion_workers = (FLAGS.num_conversion_workers or
+                            multiprocessing.cpu_count())
+  if FLAGS.num_record_shards > 1 and FLAGS.max_sequences_per_pack > 1:
+    raise ValueError("`num_record_shards` is not supported with "
+                     "`max_sequences_per_pack` > 1.")
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
 
-  if task_name not in processors:
+  if task_name not in PROCESSORS:
     raise ValueError("Task not found: %s" % (task_name))
 
-  processor = processors[task_name]()
+  processor = PROCESSORS[task_name]()
 
   label_list = processor.get_labels()
 
@@ -745,55 +1300,150 @@ def main(_):
       cluster=tpu_cluster_resolver,
       master=FLAGS.master,
       model_dir=FLAGS.output_dir,
-      save_checkpoints_steps=FLAGS.save_checkpoints_steps,
+      # Gradient accumulators are not checkpointed, so checkpoints are only
+      # saved right after an optimizer update.
+      save_checkpoints_steps=FLAGS.save_checkpoints_steps * accumulation_steps,
       tpu_config=tf.contrib.tpu.TPUConfig(
           iterations_per_loop=FLAGS.iterations_per_loop,
           num_shards=FLAGS.num_tpu_cores,
           per_host_input_for_training=is_per_host))
 
-  train_examples = None
+  # With a cluster in `TF_CONFIG` every process trains in parallel on its own
+  # shard of the data; parameter server tasks block here serving variables.
+  distributed = distribute_utils.is_distributed(run_config)
+  if distributed:
+    if FLAGS.use_tpu:
+      raise ValueError("Multi-worker training is not supported on TPU.")
+    if accumulation_steps > 1:
+      raise ValueError("`gradient_accumulation_steps` is not supported in "
+                       "multi-worker training.")
+    if FLAGS.do_eval or FLAGS.do_predict or FLAGS.eval_every_n_steps > 0:
+      raise ValueError("Run evaluation and prediction as a separate process "
+                       "without `TF_CONFIG`.")
+    distribute_utils.start_server(run_config)
+  (num_shards, shard_index) = distribute_utils.get_input_shard(run_config)
+
+  num_train_examples = None
   num_train_steps = None
   num_warmup_steps = None
   if FLAGS.do_train:
-    train_examples = processor.get_train_examples(FLAGS.data_dir)
+    # The examples are streamed into the TFRecord file; only their number is
+    # counted up front.
+    num_train_examples = processor.get_num_examples(FLAGS.data_dir, "train")
+    train_examples = processor.iter_train_examples(FLAGS.data_dir)
+    train_file = distribute_utils.get_task_file(
+        os.path.join(FLAGS.output_dir, "train.tf_record"), run_config)
+    num_train_records = file_based_convert_examples_to_features(
+        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file,
+        FLAGS.max_sequences_per_pack, num_examples=num_train_examples,
+        num_workers=num_conversion_workers,
+        num_record_shards=FLAGS.num_record_shards)
     num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+        num_train_records / FLAGS.train_batch_size * FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
 
+  in_process_eval = None
+  if FLAGS.do_train and FLAGS.eval_every_n_steps > 0:
+    if FLAGS.use_tpu:
+      raise ValueError("`eval_every_n_steps` is not supported on TPU.")
+    if FLAGS.keep_best_checkpoints < 1:
+      raise ValueError("`keep_best_checkpoints` must be at least 1.")
+    dev_file = os.path.join(FLAGS.output_dir, "dev.tf_record")
+    file_based_convert_examples_to_features(
+        processor.get_dev_examples(FLAGS.data_dir), label_list,
+        FLAGS.max_seq_length, tokenizer, dev_file,
+        FLAGS.max_sequences_per_pack, num_workers=num_conversion_workers)
+    in_process_eval = early_stopping.EvaluationConfig(
+        input_fn=file_based_input_fn_builder(
+            input_file=dev_file,
+            seq_length=FLAGS.max_seq_length,
+            is_training=False,
+            drop_remainder=False,
+            max_sequences_per_pack=FLAGS.max_sequences_per_pack),
+        batch_size=FLAGS.eval_batch_size,
+        # Evaluate right after an optimizer update, like checkpoints.
+        every_n_steps=FLAGS.eval_every_n_steps * accumulation_steps,
+        output_dir=FLAGS.output_dir,
+        metric_name=FLAGS.early_stopping_metric,
+        metric_mode=FLAGS.early_stopping_mode,
+        keep_best=FLAGS.keep_best_checkpoints,
+        patience=FLAGS.early_stopping_patience,
+        min_delta=FLAGS.early_stopping_min_delta)
+
+  metrics_writer = None
+  saving_listeners = None
+  if FLAGS.metrics_file and not FLAGS.use_tpu:
+    metrics_writer = metrics_hooks.MetricsWriter(
+        distribute_utils.get_task_file(FLAGS.metrics_file, run_config),
+        FLAGS.output_dir if run_config.is_chief else None)
+    saving_listeners = [metrics_hooks.CheckpointTimingListener(metrics_writer)]
+
   model_fn = model_fn_builder(
       bert_config=bert_config,
       num_labels=len(label_list),
       init_checkpoint=FLAGS.init_checkpoint,
+      init_checkpoint_cache_dir=FLAGS.init_checkpoint_cache_dir,
+      init_checkpoint_cache_dtype=FLAGS.init_checkpoint_cache_dtype,
       learning_rate=FLAGS.learning_rate,
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
-
-  # If TPU is not available, this will fall back to normal Estimator on CPU
-  # or GPU.
-  estimator = tf.contrib.tpu.TPUEstimator(
-      use_tpu=FLAGS.use_tpu,
-      model_fn=model_fn,
-      config=run_config,
-      train_batch_size=FLAGS.train_batch_size,
-      eval_batch_size=FLAGS.eval_batch_size,
-      predict_batch_size=FLAGS.predict_batch_size)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      metrics_writer=metrics_writer,
+      metrics_every_n_steps=FLAGS.metrics_every_n_steps,
+      gradient_accumulation_steps=accumulation_steps,
+      compute_type=compute_type,
+      loss_scale=loss_scale,
+      num_recomputed_layers=FLAGS.num_recomputed_layers,
+      num_frozen_layers=FLAGS.num_frozen_layers,
+      num_workers=num_shards,
+      worker_index=shard_index,
+      in_process_eval=in_process_eval)
+
+  if distributed:
+    estimator = distribute_utils.create_estimator(model_fn, run_config,
+                                                  micro_batch_size)
+  else:
+    # If TPU is not available, this will fall back to normal Estimator on CPU
+    # or GPU.
+    estimator = tf.contrib.tpu.TPUEstimator(
+        use_tpu=FLAGS.use_tpu,
+        model_fn=model_fn,
+        config=run_config,
+        train_batch_size=micro_batch_size,
+        eval_batch_size=FLAGS.eval_batch_size,
+        predict_batch_size=FLAGS.predict_batch_size)
 
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
-    file_based_convert_examples_to_features(
-        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
     tf.logging.info("***** Running training *****")
-    tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Num examples = %d", num_train_examples)
+    tf.logging.info("  Num records = %d", num_train_records)
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", num_train_steps)
+    if accumulation_steps > 1:
+      tf.logging.info("  Micro-batch size = %d (%d accumulation steps)",
+                      micro_batch_size, accumulation_steps)
     train_input_fn = file_based_input_fn_builder(
         input_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
-        drop_remainder=True)
-    estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
+        drop_remainder=True,
+        max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+        num_shards=num_shards,
+        shard_index=shard_index,
+        num_record_shards=FLAGS.num_record_shards)
+    # `num_train_steps` counts optimizer updates, the global step counts
+    # micro-batches.
+    estimator.train(input_fn=train_input_fn,
+                    max_steps=num_train_steps * accumulation_steps,
+                    saving_listeners=saving_listeners)
+
+  # With in-process evaluation, eval and predict use the best checkpoint
+  # instead of the latest one.
+  checkpoint_path = None
+  if in_process_eval is not None:
+    checkpoint_path = early_stopping.get_best_checkpoint(FLAGS.output_dir)
+    tf.logging.info("Best checkpoint: %s", checkpoint_path)
 
   if FLAGS.do_eval:
     eval_examples = processor.get_dev_examples(FLAGS.data_dir)
@@ -807,9 +1457,13 @@ def main(_):
       while len(eval_examples) % FLAGS.eval_batch_size != 0:
         eval_examples.append(PaddingInputExample())
 
+    # Packed rows cannot be padded to a fixed number of examples per batch,
+    # so eval on the TPU always uses unpacked records.
+    eval_sequences_per_pack = 1 if FLAGS.use_tpu else FLAGS.max_sequences_per_pack
     eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
     file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
+        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file,
+        eval_sequences_per_pack, num_workers=num_conversion_workers)
 
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -830,9 +1484,11 @@ def main(_):
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=eval_drop_remainder)
+        drop_remainder=eval_drop_remainder,
+        max_sequences_per_pack=eval_sequences_per_pack)
 
-    result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
+    result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps,
+                                checkpoint_path=checkpoint_path)
 
     output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
     with tf.gfile.GFile(output_eval_file, "w") as writer:
@@ -841,26 +1497,112 @@ def main(_):
         tf.logging.info("  %s = %s", key, str(result[key]))
         writer.write("%s = %s\n" % (key, str(result[key])))
 
-  if FLAGS.do_predict:
-    predict_examples = processor.get_test_examples(FLAGS.data_dir)
-    num_actual_predict_examples = len(predict_examples)
+  if FLAGS.do_predict and FLAGS.predict_chunk_size > 0:
+    # Every chunk is predicted with the same weights, also after a restart.
+    predict_checkpoint = checkpoint_path or estimator.latest_checkpoint()
+    predict_file = os.path.join(FLAGS.output_dir, "predict-chunk.tf_record")
+    num_predict_examples = processor.get_num_examples(FLAGS.data_dir, "test")
+    prediction_writer = None
+    if FLAGS.predict_output_format == "npy":
+      # Rows are written at their example index, so the arrays of an
+      # interrupted run are resumed as they are.
+      prediction_writer = prediction_output.NpyPredictionWriter(
+          FLAGS.output_dir, label_list, num_predict_examples,
+          dtype=FLAGS.predict_output_dtype, top_k=FLAGS.predict_top_k,
+          resume=True)
+
+    def predict_chunk(examples, start_index):
+      num_actual_examples = len(examples)
+      if FLAGS.use_tpu:
+        examples = examples + [
+            PaddingInputExample()
+            for _ in range(-len(examples) % FLAGS.predict_batch_size)
+        ]
+      file_based_convert_examples_to_features(
+          examples, label_list, FLAGS.max_seq_length, tokenizer, predict_file,
+          num_workers=num_conversion_workers)
+      predict_input_fn = file_based_input_fn_builder(
+          input_file=predict_file,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=FLAGS.use_tpu)
+      result = estimator.predict(input_fn=predict_input_fn,
+                                 checkpoint_path=predict_checkpoint)
+      probabilities = [
+          prediction["probabilities"]
+          for prediction in itertools.islice(result, num_actual_examples)
+      ]
+      if prediction_writer is not None:
+        prediction_writer.write(start_index, probabilities)
+        prediction_writer.flush()
+      return probabilities
+
+    def format_prediction(example, probabilities):
+      if prediction_writer is not None:
+        # The probabilities are in the arrays; the guids keep their order.
+        return example.guid + "\n"
+      return "\t".join([example.guid] + [
+          str(class_probability) for class_probability in probabilities
+      ]) + "\n"
+
+    tf.logging.info("***** Running chunked prediction *****")
+    tf.logging.info("  Num examples = %d", num_predict_examples)
+    tf.logging.info("  Chunk size = %d", FLAGS.predict_chunk_size)
+    tf.logging.info("  Checkpoint = %s", predict_checkpoint)
+    if prediction_writer is not None:
+      output_predict_file = os.path.join(FLAGS.output_dir, "test_guids.txt")
+    else:
+      output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
+    num_written_lines = resumable_predict.predict_in_chunks(
+        processor.iter_test_examples(FLAGS.data_dir),
+        FLAGS.predict_chunk_size,
+        predict_fn=predict_chunk,
+        format_fn=format_prediction,
+        output_file=output_predict_file,
+        settings={
+            "task_name": task_name,
+            "data_dir": os.path.abspath(FLAGS.data_dir),
+            "checkpoint": predict_checkpoint,
+            "max_seq_length": FLAGS.max_seq_length,
+            "chunk_size": FLAGS.predict_chunk_size,
+            "output_format": FLAGS.predict_output_format,
+            "output_dtype": FLAGS.predict_output_dtype,
+            "top_k": FLAGS.predict_top_k,
+        })
+    tf.logging.info("Wrote %d predictions to %s", num_written_lines,
+                    output_predict_file)
+
+  elif FLAGS.do_predict:
+    # The test set is streamed into the TFRecord file, so large prediction
+    # sets are never held in memory as a whole.
+    predict_examples = processor.iter_test_examples(FLAGS.data_dir)
+    num_actual_predict_examples = processor.get_num_examples(
+        FLAGS.data_dir, "test")
+    num_padding_examples = 0
     if FLAGS.use_tpu:
       # TPU requires a fixed batch size for all batches, therefore the number
       # of examples must be a multiple of the batch size, or else examples
       # will get dropped. So we pad with fake examples which are ignored
       # later on.
-      while len(predict_examples) % FLAGS.predict_batch_size != 0:
-        predict_examples.append(PaddingInputExample())
+      num_padding_examples = (-num_actual_predict_examples %
+                              FLAGS.predict_batch_size)
+      predict_examples = itertools.chain(
+          predict_examples,
+          [PaddingInputExample() for _ in range(num_padding_examples)])
 
     predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
-    file_based_convert_examples_to_features(predict_examples, label_list,
-                                            FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
+    num_predict_records = file_based_convert_examples_to_features(
+        predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+        predict_file, num_examples=num_actual_predict_examples,
+        num_workers=num_conversion_workers,
+        num_record_shards=FLAGS.num_record_shards)
+    assert (num_predict_records ==
+            num_actual_predict_examples + num_padding_examples)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
-                    len(predict_examples), num_actual_predict_examples,
-                    len(predict_examples) - num_actual_predict_examples)
+                    num_predict_records, num_actual_predict_examples,
+                    num_padding_examples)
     tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
 
     predict_drop_remainder = True if FLAGS.use_tpu else False
@@ -868,23 +1610,43 @@ def main(_):
         input_file=predict_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=predict_drop_remainder)
+        drop_remainder=predict_drop_remainder,
+        num_record_shards=FLAGS.num_record_shards)
 
-    result = estimator.predict(input_fn=predict_input_fn)
+    result = estimator.predict(input_fn=predict_input_fn,
+                               checkpoint_path=checkpoint_path)
 
-    output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
-    with tf.gfile.GFile(output_predict_file, "w") as writer:
-      num_written_lines = 0
+    if FLAGS.predict_output_format == "npy":
+      prediction_writer = prediction_output.NpyPredictionWriter(
+          FLAGS.output_dir, label_list, num_actual_predict_examples,
+          dtype=FLAGS.predict_output_dtype, top_k=FLAGS.predict_top_k)
       tf.logging.info("***** Predict results *****")
-      for (i, prediction) in enumerate(result):
-        probabilities = prediction["probabilities"]
-        if i >= num_actual_predict_examples:
-          break
-        output_line = "\t".join(
-            str(class_probability)
-            for class_probability in probabilities) + "\n"
-        writer.write(output_line)
-        num_written_lines += 1
+      num_written_lines = 0
+      block = []
+      for prediction in itertools.islice(result, num_actual_predict_examples):
+        block.append(prediction["probabilities"])
+        if len(block) == FLAGS.predict_batch_size:
+          prediction_writer.write(num_written_lines, block)
+          num_written_lines += len(block)
+          block = []
+      if block:
+        prediction_writer.write(num_written_lines, block)
+        num_written_lines += len(block)
+      prediction_writer.flush()
+    else:
+      output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
+      with tf.gfile.GFile(output_predict_file, "w") as writer:
+        num_written_lines = 0
+        tf.logging.info("***** Predict results *****")
+        for (i, prediction) in enumerate(result):
+          probabilities = prediction["probabilities"]
+          if i >= num_actual_predict_examples:
+            break
+          output_line = "\t".join(
+              str(class_probability)
+              for class_probability in probabilities) + "\n"
+          writer.write(output_line)
+          num_written_lines += 1
     assert num_written_lines == num_actual_predict_examples
 
 
@@ -892,6 +1654,5 @@ if __name__ == "__main__":
   flags.mark_flag_as_required("data_dir")
   flags.mark_flag_as_required("task_name")
   flags.mark_flag_as_required("model_file")
-  flags.mark_flag_as_required("vocab_file")
   flags.mark_flag_as_required("output_dir")
-  tf.app.run()
+  app.run(main)
@@ -0,0 +1,428 @@
+# coding=utf-8
+"""Multi-task BERT finetuning runner.
+
+Trains one shared encoder with one classification layer per task, so that
+prediction computes the probabilities of all tasks in a single encoder pass.
+Every task is given as
+
+  --tasks=NAME:PROCESSOR:DATA_DIR
+
+where PROCESSOR is one of the processors of run_classifier.py ("livedoor",
+"titanic") or "tsv" for an ad-hoc label set, whose labels are read from the
+"label" column of DATA_DIR/train.tsv. The train (and dev) examples of all
+tasks are mixed in one shuffled data set; every example only contributes to
+the loss and metrics of its own task.
+
+Prediction reads the "text" column of `--predict_file` and writes one row of
+probabilities per text, with the columns of all tasks, to test_results.tsv.
+All other flags are those of run_classifier.py, e.g.
+
+  python3 src/run_multitask_classifier.py \
+    --tasks=genre:livedoor:data/livedoor --tasks=event:tsv:data/events \
+    --model_file=model/wiki-ja.model --vocab_file=model/wiki-ja.vocab \
+    --init_checkpoint=model/model.ckpt-1400000 --output_dir=/tmp/multitask \
+    --do_train=True --do_eval=True --num_train_epochs=3
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import csv
+import json
+import os
+import random
+import run_classifier
+import tokenization_sentencepiece as tokenization
+import utils
+from absl import app
+from absl import flags
+
+# TensorFlow and the model code are imported when first used, so `--help` and
+# flag errors do not import them. run_classifier adds the BERT submodule to
+# the module path.
+tf = utils.LazyModule("tensorflow")
+modeling = utils.LazyModule("modeling")
+modeling_ext = utils.LazyModule("modeling_ext")
+optimization_ext = utils.LazyModule("optimization_ext")
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_multi_string(
+    "tasks", None,
+    "One task per flag, as NAME:PROCESSOR:DATA_DIR. PROCESSOR is a processor "
+    "of run_classifier.py or \"tsv\" to read the labels from train.tsv.")
+
+flags.DEFINE_string(
+    "predict_file", None,
+    "TSV file with a \"text\" column, classified for all tasks by `do_predict`.")
+
+Task = collections.namedtuple("Task", ["name", "processor", "data_dir",
+                                       "labels"])
+
+
+class TsvProcessor(run_classifier.TextLabelProcessor):
+  """Processor for an ad-hoc label set in "text" and "label" TSV columns."""
+
+  def __init__(self, data_dir):
+    self.data_dir = data_dir
+
+  def get_labels(self):
+    """See base class."""
+    return sorted(set(example.label
+                      for example in self.iter_train_examples(self.data_dir)))
+
+
+def parse_tasks(task_specs):
+  """Parses the `tasks` flags into a list of `Task`s."""
+  tasks = []
+  for spec in task_specs:
+    fields = spec.split(":", 2)
+    if len(fields) != 3:
+      raise ValueError("Invalid task %s, expected NAME:PROCESSOR:DATA_DIR" %
+                       spec)
+    (name, processor_name, data_dir) = fields
+    if processor_name == "tsv":
+      processor = TsvProcessor(data_dir)
+    elif processor_name in run_classifier.PROCESSORS:
+      processor = run_classifier.PROCESSORS[processor_name]()
+    else:
+      raise ValueError("Processor not found: %s" % processor_name)
+    tasks.append(Task(name, processor, data_dir, processor.get_labels()))
+  if len(set(task.name for task in tasks)) != len(tasks):
+    raise ValueError("Task names must be unique.")
+  return tasks
+
+
+def load_task_labels(tasks, output_dir, do_train):
+  """Keeps the label order of every task fixed between training and predict.
+
+  Training writes the labels of all tasks to `output_dir`/tasks.json; later
+  runs on the same model use the label lists from there.
+  """
+  tasks_file = os.path.join(output_dir, "tasks.json")
+  if do_train or not tf.gfile.Exists(tasks_file):
+    with tf.gfile.GFile(tasks_file, "w") as writer:
+      json.dump([{"name": task.name, "labels": task.labels} for task in tasks],
+                writer, indent=2, ensure_ascii=False)
+    return tasks
+  with tf.gfile.GFile(tasks_file) as reader:
+    saved = {task["name"]: task["labels"] for task in json.load(reader)}
+  return [task._replace(labels=saved.get(task.name, task.labels))
+          for task in tasks]
+
+
+def file_based_convert_examples_to_features(task_examples, tasks,
+                                            max_seq_length, tokenizer,
+                                            output_file, shuffle=False):
+  """Writes (task index, `InputExample`) pairs to a TFRecord file.
+
+  Returns the number of records.
+  """
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  if shuffle:
+    task_examples = list(task_examples)
+    random.Random(12345).shuffle(task_examples)
+
+  writer = tf.python_io.TFRecordWriter(output_file)
+  for (ex_index, (task_id, example)) in enumerate(task_examples):
+    if ex_index % 10000 == 0:
+      tf.logging.info("Writing example %d of %d" % (ex_index,
+                                                    len(task_examples)))
+    feature = run_classifier.convert_single_example(
+        ex_index, example, tasks[task_id].labels, max_seq_length, tokenizer)
+
+    features = collections.OrderedDict()
+    features["input_ids"] = create_int_feature(feature.input_ids)
+    features["input_mask"] = create_int_feature(feature.input_mask)
+    features["segment_ids"] = create_int_feature(feature.segment_ids)
+    features["label_ids"] = create_int_feature([feature.label_id])
+    features["task_ids"] = create_int_feature([task_id])
+
+    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+    writer.write(tf_example.SerializeToString())
+  writer.close()
+  return len(task_examples)
+
+
+def file_based_input_fn_builder(input_file, seq_length, is_training):
+  """Creates an `input_fn` closure to be passed to Estimator."""
+
+  name_to_features = {
+      "input_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
+      "input_mask": tf.io.FixedLenFeature([seq_length], tf.int64),
+      "segment_ids": tf.io.FixedLenFeature([seq_length], tf.int64),
+      "label_ids": tf.io.FixedLenFeature([], tf.int64),
+      "task_ids": tf.io.FixedLenFeature([], tf.int64),
+  }
+
+  def _decode_record(record, name_to_features):
+    """Decodes a record to a TensorFlow example."""
+    example = tf.parse_single_example(record, name_to_features)
+    for name in list(example.keys()):
+      example[name] = tf.to_int32(example[name])
+    return example
+
+  def input_fn(params):
+    """The actual input function."""
+    d = tf.data.TFRecordDataset(input_file)
+    if is_training:
+      d = d.repeat()
+      d = d.shuffle(buffer_size=100)
+    d = d.apply(
+        tf.contrib.data.map_and_batch(
+            lambda record: _decode_record(record, name_to_features),
+            batch_size=params["batch_size"],
+            drop_remainder=False))
+    return d
+
+  return input_fn
+
+
+def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
+                 label_ids, task_ids, tasks, compute_type="float32"):
+  """Creates the shared encoder and one classification layer per task.
+
+  Returns:
+    (total_loss, dict of task name to (per_example_loss, logits,
+    probabilities, task_mask)).
+  """
+  model = modeling_ext.BertModel(
+      config=bert_config,
+      is_training=is_training,
+      input_ids=input_ids,
+      input_mask=input_mask,
+      token_type_ids=segment_ids,
+      compute_type=tf.as_dtype(compute_type))
+  output_layer = model.get_pooled_output()
+
+  batch_size = tf.cast(tf.shape(input_ids)[0], tf.float32)
+  total_loss = 0.0
+  outputs = {}
+  for (task_id, task) in enumerate(tasks):
+    task_mask = tf.cast(tf.equal(task_ids, task_id), tf.float32)
+    with tf.variable_scope("task_%s" % task.name):
+      # Labels of the other tasks may be out of range of this task; their
+      # one-hot vectors are all zeros and their weight is 0.0.
+      (_, per_example_loss, logits, probabilities
+      ) = run_classifier.create_classifier_output(
+          output_layer, is_training, label_ids, len(task.labels),
+          label_weights=task_mask)
+    # Every example counts once, for its own task.
+    total_loss += tf.reduce_sum(task_mask * per_example_loss) / batch_size
+    outputs[task.name] = (per_example_loss, logits, probabilities, task_mask)
+  return (total_loss, outputs)
+
+
+def model_fn_builder(bert_config, tasks, init_checkpoint, learning_rate,
+                     num_train_steps, num_warmup_steps,
+                     compute_type="float32"):
+  """Returns `model_fn` closure for Estimator."""
+
+  def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+    """The `model_fn` for Estimator."""
+    is_training = (mode == tf.estimator.ModeKeys.TRAIN)
+    label_ids = features["label_ids"]
+    (total_loss, outputs) = create_model(
+        bert_config, is_training, features["input_ids"],
+        features["input_mask"], features["segment_ids"], label_ids,
+        features["task_ids"], tasks, compute_type=compute_type)
+
+    tvars = tf.trainable_variables()
+    initialized_variable_names = {}
+    if init_checkpoint:
+      (assignment_map, initialized_variable_names
+       ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+
+    tf.logging.info("**** Trainable Variables ****")
+    for var in tvars:
+      init_string = ""
+      if var.name in initialized_variable_names:
+        init_string = ", *INIT_FROM_CKPT*"
+      tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape,
+                      init_string)
+
+    if mode == tf.estimator.ModeKeys.TRAIN:
+      train_op = optimization_ext.create_optimizer(
+          total_loss, learning_rate, num_train_steps, num_warmup_steps,
+          use_tpu=False)
+      return tf.estimator.EstimatorSpec(
+          mode=mode, loss=total_loss, train_op=train_op)
+    elif mode == tf.estimator.ModeKeys.EVAL:
+      eval_metric_ops = {}
+      for (name, (per_example_loss, logits, _, task_mask)) in outputs.items():
+        predictions = tf.argmax(logits, axis=-1, output_type=tf.int32)
+        eval_metric_ops["%s_eval_accuracy" % name] = tf.metrics.accuracy(
+            labels=label_ids, predictions=predictions, weights=task_mask)
+        eval_metric_ops["%s_eval_loss" % name] = tf.metrics.mean(
+            values=per_example_loss, weights=task_mask)
+      return tf.estimator.EstimatorSpec(
+          mode=mode, loss=total_loss, eval_metric_ops=eval_metric_ops)
+    predictions = {
+        name: probabilities
+        for (name, (_, _, probabilities, _)) in outputs.items()
+    }
+    return tf.estimator.EstimatorSpec(mode=mode, predictions=predictions)
+
+  return model_fn
+
+
+def read_predict_examples(predict_file):
+  """Reads the "text" column of `predict_file` as label-less examples."""
+  examples = []
+  with tf.gfile.Open(predict_file, "r") as f:
+    reader = csv.reader(f, delimiter="\t")
+    for (i, line) in enumerate(reader):
+      if i == 0:
+        idx_text = line.index("text")
+      else:
+        examples.append(run_classifier.InputExample(
+            guid="test-%d" % i,
+            text_a=tokenization.convert_to_unicode(line[idx_text]),
+            label=None))
+  return examples
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+
+  if not FLAGS.do_train and not FLAGS.do_eval and not FLAGS.do_predict:
+    raise ValueError(
+        "At least one of `do_train`, `do_eval` or `do_predict' must be True.")
+  if FLAGS.use_tpu:
+    raise ValueError("run_multitask_classifier.py does not support TPU.")
+  if FLAGS.do_predict and not FLAGS.predict_file:
+    raise ValueError("`do_predict` needs a `predict_file`.")
+
+  bert_config = modeling.BertConfig.from_dict(
+      utils.read_bert_config(run_classifier.CONFIGPATH, FLAGS.bert_config_name))
+  if FLAGS.max_seq_length > bert_config.max_position_embeddings:
+    raise ValueError(
+        "Cannot use sequence length %d because the BERT model "
+        "was only trained up to sequence length %d" %
+        (FLAGS.max_seq_length, bert_config.max_position_embeddings))
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+  tasks = load_task_labels(parse_tasks(FLAGS.tasks), FLAGS.output_dir,
+                           FLAGS.do_train)
+  for task in tasks:
+    tf.logging.info("Task %s: %d labels from %s", task.name, len(task.labels),
+                    task.data_dir)
+
+  tokenizer = tokenization.FullTokenizer(
+      model_file=FLAGS.model_file, vocab_file=FLAGS.vocab_file,
+      do_lower_case=FLAGS.do_lower_case)
+
+  num_train_steps = None
+  num_warmup_steps = None
+  if FLAGS.do_train:
+    train_examples = [
+        (task_id, example) for (task_id, task) in enumerate(tasks)
+        for example in task.processor.get_train_examples(task.data_dir)
+    ]
+    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
+    file_based_convert_examples_to_features(
+        train_examples, tasks, FLAGS.max_seq_length, tokenizer, train_file,
+        shuffle=True)
+    num_train_steps = int(
+        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+    num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
+
+  model_fn = model_fn_builder(
+      bert_config=bert_config,
+      tasks=tasks,
+      init_checkpoint=FLAGS.init_checkpoint,
+      learning_rate=FLAGS.learning_rate,
+      num_train_steps=num_train_steps,
+      num_warmup_steps=num_warmup_steps,
+      compute_type=modeling_ext.get_compute_type(FLAGS.precision))
+  run_config = tf.estimator.RunConfig(
+      model_dir=FLAGS.output_dir,
+      save_checkpoints_steps=FLAGS.save_checkpoints_steps)
+
+  def create_estimator(batch_size):
+    return tf.estimator.Estimator(model_fn=model_fn, config=run_config,
+                                  params={"batch_size": batch_size})
+
+  if FLAGS.do_train:
+    tf.logging.info("***** Running training *****")
+    tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
+    tf.logging.info("  Num steps = %d", num_train_steps)
+    train_input_fn = file_based_input_fn_builder(
+        input_file=train_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=True)
+    create_estimator(FLAGS.train_batch_size).train(
+        input_fn=train_input_fn, max_steps=num_train_steps)
+
+  if FLAGS.do_eval:
+    eval_examples = [
+        (task_id, example) for (task_id, task) in enumerate(tasks)
+        for example in task.processor.get_dev_examples(task.data_dir)
+    ]
+    eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
+    file_based_convert_examples_to_features(
+        eval_examples, tasks, FLAGS.max_seq_length, tokenizer, eval_file)
+
+    tf.logging.info("***** Running evaluation *****")
+    tf.logging.info("  Num examples = %d", len(eval_examples))
+    tf.logging.info("  Batch size = %d", FLAGS.eval_batch_size)
+    eval_input_fn = file_based_input_fn_builder(
+        input_file=eval_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=False)
+    result = create_estimator(FLAGS.eval_batch_size).evaluate(
+        input_fn=eval_input_fn)
+
+    output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
+    with tf.gfile.GFile(output_eval_file, "w") as writer:
+      tf.logging.info("***** Eval results *****")
+      for key in sorted(result.keys()):
+        tf.logging.info("  %s = %s", key, str(result[key]))
+        writer.write("%s = %s\n" % (key, str(result[key])))
+
+  if FLAGS.do_predict:
+    # Predict examples have no labels; every example is converted with the
+    # placeholder label list [None] and goes through all tasks.
+    predict_examples = [
+        (0, example) for example in read_predict_examples(FLAGS.predict_file)
+    ]
+    predict_tasks = [task._replace(labels=[None]) for task in tasks]
+    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+    file_based_convert_examples_to_features(
+        predict_examples, predict_tasks, FLAGS.max_seq_length, tokenizer,
+        predict_file)
+
+    tf.logging.info("***** Running prediction*****")
+    tf.logging.info("  Num examples = %d", len(predict_examples))
+    tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
+    predict_input_fn = file_based_input_fn_builder(
+        input_file=predict_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=False)
+    result = create_estimator(FLAGS.predict_batch_size).predict(
+        input_fn=predict_input_fn)
+
+    output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
+    with tf.gfile.GFile(output_predict_file, "w") as writer:
+      tf.logging.info("***** Predict results *****")
+      writer.write("\t".join("%s:%s" % (task.name, label) for task in tasks
+                             for label in task.labels) + "\n")
+      for prediction in result:
+        writer.write("\t".join(
+            str(class_probability) for task in tasks
+            for class_probability in prediction[task.name]) + "\n")
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("tasks")
+  flags.mark_flag_as_required("model_file")
+  flags.mark_flag_as_required("output_dir")
+  app.run(main)
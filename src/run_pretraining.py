@@ -7,26 +7,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import configparser
-import json
+import checkpoint_cache
+import collections
+import distribute_utils
 import os
 import sys
-import tempfile
+import metrics_hooks
 import tensorflow as tf
 import utils
 
 CURDIR = os.path.dirname(os.path.abspath(__file__))
 CONFIGPATH = os.path.join(CURDIR, os.pardir, 'config.ini')
-config = configparser.ConfigParser()
-config.read(CONFIGPATH)
-bert_config_file = tempfile.NamedTemporaryFile(mode='w+t', encoding='utf-8', suffix='.json')
-bert_config_file.write(json.dumps({k:utils.str_to_value(v) for k,v in config['BERT-CONFIG'].items()}))
-bert_config_file.seek(0)
 
 sys.path.append(os.path.join(CURDIR, os.pardir, 'bert'))
 import modeling
-import optimization
+import modeling_ext
+import optimization_ext
 
+AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 flags = tf.flags
 
@@ -38,9 +36,16 @@ flags.DEFINE_string(
     "The config json file corresponding to the pre-trained BERT model. "
     "This specifies the model architecture.")
 
+flags.DEFINE_string(
+    "bert_config_name", None,
+    "Name of the model config in config.ini: the [BERT-CONFIG:NAME] section, "
+    "which overrides values of [BERT-CONFIG]. Uses [BERT-CONFIG] if not "
+    "set.")
+
 flags.DEFINE_string(
     "input_file", None,
-    "Input TF example files (can be a glob or comma separated).")
+    "Input TF example files (can be a glob or comma separated). Used for "
+    "training unless `train_phases` is given, and for evaluation.")
 
 flags.DEFINE_string(
     "output_dir", None,
@@ -51,6 +56,18 @@ flags.DEFINE_string(
     "init_checkpoint", None,
     "Initial checkpoint (usually from a pre-trained BERT model).")
 
+flags.DEFINE_string(
+    "init_checkpoint_cache_dir", None,
+    "[Optional] Local directory of a warm-start cache of `init_checkpoint` "
+    "(see checkpoint_cache.py). The cache is built on the first run and "
+    "memory-mapped afterwards, so later runs do not read the checkpoint. "
+    "Only used if `use_tpu` is False.")
+
+flags.DEFINE_enum(
+    "init_checkpoint_cache_dtype", "float32", ["float32", "float16"],
+    "Storage type of the warm-start cache. float16 halves its size at a "
+    "small loss of precision.")
+
 flags.DEFINE_integer(
     "max_seq_length", 128,
     "The maximum total input sequence length after WordPiece tokenization. "
@@ -62,6 +79,23 @@ flags.DEFINE_integer(
     "Maximum number of masked LM predictions per sequence. "
     "Must match data generation.")
 
+flags.DEFINE_multi_string(
+    "train_phases", None,
+    "Sequence length curriculum, one flag per phase in the format "
+    "MAX_SEQ_LENGTH:MAX_PREDICTIONS_PER_SEQ:FRACTION:INPUT_FILES, e.g. "
+    "`--train_phases=128:20:0.9:data/seq128/*.tfrecord "
+    "--train_phases=512:80:0.1:data/seq512/*.tfrecord`. Phases run in the "
+    "given order, each for FRACTION of `num_train_steps`, continuing from the "
+    "checkpoints of the previous phase. `train_batch_size` is the batch size "
+    "at `max_seq_length`; phases with other lengths scale it so that the "
+    "number of tokens per batch stays the same. If not set, training uses "
+    "`input_file` at `max_seq_length`.")
+
+flags.DEFINE_integer(
+    "max_sequences_per_pack", 1,
+    "Maximum number of instances packed into one row. Must match data "
+    "generation. 1 means the input is not packed.")
+
 flags.DEFINE_bool("do_train", False, "Whether to run training.")
 
 flags.DEFINE_bool("do_eval", False, "Whether to run eval on the dev set.")
@@ -76,6 +110,46 @@ flags.DEFINE_integer("num_train_steps", 100000, "Number of training steps.")
 
 flags.DEFINE_integer("num_warmup_steps", 10000, "Number of warmup steps.")
 
+flags.DEFINE_integer(
+    "gradient_accumulation_steps", 1,
+    "Number of micro-batches whose gradients are summed before each optimizer "
+    "update. `train_batch_size` stays the effective batch size and must be "
+    "divisible by this; every micro-batch holds "
+    "`train_batch_size / gradient_accumulation_steps` examples. "
+    "`num_train_steps`, `num_warmup_steps` and `save_checkpoints_steps` count "
+    "optimizer updates. Only used if `use_tpu` is False.")
+
+flags.DEFINE_enum(
+    "precision", "float32", list(utils.PRECISIONS),
+    "Type of the transformer activations and matmuls. With float16 or "
+    "bfloat16 the variables stay float32, and layer normalization and the "
+    "attention softmax run in float32.")
+
+flags.DEFINE_float(
+    "loss_scale", 0,
+    "Loss scale for training with `precision=float16`; 0 selects dynamic loss "
+    "scaling. Not used with float32 or bfloat16.")
+
+flags.DEFINE_integer(
+    "num_recomputed_layers", 0,
+    "Number of transformer layers, counted from the bottom, whose activations "
+    "are recomputed in the backward pass instead of being kept in memory. "
+    "Costs roughly one extra forward pass of those layers per step but allows "
+    "much larger batches at long sequence lengths.")
+
+flags.DEFINE_enum(
+    "masked_lm_loss", "dense", ["dense", "sparse", "sampled"],
+    "Masked LM training loss. `dense` computes log probs over the whole "
+    "vocabulary for every prediction slot. `sparse` skips the padding slots "
+    "and computes the exact cross-entropy from integer labels. `sampled` also "
+    "skips the padding slots and approximates the softmax with "
+    "`masked_lm_num_sampled` sampled classes. Evaluation and TPU training "
+    "always use `dense`.")
+
+flags.DEFINE_integer(
+    "masked_lm_num_sampled", 8192,
+    "Number of sampled classes for `masked_lm_loss=sampled`.")
+
 flags.DEFINE_integer("save_checkpoints_steps", 1000,
                      "How often to save the model checkpoint.")
 
@@ -110,10 +184,44 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_integer(
+    "num_cpu_threads", 4,
+    "Number of files read in parallel and of parallel parsing calls in the "
+    "input pipeline. -1 lets tf.data autotune it.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 10000,
+    "Number of records in the shuffle window of the training input pipeline.")
+
+flags.DEFINE_integer(
+    "prefetch_buffer_size", -1,
+    "Number of batches prefetched by the input pipeline. -1 lets tf.data "
+    "autotune it and 0 disables prefetching.")
+
+flags.DEFINE_bool(
+    "cache_eval_data", False,
+    "Whether to cache the eval records in memory after the first pass. "
+    "Only useful for eval sets that fit in memory.")
+
+flags.DEFINE_string(
+    "metrics_file", None,
+    "[Optional] File (.jsonl or .csv) to which step-time, throughput and "
+    "checkpoint save metrics are appended. They are also written as "
+    "TensorBoard summaries to `output_dir`. Only used if `use_tpu` is False.")
+
+flags.DEFINE_integer("metrics_every_n_steps", 100,
+                     "How many training steps are aggregated per metrics record.")
+
 
 def model_fn_builder(bert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, metrics_writer=None,
+                     metrics_every_n_steps=100, gradient_accumulation_steps=1,
+                     compute_type=tf.float32, loss_scale=None,
+                     num_recomputed_layers=0, masked_lm_loss="dense",
+                     masked_lm_num_sampled=8192, num_workers=1,
+                     worker_index=0, init_checkpoint_cache_dir=None,
+                     init_checkpoint_cache_dtype="float32"):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -131,24 +239,46 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
     masked_lm_weights = features["masked_lm_weights"]
     next_sentence_labels = features["next_sentence_labels"]
 
+    # Packed rows hold several instances, each with its own [CLS] token and
+    # next sentence label (see packing.py).
+    is_packed = "sequence_ids" in features
+    if is_packed:
+      next_sentence_weights = features["next_sentence_weights"]
+    else:
+      next_sentence_weights = tf.ones_like(
+          next_sentence_labels, dtype=tf.float32)
+
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
-    model = modeling.BertModel(
+    model = modeling_ext.BertModel(
         config=bert_config,
         is_training=is_training,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=segment_ids,
-        use_one_hot_embeddings=use_one_hot_embeddings)
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        position_ids=features.get("position_ids"),
+        sequence_ids=features.get("sequence_ids"),
+        pooled_positions=features.get("next_sentence_positions"),
+        compute_type=compute_type,
+        num_recomputed_layers=num_recomputed_layers)
+
+    # The cheaper losses select the real predictions with dynamic shapes and
+    # do not produce the log probs needed by the eval metrics.
+    masked_lm_loss_type = "dense"
+    if is_training and not use_tpu:
+      masked_lm_loss_type = masked_lm_loss
 
     (masked_lm_loss,
      masked_lm_example_loss, masked_lm_log_probs) = get_masked_lm_output(
          bert_config, model.get_sequence_output(), model.get_embedding_table(),
-         masked_lm_positions, masked_lm_ids, masked_lm_weights)
+         masked_lm_positions, masked_lm_ids, masked_lm_weights,
+         loss_type=masked_lm_loss_type, num_sampled=masked_lm_num_sampled)
 
     (next_sentence_loss, next_sentence_example_loss,
      next_sentence_log_probs) = get_next_sentence_output(
-         bert_config, model.get_pooled_output(), next_sentence_labels)
+         bert_config, model.get_pooled_output(), next_sentence_labels,
+         next_sentence_weights)
 
     total_loss = masked_lm_loss + next_sentence_loss
 
@@ -156,7 +286,14 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
     initialized_variable_names = {}
     scaffold_fn = None
-    if init_checkpoint:
+    use_checkpoint_cache = bool(
+        init_checkpoint and init_checkpoint_cache_dir and not use_tpu)
+    if use_checkpoint_cache:
+      (scaffold_fn, initialized_variable_names
+       ) = checkpoint_cache.warm_start_scaffold_fn(
+          tvars, init_checkpoint, init_checkpoint_cache_dir,
+          init_checkpoint_cache_dtype)
+    elif init_checkpoint:
       (assignment_map, initialized_variable_names
        ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
       if use_tpu:
@@ -169,29 +306,34 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
       else:
         tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
 
-    tf.logging.info("**** Trainable Variables ****")
-    for var in tvars:
-      init_string = ""
-      if var.name in initialized_variable_names:
-        init_string = ", *INIT_FROM_CKPT*"
-      tf.logging.info("  name = %s, shape = %s%s", var.name, var.shape,
-                      init_string)
+    checkpoint_cache.log_trainable_variables(
+        tvars, initialized_variable_names, summary_only=use_checkpoint_cache)
 
     output_spec = None
     if mode == tf.estimator.ModeKeys.TRAIN:
-      train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+      train_op = optimization_ext.create_optimizer(
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          gradient_accumulation_steps=gradient_accumulation_steps,
+          loss_scale=loss_scale)
+
+      training_hooks = None
+      if metrics_writer is not None and not use_tpu:
+        training_hooks = metrics_hooks.create_training_hooks(
+            metrics_writer, features, metrics_every_n_steps,
+            num_workers=num_workers, worker_index=worker_index)
 
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
           loss=total_loss,
           train_op=train_op,
+          training_hooks=training_hooks,
           scaffold_fn=scaffold_fn)
     elif mode == tf.estimator.ModeKeys.EVAL:
 
       def metric_fn(masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
                     masked_lm_weights, next_sentence_example_loss,
-                    next_sentence_log_probs, next_sentence_labels):
+                    next_sentence_log_probs, next_sentence_labels,
+                    next_sentence_weights):
         """Computes the loss and accuracy of the model."""
         masked_lm_log_probs = tf.reshape(masked_lm_log_probs,
                                          [-1, masked_lm_log_probs.shape[-1]])
@@ -212,10 +354,13 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
         next_sentence_predictions = tf.argmax(
             next_sentence_log_probs, axis=-1, output_type=tf.int32)
         next_sentence_labels = tf.reshape(next_sentence_labels, [-1])
+        next_sentence_weights = tf.reshape(next_sentence_weights, [-1])
         next_sentence_accuracy = tf.metrics.accuracy(
-            labels=next_sentence_labels, predictions=next_sentence_predictions)
+            labels=next_sentence_labels,
+            predictions=next_sentence_predictions,
+            weights=next_sentence_weights)
         next_sentence_mean_loss = tf.metrics.mean(
-            values=next_sentence_example_loss)
+            values=next_sentence_example_loss, weights=next_sentence_weights)
 
         return {
             "masked_lm_accuracy": masked_lm_accuracy,
@@ -227,7 +372,7 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
       eval_metrics = (metric_fn, [
           masked_lm_example_loss, masked_lm_log_probs, masked_lm_ids,
           masked_lm_weights, next_sentence_example_loss,
-          next_sentence_log_probs, next_sentence_labels
+          next_sentence_log_probs, next_sentence_labels, next_sentence_weights
       ])
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -243,10 +388,28 @@ def model_fn_builder(bert_config, init_checkpoint, learning_rate,
 
 
 def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
-                         label_ids, label_weights):
-  """Get loss and log probs for the masked LM."""
+                         label_ids, label_weights, loss_type="dense",
+                         num_sampled=8192):
+  """Get loss and log probs for the masked LM.
+
+  With `loss_type` "sparse" or "sampled" only the real predictions (weight
+  > 0.0) go through the output layer and no log probs are computed; None is
+  returned in their place. "sparse" computes the exact cross-entropy from the
+  integer labels, "sampled" approximates it with a sampled softmax over
+  `num_sampled` classes. Both are meant for training only.
+  """
   input_tensor = gather_indexes(input_tensor, positions)
 
+  label_ids = tf.reshape(label_ids, [-1])
+  label_weights = tf.reshape(label_weights, [-1])
+
+  if loss_type != "dense":
+    # The `positions` tensor might be zero-padded. Those padding predictions
+    # have a weight of 0.0 and are dropped before the output layer.
+    real_indexes = tf.where(label_weights > 0.0)
+    input_tensor = tf.gather_nd(input_tensor, real_indexes)
+    real_label_ids = tf.gather_nd(label_ids, real_indexes)
+
   with tf.variable_scope("cls/predictions"):
     # We apply one more non-linear transformation before the output layer.
     # This matrix is not used after pre-training.
@@ -265,21 +428,42 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
         "output_bias",
         shape=[bert_config.vocab_size],
         initializer=tf.zeros_initializer())
-    logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
-    logits = tf.nn.bias_add(logits, output_bias)
-    log_probs = tf.nn.log_softmax(logits, axis=-1)
 
-    label_ids = tf.reshape(label_ids, [-1])
-    label_weights = tf.reshape(label_weights, [-1])
+    if loss_type == "dense":
+      logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
+      logits = tf.nn.bias_add(logits, output_bias)
+      log_probs = tf.nn.log_softmax(logits, axis=-1)
 
-    one_hot_labels = tf.one_hot(
-        label_ids, depth=bert_config.vocab_size, dtype=tf.float32)
+      one_hot_labels = tf.one_hot(
+          label_ids, depth=bert_config.vocab_size, dtype=tf.float32)
+
+      # The `positions` tensor might be zero-padded (if the sequence is too
+      # short to have the maximum number of predictions). The `label_weights`
+      # tensor has a value of 1.0 for every real prediction and 0.0 for the
+      # padding predictions.
+      per_example_loss = -tf.reduce_sum(log_probs * one_hot_labels, axis=[-1])
+    else:
+      if loss_type == "sparse":
+        logits = tf.matmul(input_tensor, output_weights, transpose_b=True)
+        logits = tf.nn.bias_add(logits, output_bias)
+        real_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=real_label_ids, logits=logits)
+      elif loss_type == "sampled":
+        real_loss = tf.nn.sampled_softmax_loss(
+            weights=output_weights,
+            biases=output_bias,
+            labels=tf.expand_dims(tf.cast(real_label_ids, tf.int64), axis=-1),
+            inputs=input_tensor,
+            num_sampled=num_sampled,
+            num_classes=bert_config.vocab_size)
+      else:
+        raise ValueError("Unsupported masked LM loss: %s" % loss_type)
+      log_probs = None
+      # Padding predictions get a loss of 0.0.
+      per_example_loss = tf.scatter_nd(
+          real_indexes, real_loss,
+          tf.shape(label_weights, out_type=tf.int64))
 
-    # The `positions` tensor might be zero-padded (if the sequence is too
-    # short to have the maximum number of predictions). The `label_weights`
-    # tensor has a value of 1.0 for every real prediction and 0.0 for the
-    # padding predictions.
-    per_example_loss = -tf.reduce_sum(log_probs * one_hot_labels, axis=[-1])
     numerator = tf.reduce_sum(label_weights * per_example_loss)
     denominator = tf.reduce_sum(label_weights) + 1e-5
     loss = numerator / denominator
@@ -287,7 +471,8 @@ def get_masked_lm_output(bert_config, input_tensor, output_weights, positions,
   return (loss, per_example_loss, log_probs)
 
 
-def get_next_sentence_output(bert_config, input_tensor, labels):
+def get_next_sentence_output(bert_config, input_tensor, labels,
+                             label_weights=None):
   """Get loss and log probs for the next sentence prediction."""
 
   # Simple binary classification. Note that 0 is "next sentence" and 1 is
@@ -306,7 +491,14 @@ def get_next_sentence_output(bert_config, input_tensor, labels):
     labels = tf.reshape(labels, [-1])
     one_hot_labels = tf.one_hot(labels, depth=2, dtype=tf.float32)
     per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
-    loss = tf.reduce_mean(per_example_loss)
+    if label_weights is None:
+      loss = tf.reduce_mean(per_example_loss)
+    else:
+      # Unused next sentence slots of packed rows have a weight of 0.0.
+      label_weights = tf.reshape(label_weights, [-1])
+      numerator = tf.reduce_sum(label_weights * per_example_loss)
+      denominator = tf.reduce_sum(label_weights) + 1e-5
+      loss = numerator / denominator
     return (loss, per_example_loss, log_probs)
 
 
@@ -330,8 +522,24 @@ def input_fn_builder(input_files,
                      max_seq_length,
                      max_predictions_per_seq,
                      is_training,
-                     num_cpu_threads=4):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     max_sequences_per_pack=1,
+                     num_cpu_threads=4,
+                     shuffle_buffer_size=100,
+                     prefetch_buffer_size=0,
+                     cache_eval_data=False,
+                     num_shards=1,
+                     shard_index=0):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  Records are batched before they are parsed so that a single
+  `tf.parse_example` call decodes a whole batch. A `num_cpu_threads` or
+  `prefetch_buffer_size` of `AUTOTUNE` (-1) lets tf.data pick the value at
+  runtime; a `prefetch_buffer_size` of 0 disables prefetching.
+
+  In multi-worker training every worker reads only shard `shard_index` of
+  `num_shards` of the training data: a subset of the files if there are at
+  least as many files as shards, every `num_shards`-th record otherwise.
+  """
 
   def input_fn(params):
     """The actual input function."""
@@ -353,49 +561,74 @@ def input_fn_builder(input_files,
         "next_sentence_labels":
             tf.FixedLenFeature([1], tf.int64),
     }
+    if max_sequences_per_pack > 1:
+      name_to_features.update({
+          "position_ids":
+              tf.FixedLenFeature([max_seq_length], tf.int64),
+          "sequence_ids":
+              tf.FixedLenFeature([max_seq_length], tf.int64),
+          "next_sentence_positions":
+              tf.FixedLenFeature([max_sequences_per_pack], tf.int64),
+          "next_sentence_labels":
+              tf.FixedLenFeature([max_sequences_per_pack], tf.int64),
+          "next_sentence_weights":
+              tf.FixedLenFeature([max_sequences_per_pack], tf.float32),
+      })
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    if is_training:
+    if is_training and len(input_files) < num_shards:
+      d = tf.data.TFRecordDataset(input_files)
+      d = d.shard(num_shards, shard_index)
+      d = d.repeat()
+      d = d.shuffle(buffer_size=shuffle_buffer_size)
+    elif is_training:
       d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
+      if num_shards > 1:
+        d = d.shard(num_shards, shard_index)
       d = d.repeat()
       d = d.shuffle(buffer_size=len(input_files))
 
-      # `cycle_length` is the number of parallel files that get read.
-      cycle_length = min(num_cpu_threads, len(input_files))
-
-      # `sloppy` mode means that the interleaving is not exact. This adds
-      # even more randomness to the training pipeline.
-      d = d.apply(
-          tf.contrib.data.parallel_interleave(
-              tf.data.TFRecordDataset,
-              sloppy=is_training,
-              cycle_length=cycle_length))
-      d = d.shuffle(buffer_size=100)
+      # `cycle_length` is the number of files that get read in parallel.
+      if num_cpu_threads == AUTOTUNE:
+        cycle_length = min(os.cpu_count() or 1, len(input_files))
+      else:
+        cycle_length = min(num_cpu_threads, len(input_files))
+
+      d = d.interleave(
+          tf.data.TFRecordDataset,
+          cycle_length=cycle_length,
+          num_parallel_calls=num_cpu_threads)
+      d = d.shuffle(buffer_size=shuffle_buffer_size)
     else:
       d = tf.data.TFRecordDataset(input_files)
+      # Small eval sets can be kept in memory after the first pass so that
+      # they are read only once.
+      if cache_eval_data:
+        d = d.cache()
       # Since we evaluate for a fixed number of steps we don't want to encounter
-      # out-of-range exceptions.
+      # out-of-range exceptions. Repeating before batching also keeps the last
+      # records of every pass.
       d = d.repeat()
 
-    # We must `drop_remainder` on training because the TPU requires fixed
-    # size dimensions. For eval, we assume we are evaluating on the CPU or GPU
-    # and we *don't* want to drop the remainder, otherwise we wont cover
-    # every sample.
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            num_parallel_batches=num_cpu_threads,
-            drop_remainder=True))
+    # We must `drop_remainder` because the TPU requires fixed size dimensions.
+    # The records are batched before they are decoded, so every batch is
+    # parsed with one op.
+    d = d.batch(batch_size, drop_remainder=True)
+    d = d.map(
+        lambda records: _decode_records(records, name_to_features),
+        num_parallel_calls=num_cpu_threads)
+
+    if prefetch_buffer_size:
+      d = d.prefetch(prefetch_buffer_size)
     return d
 
   return input_fn
 
 
-def _decode_record(record, name_to_features):
-  """Decodes a record to a TensorFlow example."""
-  example = tf.parse_single_example(record, name_to_features)
+def _decode_records(records, name_to_features):
+  """Decodes a batch of records to a TensorFlow example."""
+  example = tf.parse_example(records, name_to_features)
 
   # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
   # So cast all int64 to int32.
@@ -408,19 +641,112 @@ def _decode_record(record, name_to_features):
   return example
 
 
+TrainPhase = collections.namedtuple(
+    "TrainPhase",
+    ["max_seq_length", "max_predictions_per_seq", "fraction", "input_files"])
+
+
+def get_input_files(input_file):
+  """Expands a comma separated list of glob patterns."""
+  input_files = []
+  for input_pattern in input_file.split(","):
+    input_files.extend(tf.gfile.Glob(input_pattern))
+  return input_files
+
+
+def parse_train_phases(phase_specs):
+  """Parses the `train_phases` flag into a list of `TrainPhase`s."""
+  phases = []
+  for spec in phase_specs:
+    # The file patterns come last, so they may contain ":" (e.g. gs://).
+    parts = spec.split(":", 3)
+    if len(parts) != 4:
+      raise ValueError(
+          "Invalid train phase `%s`, expected "
+          "MAX_SEQ_LENGTH:MAX_PREDICTIONS_PER_SEQ:FRACTION:INPUT_FILES" % spec)
+    input_files = get_input_files(parts[3])
+    if not input_files:
+      raise ValueError("No input files match train phase `%s`" % spec)
+    phases.append(
+        TrainPhase(
+            max_seq_length=int(parts[0]),
+            max_predictions_per_seq=int(parts[1]),
+            fraction=float(parts[2]),
+            input_files=input_files))
+
+  total_fraction = sum(phase.fraction for phase in phases)
+  if abs(total_fraction - 1.0) > 1e-6:
+    raise ValueError(
+        "Fractions of `train_phases` must sum up to 1.0, got %f" %
+        total_fraction)
+  return phases
+
+
+def get_phase_end_steps(phases, num_train_steps):
+  """Returns the optimizer step at which every phase ends."""
+  end_steps = []
+  cumulative_fraction = 0.0
+  for phase in phases[:-1]:
+    cumulative_fraction += phase.fraction
+    end_steps.append(int(round(cumulative_fraction * num_train_steps)))
+  end_steps.append(num_train_steps)
+  return end_steps
+
+
+def get_phase_batch_size(phase, train_batch_size, max_seq_length,
+                         accumulation_steps):
+  """Scales `train_batch_size` to the same number of tokens per batch.
+
+  The result is rounded down to a multiple of `accumulation_steps`.
+  """
+  batch_size = train_batch_size * max_seq_length // phase.max_seq_length
+  batch_size -= batch_size % accumulation_steps
+  return max(batch_size, accumulation_steps)
+
+
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
 
   if not FLAGS.do_train and not FLAGS.do_eval:
     raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
-  bert_config = modeling.BertConfig.from_json_file(bert_config_file.name)
+  bert_config = modeling.BertConfig.from_dict(
+      utils.read_bert_config(CONFIGPATH, FLAGS.bert_config_name))
+
+  accumulation_steps = FLAGS.gradient_accumulation_steps
+  if accumulation_steps < 1:
+    raise ValueError("`gradient_accumulation_steps` must be at least 1.")
+  if accumulation_steps > 1 and FLAGS.use_tpu:
+    raise ValueError("`gradient_accumulation_steps` is not supported on TPU.")
+  if FLAGS.train_batch_size % accumulation_steps != 0:
+    raise ValueError(
+        "`train_batch_size` (%d) must be divisible by "
+        "`gradient_accumulation_steps` (%d)" %
+        (FLAGS.train_batch_size, accumulation_steps))
+  micro_batch_size = FLAGS.train_batch_size // accumulation_steps
+
+  compute_type = modeling_ext.get_compute_type(FLAGS.precision)
+  loss_scale = FLAGS.loss_scale if compute_type == tf.float16 else None
+
+  if not FLAGS.input_file and (FLAGS.do_eval or not FLAGS.train_phases):
+    raise ValueError("`input_file` is required.")
 
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   input_files = []
-  for input_pattern in FLAGS.input_file.split(","):
-    input_files.extend(tf.gfile.Glob(input_pattern))
+  if FLAGS.input_file:
+    input_files = get_input_files(FLAGS.input_file)
+
+  if FLAGS.train_phases:
+    train_phases = parse_train_phases(FLAGS.train_phases)
+  else:
+    train_phases = [
+        TrainPhase(
+            max_seq_length=FLAGS.max_seq_length,
+            max_predictions_per_seq=FLAGS.max_predictions_per_seq,
+            fraction=1.0,
+            input_files=input_files)
+    ]
 
   tf.logging.info("*** Input Files ***")
   for input_file in input_files:
@@ -436,49 +762,124 @@ def main(_):
       cluster=tpu_cluster_resolver,
       master=FLAGS.master,
       model_dir=FLAGS.output_dir,
-      save_checkpoints_steps=FLAGS.save_checkpoints_steps,
+      # Gradient accumulators are not checkpointed, so checkpoints are only
+      # saved right after an optimizer update.
+      save_checkpoints_steps=FLAGS.save_checkpoints_steps * accumulation_steps,
       tpu_config=tf.contrib.tpu.TPUConfig(
           iterations_per_loop=FLAGS.iterations_per_loop,
           num_shards=FLAGS.num_tpu_cores,
           per_host_input_for_training=is_per_host))
 
+  # With a cluster in `TF_CONFIG` every process trains in parallel on its own
+  # shard of the data; parameter server tasks block here serving variables.
+  distributed = distribute_utils.is_distributed(run_config)
+  if distributed:
+    if FLAGS.use_tpu:
+      raise ValueError("Multi-worker training is not supported on TPU.")
+    if accumulation_steps > 1:
+      raise ValueError("`gradient_accumulation_steps` is not supported in "
+                       "multi-worker training.")
+    if FLAGS.do_eval:
+      raise ValueError("Run the evaluation as a separate process without "
+                       "`TF_CONFIG`.")
+    distribute_utils.start_server(run_config)
+  (num_shards, shard_index) = distribute_utils.get_input_shard(run_config)
+
+  metrics_writer = None
+  saving_listeners = None
+  if FLAGS.metrics_file and not FLAGS.use_tpu:
+    metrics_writer = metrics_hooks.MetricsWriter(
+        distribute_utils.get_task_file(FLAGS.metrics_file, run_config),
+        FLAGS.output_dir if run_config.is_chief else None)
+    saving_listeners = [metrics_hooks.CheckpointTimingListener(metrics_writer)]
+
   model_fn = model_fn_builder(
       bert_config=bert_config,
       init_checkpoint=FLAGS.init_checkpoint,
+      init_checkpoint_cache_dir=FLAGS.init_checkpoint_cache_dir,
+      init_checkpoint_cache_dtype=FLAGS.init_checkpoint_cache_dtype,
       learning_rate=FLAGS.learning_rate,
       num_train_steps=FLAGS.num_train_steps,
       num_warmup_steps=FLAGS.num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
-
-  # If TPU is not available, this will fall back to normal Estimator on CPU
-  # or GPU.
-  estimator = tf.contrib.tpu.TPUEstimator(
-      use_tpu=FLAGS.use_tpu,
-      model_fn=model_fn,
-      config=run_config,
-      train_batch_size=FLAGS.train_batch_size,
-      eval_batch_size=FLAGS.eval_batch_size)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      metrics_writer=metrics_writer,
+      metrics_every_n_steps=FLAGS.metrics_every_n_steps,
+      gradient_accumulation_steps=accumulation_steps,
+      compute_type=compute_type,
+      loss_scale=loss_scale,
+      num_recomputed_layers=FLAGS.num_recomputed_layers,
+      masked_lm_loss=FLAGS.masked_lm_loss,
+      masked_lm_num_sampled=FLAGS.masked_lm_num_sampled,
+      num_workers=num_shards,
+      worker_index=shard_index)
+
+  def create_estimator(train_batch_size):
+    if distributed:
+      return distribute_utils.create_estimator(model_fn, run_config,
+                                               train_batch_size)
+    # If TPU is not available, this will fall back to normal Estimator on CPU
+    # or GPU.
+    return tf.contrib.tpu.TPUEstimator(
+        use_tpu=FLAGS.use_tpu,
+        model_fn=model_fn,
+        config=run_config,
+        train_batch_size=train_batch_size,
+        eval_batch_size=FLAGS.eval_batch_size)
 
   if FLAGS.do_train:
-    tf.logging.info("***** Running training *****")
-    tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
-    train_input_fn = input_fn_builder(
-        input_files=input_files,
-        max_seq_length=FLAGS.max_seq_length,
-        max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=True)
-    estimator.train(input_fn=train_input_fn, max_steps=FLAGS.num_train_steps)
+    phase_end_steps = get_phase_end_steps(train_phases, FLAGS.num_train_steps)
+    phase_start_step = 0
+    for (phase_index, (phase, phase_end_step)) in enumerate(
+        zip(train_phases, phase_end_steps)):
+      if phase_end_step <= phase_start_step:
+        continue
+      batch_size = get_phase_batch_size(phase, FLAGS.train_batch_size,
+                                        FLAGS.max_seq_length,
+                                        accumulation_steps)
+      tf.logging.info("***** Running training *****")
+      if len(train_phases) > 1:
+        tf.logging.info("  Phase %d: steps %d to %d, max_seq_length = %d",
+                        phase_index, phase_start_step, phase_end_step,
+                        phase.max_seq_length)
+      tf.logging.info("  Batch size = %d", batch_size)
+      if accumulation_steps > 1:
+        tf.logging.info("  Micro-batch size = %d (%d accumulation steps)",
+                        batch_size // accumulation_steps, accumulation_steps)
+      # Every phase gets its own estimator, which restores the last checkpoint
+      # of the previous phase from `output_dir`.
+      estimator = create_estimator(batch_size // accumulation_steps)
+      train_input_fn = input_fn_builder(
+          input_files=phase.input_files,
+          max_seq_length=phase.max_seq_length,
+          max_predictions_per_seq=phase.max_predictions_per_seq,
+          is_training=True,
+          max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+          num_cpu_threads=FLAGS.num_cpu_threads,
+          shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+          prefetch_buffer_size=FLAGS.prefetch_buffer_size,
+          num_shards=num_shards,
+          shard_index=shard_index)
+      # The global step counts micro-batches.
+      estimator.train(input_fn=train_input_fn,
+                      max_steps=phase_end_step * accumulation_steps,
+                      saving_listeners=saving_listeners)
+      phase_start_step = phase_end_step
 
   if FLAGS.do_eval:
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Batch size = %d", FLAGS.eval_batch_size)
 
+    estimator = create_estimator(micro_batch_size)
     eval_input_fn = input_fn_builder(
         input_files=input_files,
         max_seq_length=FLAGS.max_seq_length,
         max_predictions_per_seq=FLAGS.max_predictions_per_seq,
-        is_training=False)
+        is_training=False,
+        max_sequences_per_pack=FLAGS.max_sequences_per_pack,
+        num_cpu_threads=FLAGS.num_cpu_threads,
+        prefetch_buffer_size=FLAGS.prefetch_buffer_size,
+        cache_eval_data=FLAGS.cache_eval_data)
 
     result = estimator.evaluate(
         input_fn=eval_input_fn, steps=FLAGS.max_eval_steps)
@@ -492,6 +893,5 @@ def main(_):
 
 
 if __name__ == "__main__":
-  flags.mark_flag_as_required("input_file")
   flags.mark_flag_as_required("output_dir")
   tf.app.run()
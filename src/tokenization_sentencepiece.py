@@ -9,10 +9,16 @@ from __future__ import print_function
 
 import collections
 import re
+import sys
 import unicodedata
+import numpy as np
 import sentencepiece as sp
 import six
-import tensorflow as tf
+import utils
+
+# Only `load_vocab` uses TensorFlow (for gfile paths), so tokenization alone
+# does not import it.
+tf = utils.LazyModule("tensorflow")
 
 
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
@@ -111,19 +117,87 @@ def printable_text(text):
 def load_vocab(vocab_file):
     """Loads a vocabulary file into a dictionary."""
     vocab = collections.OrderedDict()
-    index = 0
     with tf.gfile.GFile(vocab_file, "r") as reader:
-        while True:
-            token = convert_to_unicode(reader.readline())
-            if not token:
-                break
-            token, _ = token.split("\t")
-            token = token.strip()
-            vocab[token] = index
-            index += 1
+        lines = convert_to_unicode(reader.read()).splitlines()
+    for (index, line) in enumerate(lines):
+        token, _ = line.split("\t")
+        vocab[token.strip()] = index
     return vocab
 
 
+class Vocab(object):
+    """Array-backed vocabulary of SentencePiece pieces.
+
+    The pieces are kept in a fixed-width NumPy array of shape [2, vocab_size],
+    once in id order and once sorted, instead of a dict and its inverse. Ids
+    are looked up by binary search and pieces by `take`. A vocabulary saved
+    with `save` is memory-mapped by `load`, so worker processes share it.
+    """
+
+    def __init__(self, table):
+        self._table = table
+        self.pieces = table[0]
+        self._sorted_pieces = table[1]
+        self._sorted_ids = np.empty(len(self.pieces), dtype=np.int32)
+        self._sorted_ids[np.searchsorted(self._sorted_pieces, self.pieces)] = (
+            np.arange(len(self.pieces)))
+
+    @classmethod
+    def from_pieces(cls, pieces):
+        pieces = np.array(list(pieces), dtype=np.str_)
+        return cls(np.stack([pieces, np.sort(pieces)]))
+
+    @classmethod
+    def from_model(cls, processor):
+        """Returns the vocabulary of a loaded SentencePieceProcessor."""
+        return cls.from_pieces(processor.IdToPiece(i)
+                               for i in range(processor.GetPieceSize()))
+
+    @classmethod
+    def from_vocab_file(cls, vocab_file):
+        return cls.from_pieces(load_vocab(vocab_file).keys())
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps a vocabulary written by `save`."""
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        np.save(path, self._table)
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def __contains__(self, piece):
+        return self.to_ids([piece], unk_id=-1)[0] >= 0
+
+    def __getitem__(self, piece):
+        token_id = self.to_ids([piece], unk_id=-1)[0]
+        if token_id < 0:
+            raise KeyError(piece)
+        return token_id
+
+    def keys(self):
+        """Returns the pieces in id order."""
+        return self.pieces.tolist()
+
+    def to_ids(self, tokens, unk_id=0):
+        tokens = np.asarray(tokens, dtype=np.str_)
+        if not tokens.size:
+            return []
+        positions = np.minimum(
+            np.searchsorted(self._sorted_pieces, tokens), len(self) - 1)
+        found = self._sorted_pieces[positions] == tokens
+        return np.where(found, self._sorted_ids[positions], unk_id).tolist()
+
+    def to_tokens(self, ids, unk_token="<unk>"):
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < len(self))
+        tokens = self.pieces.take(np.where(valid, ids, 0)).astype(np.object_)
+        tokens[~valid] = unk_token
+        return tokens.tolist()
+
+
 def convert_by_vocab(vocab, items, unk_info):
     """Converts a sequence of [tokens|ids] using the vocab."""
     output = []
@@ -148,10 +222,43 @@ def convert_ids_to_tokens(inv_vocab, ids):
 class FullTokenizer(object):
     """Runs end-to-end tokenziation."""
 
-    def __init__(self, model_file, vocab_file, do_lower_case=True):
+    def __init__(self, model_file, vocab_file=None, do_lower_case=True):
+        """Constructs a FullTokenizer.
+
+        `vocab_file` is a .vocab file of spm_train, a vocabulary saved with
+        `Vocab.save` (.npy) or None for the vocabulary of the model itself.
+        """
+        self.model_file = model_file
+        self.vocab_file = vocab_file
+        self.do_lower_case = do_lower_case
         self.tokenizer = SentencePieceTokenizer(model_file, do_lower_case=do_lower_case)
-        self.vocab = load_vocab(vocab_file)
-        self.inv_vocab = {v: k for k, v in self.vocab.items()}
+        processor = self.tokenizer.tokenizer
+        self._piece_to_id = None
+        if not vocab_file:
+            self.vocab = Vocab.from_model(processor)
+            self._piece_to_id = processor.piece_to_id
+        else:
+            if vocab_file.endswith(".npy"):
+                self.vocab = Vocab.load(vocab_file)
+            else:
+                self.vocab = Vocab.from_vocab_file(vocab_file)
+            # The .vocab file of spm_train lists the pieces of the model in id
+            # order; then the model converts tokens to ids without a table.
+            if np.array_equal(self.vocab.pieces,
+                              Vocab.from_model(processor).pieces):
+                self._piece_to_id = processor.piece_to_id
+
+    def __getstate__(self):
+        # Pickled as the constructor arguments, e.g. for worker processes,
+        # which load the SentencePiece model themselves.
+        return {
+            "model_file": self.model_file,
+            "vocab_file": self.vocab_file,
+            "do_lower_case": self.do_lower_case,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
 
     def tokenize(self, text):
         split_tokens = self.tokenizer.tokenize(text)
@@ -159,11 +266,13 @@ class FullTokenizer(object):
 
     def convert_tokens_to_ids(self, tokens):
         """Id of <unk> is assumed as 0 accroding to sentencepiece"""
-        return convert_by_vocab(self.vocab, tokens, unk_info=0)
+        if self._piece_to_id is not None:
+            return self._piece_to_id(list(tokens))
+        return self.vocab.to_ids(tokens, unk_id=0)
 
     def convert_ids_to_tokens(self, ids):
         """Token of unknown word is assumed as <unk> according to sentencepiece"""
-        return convert_by_vocab(self.inv_vocab, ids, unk_info="<unk>")
+        return self.vocab.to_tokens(ids, unk_token="<unk>")
 
 
 class SentencePieceTokenizer(object):
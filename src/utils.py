@@ -1,11 +1,93 @@
-def str_to_value(input_str):
+import collections
+import configparser
+import functools
+import importlib
+import os
+import types
+
+# Values of the `--precision` flags (see modeling_ext.py). Defined here so the
+# flags can be declared without importing TensorFlow.
+PRECISIONS = ("float32", "float16", "bfloat16")
+
+
+# Types of the BERT-CONFIG values of config.ini, as expected by
+# `modeling.BertConfig`.
+BERT_CONFIG_SCHEMA = collections.OrderedDict([
+    ('vocab_size', int),
+    ('hidden_size', int),
+    ('num_hidden_layers', int),
+    ('num_attention_heads', int),
+    ('hidden_act', str),
+    ('intermediate_size', int),
+    ('hidden_dropout_prob', float),
+    ('attention_probs_dropout_prob', float),
+    ('max_position_embeddings', int),
+    ('type_vocab_size', int),
+    ('initializer_range', float),
+])
+
+BERT_CONFIG_SECTION = 'BERT-CONFIG'
+
+
+def read_bert_config(config_path, name=None):
     """
-    Convert data type of value of dict to appropriate one.
-    Assume there are only three types: str, int, float.
+    Read a BERT model config of config.ini as a dict for
+    `modeling.BertConfig.from_dict`.
+
+    Without `name` this is the BERT-CONFIG section. A named config is the
+    section `BERT-CONFIG:<name>`, whose values override those of BERT-CONFIG
+    (e.g. only `num_hidden_layers` for a smaller model). Values are converted
+    with BERT_CONFIG_SCHEMA, and the file is only read once per process.
     """
-    if input_str.isalpha():
-        return input_str
-    elif input_str.isdigit():
-        return int(input_str)
-    else:
-        return float(input_str)
+    return dict(_read_bert_config(os.path.abspath(config_path), name))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_bert_config(config_path, name):
+    config = configparser.ConfigParser()
+    if not config.read(config_path, encoding='utf-8'):
+        raise ValueError('Cannot read %s' % config_path)
+    sections = [BERT_CONFIG_SECTION]
+    if name:
+        sections.append('%s:%s' % (BERT_CONFIG_SECTION, name))
+        if not config.has_section(sections[-1]):
+            named = [section.split(':', 1)[1] for section in config.sections()
+                     if section.startswith(BERT_CONFIG_SECTION + ':')]
+            raise ValueError('No BERT config named %r in %s (available: %s)'
+                             % (name, config_path, ', '.join(named) or 'none'))
+    values = collections.OrderedDict()
+    for section in sections:
+        for key, value in config[section].items():
+            if key not in BERT_CONFIG_SCHEMA:
+                raise ValueError('Unknown key %r in [%s] of %s' %
+                                 (key, section, config_path))
+            try:
+                values[key] = BERT_CONFIG_SCHEMA[key](value)
+            except ValueError:
+                raise ValueError('Invalid %s value %r of %r in [%s] of %s' %
+                                 (BERT_CONFIG_SCHEMA[key].__name__, value,
+                                  key, section, config_path))
+    return tuple(values.items())
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module that is only imported when one of its attributes is first used,
+    like TensorFlow's own `lazy_loader.LazyLoader`. Entry points import
+    TensorFlow and the modules that depend on it this way, so `--help`,
+    flag errors and tokenization-only code paths never load TensorFlow.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+
+    def _load(self):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __dir__(self):
+        return dir(self._load())